@@ -0,0 +1,32 @@
+"""add push progress columns to stream_quality_metrics
+
+Revision ID: 3f9a1c7e2b40
+Revises: 
+Create Date: 2026-10-18 10:12:31.402117
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3f9a1c7e2b40'
+down_revision: Union[str, None] = None
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('stream_quality_metrics', sa.Column('dropped_frames', sa.Integer(), nullable=True))
+    op.add_column('stream_quality_metrics', sa.Column('speed', sa.Float(), nullable=True))
+    # 按直播流查询最近的质量指标
+    op.create_index('ix_stream_quality_metrics_stream_id_timestamp', 'stream_quality_metrics',
+                    ['stream_id', 'timestamp'])
+
+
+def downgrade() -> None:
+    op.drop_index('ix_stream_quality_metrics_stream_id_timestamp', table_name='stream_quality_metrics')
+    op.drop_column('stream_quality_metrics', 'speed')
+    op.drop_column('stream_quality_metrics', 'dropped_frames')
@@ -0,0 +1,45 @@
+"""add live_stream search indexes
+
+Revision ID: 8c2d5e61a9f3
+Revises: 3f9a1c7e2b40
+Create Date: 2026-10-18 11:04:52.718340
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8c2d5e61a9f3'
+down_revision: Union[str, None] = '3f9a1c7e2b40'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# (索引名, 列) 与 app/models/stream.py 中 LiveStream.__table_args__ 保持一致
+BTREE_INDEXES = [
+    ('ix_live_stream_created_at_id', ['created_at', 'id']),
+    ('ix_live_stream_status_created_at_id', ['status', 'created_at', 'id']),
+    ('ix_live_stream_category_status_created_at_id', ['category_id', 'status', 'created_at', 'id']),
+    ('ix_live_stream_private_status_created_at_id', ['is_private', 'status', 'created_at', 'id']),
+]
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # 大表上建索引不锁写，CONCURRENTLY 不能在事务中执行
+    with op.get_context().autocommit_block():
+        for name, columns in BTREE_INDEXES:
+            op.create_index(name, 'live_stream', columns, postgresql_concurrently=True, if_not_exists=True)
+        op.create_index('ix_live_stream_title_trgm', 'live_stream', ['title'],
+                        postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'},
+                        postgresql_concurrently=True, if_not_exists=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_live_stream_title_trgm', table_name='live_stream',
+                      postgresql_concurrently=True, if_exists=True)
+        for name, _ in reversed(BTREE_INDEXES):
+            op.drop_index(name, table_name='live_stream', postgresql_concurrently=True, if_exists=True)
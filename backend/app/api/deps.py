@@ -1,17 +1,14 @@
 # backend/app/api/deps.py
-from typing import Generator
-from sqlalchemy.orm import Session
-from app.db.session import SessionLocal
+from typing import AsyncGenerator
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db.session import AsyncSessionLocal
 
-def get_db() -> Generator:
+async def get_db() -> AsyncGenerator[AsyncSession, None]:
     """
-    获取数据库会话
+    获取异步数据库会话
     """
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 def get_current_user():
     """
@@ -1,17 +1,25 @@
 # app/api/v1/endpoints/stream.py
 import os
-import shutil
-from typing import List
+from typing import List, Optional, Union
 from uuid import UUID
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Request, Header
+from fastapi.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.api.deps import get_db, get_current_user
-from app.services.stream import StreamService
+from app.services.stream import StreamService, STREAM_NO_LOADERS
+from app.services.push_supervisor import push_supervisor
+from app.services.upload import upload_service, UploadConflictError
+from app.services.direct_upload import direct_upload_service
 from app.schemas.stream import (
     StreamCreate, StreamUpdate, Stream, StreamList,
     StreamStatusUpdate, StreamSearch, StreamPermissionCreate,
     StreamPermissionUpdate, StreamPermission, StreamPermissionRuleCreate,
-    StreamPermissionRuleUpdate, StreamPermissionRule
+    StreamPermissionRuleUpdate, StreamPermissionRule, StreamCountMode, StreamSummaryList
+)
+from app.schemas.upload import (
+    UploadSessionCreate, UploadSession, UploadComplete, DirectUploadCreate, DirectUploadSession,
+    DirectUploadPart, DirectUploadPartsRequest, UploadedPart, DirectUploadComplete, DirectUploadResult
 )
 
 from app.core.config import settings
@@ -21,32 +29,20 @@ router = APIRouter()
 
 @router.get("/")
 async def list_streams(
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_db),
         current_user: dict = Depends(get_current_user)
 ):
     try:
         print(f"获取用户 {current_user['id']} 的直播流列表")  # 添加日志
         service = StreamService(db)
-        streams = service.get_user_streams(current_user["id"])
+        # 列表页只查询需要展示的列
+        streams = await service.get_user_streams(current_user["id"], lean=True)
         print(f"找到 {len(streams)} 个直播流")  # 添加日志
 
         return {
             "message": "success",
             "data": [
-                {
-                    "id": str(stream.id),
-                    "title": stream.title,
-                    "description": stream.description,
-                    "cover_url": stream.cover_url,
-                    "stream_key": stream.stream_key,
-                    "storage_type": stream.storage_type,
-                    "status": stream.status,
-                    "region": stream.region,
-                    "provider": stream.provider,
-                    "is_private": stream.is_private,
-                    "is_recorded": stream.is_recorded,
-                    "created_at": stream.created_at
-                }
+                {**stream, "id": str(stream["id"])}
                 for stream in streams
             ]
         }
@@ -58,7 +54,7 @@ async def list_streams(
 @router.post("/")
 async def create_stream(
     stream: StreamCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     """创建直播流"""
@@ -66,7 +62,7 @@ async def create_stream(
         print("1")
         service = StreamService(db)
         print("2")
-        db_stream = service.create_stream(stream, current_user["id"])
+        db_stream = await service.create_stream(stream, current_user["id"])
         print("3")
         return {
             "message": "success",
@@ -79,122 +75,139 @@ async def create_stream(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/pushes")
+async def list_pushes(
+    current_user: dict = Depends(get_current_user)
+):
+    """查看本节点上所有推流进程"""
+    return {"message": "success", "data": push_supervisor.list()}
+
+@router.get("/search", response_model=Union[StreamList, StreamSummaryList])
+async def search_streams(
+    search: StreamSearch = Depends(),
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """搜索直播流，使用 next_cursor 翻页"""
+    service = StreamService(db)
+    try:
+        streams, total, next_cursor = await service.search_streams(search)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    list_model = StreamSummaryList if search.lean else StreamList
+    return list_model(
+        total=total,
+        total_is_estimate=search.count_mode == StreamCountMode.ESTIMATED,
+        next_cursor=next_cursor,
+        items=streams
+    )
+
 @router.get("/{stream_id}", response_model=Stream)
-def get_stream(
+async def get_stream(
     stream_id: UUID,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    stream = service.get_stream(stream_id)
+    stream = await service.get_stream(stream_id)
     if not stream:
         raise HTTPException(status_code=404, detail="Stream not found")
     return stream
 
-@router.get("/", response_model=StreamList)
-def search_streams(
-    search: StreamSearch = Depends(),
-    db: Session = Depends(get_db),
-    current_user: dict = Depends(get_current_user)
-):
-    service = StreamService(db)
-    streams, total = service.search_streams(search)
-    return StreamList(total=total, items=streams)
-
 @router.put("/{stream_id}", response_model=Stream)
-def update_stream(
+async def update_stream(
     stream_id: UUID,
     stream: StreamUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    db_stream = service.get_stream(stream_id)
+    db_stream = await service.get_stream(stream_id)
     if not db_stream:
         raise HTTPException(status_code=404, detail="Stream not found")
     if db_stream.user_id != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return service.update_stream(stream_id, stream)
+    return await service.update_stream(stream_id, stream)
 
 @router.delete("/{stream_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_stream(
+async def delete_stream(
     stream_id: UUID,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    db_stream = service.get_stream(stream_id)
+    db_stream = await service.get_stream(stream_id)
     if not db_stream:
         raise HTTPException(status_code=404, detail="Stream not found")
     if db_stream.user_id != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    if not service.delete_stream(stream_id):
+    if not await service.delete_stream(stream_id):
         raise HTTPException(status_code=400, detail="Failed to delete stream")
 
 @router.put("/{stream_id}/status", response_model=Stream)
-def update_stream_status(
+async def update_stream_status(
     stream_id: UUID,
     status_update: StreamStatusUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    db_stream = service.get_stream(stream_id)
+    db_stream = await service.get_stream(stream_id)
     if not db_stream:
         raise HTTPException(status_code=404, detail="Stream not found")
     if db_stream.user_id != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return service.update_stream_status(stream_id, status_update)
+    return await service.update_stream_status(stream_id, status_update)
 
 @router.post("/{stream_id}/permissions", response_model=StreamPermission)
-def create_stream_permission(
+async def create_stream_permission(
     stream_id: UUID,
     permission: StreamPermissionCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    db_stream = service.get_stream(stream_id)
+    db_stream = await service.get_stream(stream_id)
     if not db_stream:
         raise HTTPException(status_code=404, detail="Stream not found")
     if db_stream.user_id != current_user["id"]:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return service.create_stream_permission(permission)
+    return await service.create_stream_permission(permission)
 
 @router.put("/permissions/{permission_id}", response_model=StreamPermission)
-def update_stream_permission(
+async def update_stream_permission(
     permission_id: UUID,
     permission: StreamPermissionUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    return service.update_stream_permission(permission_id, permission)
+    return await service.update_stream_permission(permission_id, permission)
 
 @router.post("/permission-rules", response_model=StreamPermissionRule)
-def create_stream_permission_rule(
+async def create_stream_permission_rule(
     rule: StreamPermissionRuleCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    return service.create_stream_permission_rule(rule)
+    return await service.create_stream_permission_rule(rule)
 
 @router.put("/permission-rules/{rule_id}", response_model=StreamPermissionRule)
-def update_stream_permission_rule(
+async def update_stream_permission_rule(
     rule_id: UUID,
     rule: StreamPermissionRuleUpdate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     service = StreamService(db)
-    return service.update_stream_permission_rule(rule_id, rule)
+    return await service.update_stream_permission_rule(rule_id, rule)
 
 
 @router.post("/{stream_id}/push")
 async def start_streaming(
     stream_id: UUID,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     """启动推流"""
@@ -214,7 +227,7 @@ async def start_streaming(
 @router.post("/{stream_id}/stop")
 async def stop_streaming(
     stream_id: UUID,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     """停止推流"""
@@ -227,29 +240,59 @@ async def stop_streaming(
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/{stream_id}/push")
+async def get_push_status(
+    stream_id: UUID,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """查看推流进程状态"""
+    service = StreamService(db)
+    push_status = service.get_push_status(stream_id)
+    if not push_status:
+        raise HTTPException(status_code=404, detail="推流进程不存在")
+    return {"message": "success", "data": push_status}
+
+@router.post("/{stream_id}/restart")
+async def restart_streaming(
+    stream_id: UUID,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """重启推流进程"""
+    service = StreamService(db)
+    push_status = await service.restart_streaming(stream_id)
+    if not push_status:
+        raise HTTPException(status_code=404, detail="推流进程不存在")
+    return {"message": "success", "data": push_status}
+
 @router.post("/{stream_id}/upload")
 async def upload_video(
     stream_id: UUID,
     file: UploadFile = File(...),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: dict = Depends(get_current_user)
 ):
     """上传视频文件"""
     try:
         # 获取直播流信息
         service = StreamService(db)
-        stream = service.get_stream(stream_id)
+        stream = await service.get_stream(stream_id)
         if not stream:
             raise HTTPException(status_code=404, detail="直播流不存在")
 
         # 创建上传目录
         upload_dir = os.path.join(settings.UPLOAD_DIR, str(stream_id))
-        os.makedirs(upload_dir, exist_ok=True)
+        await run_in_threadpool(os.makedirs, upload_dir, exist_ok=True)
 
-        # 保存文件
-        file_path = os.path.join(upload_dir, file.filename)
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # 分块读取上传内容，磁盘写入放到线程池，避免大文件阻塞事件循环
+        file_path = os.path.join(upload_dir, os.path.basename(file.filename))
+        buffer = await run_in_threadpool(open, file_path, "wb")
+        try:
+            while chunk := await file.read(settings.UPLOAD_IO_BLOCK_SIZE):
+                await run_in_threadpool(buffer.write, chunk)
+        finally:
+            await run_in_threadpool(buffer.close)
 
         # 更新直播流信息
         success = await service.upload_video(stream_id, file_path)
@@ -264,4 +307,171 @@ async def upload_video(
             }
         }
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/{stream_id}/uploads", response_model=UploadSession)
+async def create_upload_session(
+    stream_id: UUID,
+    upload: UploadSessionCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """创建分片上传会话"""
+    service = StreamService(db)
+    if not await service.get_stream(stream_id, loaders=STREAM_NO_LOADERS):
+        raise HTTPException(status_code=404, detail="直播流不存在")
+    try:
+        session = await upload_service.create_session(str(stream_id), upload.filename,
+                                                      upload.file_size, upload.chunk_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return session.to_dict()
+
+@router.get("/{stream_id}/uploads/{upload_id}", response_model=UploadSession)
+async def get_upload_session(
+    stream_id: UUID,
+    upload_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """查询上传会话，续传时根据 received_chunks 只补传缺失的分片"""
+    session = await upload_service.get_session(str(stream_id), upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="上传会话不存在")
+    return session.to_dict()
+
+@router.put("/{stream_id}/uploads/{upload_id}/chunks/{index}", response_model=UploadSession)
+async def upload_chunk(
+    stream_id: UUID,
+    upload_id: str,
+    index: int,
+    request: Request,
+    x_chunk_sha256: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """上传一个分片，请求体为分片原始数据，可通过 X-Chunk-SHA256 头校验"""
+    session = await upload_service.get_session(str(stream_id), upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="上传会话不存在")
+    try:
+        session = await upload_service.write_chunk(session, index, request.stream(), x_chunk_sha256)
+    except UploadConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ClientDisconnect:
+        raise HTTPException(status_code=400, detail=f"分片 {index} 上传中断，请重新上传")
+    return session.to_dict()
+
+@router.post("/{stream_id}/uploads/{upload_id}/complete", response_model=UploadSession)
+async def complete_upload(
+    stream_id: UUID,
+    upload_id: str,
+    complete: Optional[UploadComplete] = None,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """所有分片上传完成后合并为视频文件，并更新直播流的视频路径"""
+    session = await upload_service.get_session(str(stream_id), upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="上传会话不存在")
+    try:
+        session = await upload_service.complete(session, complete.sha256 if complete else None)
+    except UploadConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    service = StreamService(db)
+    if not await service.upload_video(stream_id, session.file_path):
+        raise HTTPException(status_code=400, detail="上传视频失败")
+    return session.to_dict()
+
+@router.delete("/{stream_id}/uploads/{upload_id}")
+async def abort_upload(
+    stream_id: UUID,
+    upload_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """取消上传并删除已上传的分片"""
+    if not await upload_service.abort(str(stream_id), upload_id):
+        raise HTTPException(status_code=404, detail="上传会话不存在")
+    return {"message": "success"}
+
+@router.post("/{stream_id}/direct-uploads", response_model=DirectUploadSession)
+async def create_direct_upload(
+    stream_id: UUID,
+    upload: DirectUploadCreate,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """创建直传 R2 的分片上传，返回首批分片的预签名上传地址"""
+    service = StreamService(db)
+    if not await service.get_stream(stream_id, loaders=STREAM_NO_LOADERS):
+        raise HTTPException(status_code=404, detail="直播流不存在")
+    try:
+        return await direct_upload_service.create(str(stream_id), upload.filename, upload.file_size,
+                                                  upload.content_type, upload.part_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/{stream_id}/direct-uploads/{upload_id}/parts", response_model=List[DirectUploadPart])
+async def presign_direct_upload_parts(
+    stream_id: UUID,
+    upload_id: str,
+    request: DirectUploadPartsRequest,
+    current_user: dict = Depends(get_current_user)
+):
+    """签发指定分片的上传地址"""
+    try:
+        return await direct_upload_service.presign_parts(str(stream_id), request.key, upload_id,
+                                                         request.part_numbers)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/{stream_id}/direct-uploads/{upload_id}/parts", response_model=List[UploadedPart])
+async def list_direct_upload_parts(
+    stream_id: UUID,
+    upload_id: str,
+    key: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """查询 R2 已收到的分片，续传时只上传缺失的分片"""
+    try:
+        return await direct_upload_service.list_parts(str(stream_id), key, upload_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.post("/{stream_id}/direct-uploads/{upload_id}/complete", response_model=DirectUploadResult)
+async def complete_direct_upload(
+    stream_id: UUID,
+    upload_id: str,
+    complete: DirectUploadComplete,
+    db: AsyncSession = Depends(get_db),
+    current_user: dict = Depends(get_current_user)
+):
+    """合并分片，并把直播流的视频源指向 R2 上的对象"""
+    service = StreamService(db)
+    if not await service.get_stream(stream_id, loaders=STREAM_NO_LOADERS):
+        raise HTTPException(status_code=404, detail="直播流不存在")
+    parts = [part.model_dump() for part in complete.parts] if complete.parts else None
+    try:
+        result = await direct_upload_service.complete(str(stream_id), complete.key, upload_id, parts)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    await service.attach_storage_object(stream_id, result["bucket"], result["key"])
+    return result
+
+@router.delete("/{stream_id}/direct-uploads/{upload_id}")
+async def abort_direct_upload(
+    stream_id: UUID,
+    upload_id: str,
+    key: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """取消直传，R2 会删除已上传的分片"""
+    try:
+        await direct_upload_service.abort(str(stream_id), key, upload_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"message": "success"}
@@ -24,6 +24,79 @@ class Settings(BaseSettings):
     POSTGRES_DB: str = "livestream_saas"
     DATABASE_URL: str = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}/{POSTGRES_DB}"
     SQLALCHEMY_DATABASE_URI: str = DATABASE_URL  # 为了兼容性保留
+
+    # 异步数据库配置
+    ASYNC_DATABASE_URL: str = ""  # 为空时由 DATABASE_URL 推导为 postgresql+asyncpg://
+    DB_POOL_SIZE: int = 10  # 连接池常驻连接数
+    DB_MAX_OVERFLOW: int = 20  # 超出连接池后允许临时创建的连接数
+    DB_POOL_TIMEOUT: float = 30.0  # 等待空闲连接的超时时间（秒）
+    DB_POOL_RECYCLE: int = 1800  # 连接最长使用时间（秒），超过后重建
+    DB_POOL_PRE_PING: bool = True  # 取出连接前检测是否可用
+    DB_STATEMENT_CACHE_SIZE: int = 100  # asyncpg 预编译语句缓存大小，使用 pgbouncer 时设为 0
+
+    # 推流进程管理配置
+    FFMPEG_BINARY: str = "ffmpeg"
+    PUSH_MAX_PROCESSES: int = 500  # 单节点最大推流进程数
+    PUSH_MAX_RESTARTS: int = 5  # 连续异常退出的最大重启次数
+    PUSH_BACKOFF_BASE: float = 1.0  # 重启退避基数（秒），按 2 的指数增长
+    PUSH_BACKOFF_MAX: float = 60.0  # 重启退避上限（秒）
+    PUSH_STABLE_AFTER: float = 60.0  # 运行超过该时长后崩溃，重新计算退避
+    PUSH_STOP_TIMEOUT: float = 10.0  # 停止推流时等待进程退出的时间，超时则 kill
+    PUSH_STDERR_TAIL_LINES: int = 50  # 保留的 ffmpeg 错误输出行数
+    PUSH_SOURCE_URL_EXPIRES: int = 7 * 24 * 3600  # 推流读取 R2 视频的预签名地址有效期（秒），重启沿用原地址，SigV4 最长 7 天
+
+    # 推流质量指标采集配置
+    QUALITY_SAMPLE_INTERVAL: float = 5.0  # 每个直播流的采样间隔（秒）
+    QUALITY_FLUSH_INTERVAL: float = 10.0  # 批量写入间隔（秒）
+    QUALITY_BATCH_SIZE: int = 500  # 缓冲达到该条数立即写入
+    QUALITY_BUFFER_MAX: int = 20000  # 缓冲区上限，数据库不可用时丢弃最早的采样
+
+    # 视频上传配置
+    UPLOAD_DIR: str = "uploads"
+    UPLOAD_CHUNK_SIZE: int = 8 * 1024 * 1024  # 分片上传的默认分片大小
+    UPLOAD_MAX_CHUNK_SIZE: int = 64 * 1024 * 1024  # 客户端可指定的最大分片大小
+    UPLOAD_MAX_FILE_SIZE: int = 50 * 1024 * 1024 * 1024  # 单个视频文件大小上限
+    UPLOAD_SESSION_TTL: int = 7 * 24 * 3600  # 未完成的上传会话保留时间（秒）
+    UPLOAD_IO_BLOCK_SIZE: int = 1024 * 1024  # 写入磁盘的单次块大小
+
+    # R2 对象存储配置，密钥通过环境变量设置
+    R2_ENDPOINT_URL: str = "https://fbc0f7bc8a3bdb7d0a20307c4eaf8cde.r2.cloudflarestorage.com"
+    R2_ACCESS_KEY: str = ""
+    R2_SECRET_KEY: str = ""
+    R2_BUCKET: str = "raw-video"
+    R2_PUBLIC_URL: str = "https://pub-8ea55317b8624238a35e5c73454b9d2d.r2.dev"
+    R2_MAX_POOL_CONNECTIONS: int = 0  # 单个客户端的 HTTP 连接池大小，为 0 时按 HLS 上传的最大并发连接数计算
+    R2_CONNECT_TIMEOUT: float = 10.0
+    R2_READ_TIMEOUT: float = 60.0
+    R2_MAX_ATTEMPTS: int = 5  # 请求失败的最大尝试次数，包含第一次
+
+    # HLS 上传配置
+    HLS_UPLOAD_WORKERS: int = 16  # 并发上传的文件数
+    HLS_MULTIPART_THRESHOLD: int = 64 * 1024 * 1024  # 超过该大小才分片上传，ts 分片走单次 PUT
+    HLS_MULTIPART_CHUNKSIZE: int = 16 * 1024 * 1024
+    HLS_MULTIPART_CONCURRENCY: int = 4  # 单个文件分片上传的并发数，文件级并发由 HLS_UPLOAD_WORKERS 控制
+    HLS_PLAYLIST_CACHE_CONTROL: str = "public, max-age=60"  # 播放列表可能更新，短缓存
+    HLS_SEGMENT_CACHE_CONTROL: str = "public, max-age=604800, immutable"  # 分片内容不变，CDN 缓存 7 天
+
+    # 客户端直传 R2 配置
+    DIRECT_UPLOAD_PART_SIZE: int = 64 * 1024 * 1024  # 默认分片大小，S3 协议要求除最后一片外不小于 5MB
+    DIRECT_UPLOAD_URL_EXPIRES: int = 3600  # 预签名地址有效期（秒）
+    DIRECT_UPLOAD_PRESIGN_BATCH: int = 100  # 单次请求最多签发的分片地址数
+
+    @property
+    def r2_max_pool_connections(self) -> int:
+        # 每个上传线程上传大文件时最多同时占用 HLS_MULTIPART_CONCURRENCY 个连接
+        if self.R2_MAX_POOL_CONNECTIONS:
+            return self.R2_MAX_POOL_CONNECTIONS
+        return self.HLS_UPLOAD_WORKERS * self.HLS_MULTIPART_CONCURRENCY
+
+    @property
+    def async_database_url(self) -> str:
+        if self.ASYNC_DATABASE_URL:
+            return self.ASYNC_DATABASE_URL
+        scheme, _, rest = self.DATABASE_URL.partition("://")
+        return f"postgresql+asyncpg://{rest}"
+
     class Config:
         case_sensitive = True
 
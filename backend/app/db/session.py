@@ -1,8 +1,29 @@
 # backend/app/db/session.py
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.orm import sessionmaker
 from app.core.config import settings
 
 # 确保使用正确的数据库 URI
+# 同步引擎只给脚本和 alembic 使用，API 请求走下面的异步引擎
 engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
\ No newline at end of file
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# 异步引擎（asyncpg），连接池参数都可以通过 Settings 配置
+# SQLAlchemy 层的 asyncpg 预编译语句缓存通过 URL 参数设置
+async_database_url = make_url(settings.async_database_url).update_query_dict(
+    {"prepared_statement_cache_size": str(settings.DB_STATEMENT_CACHE_SIZE)}
+)
+async_engine = create_async_engine(
+    async_database_url,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+    # asyncpg 自身的预编译语句缓存，经过 pgbouncer 事务模式时需要设为 0
+    connect_args={"statement_cache_size": settings.DB_STATEMENT_CACHE_SIZE},
+)
+# 提交后不过期对象，避免在异步上下文中访问属性时触发隐式 IO
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
@@ -3,6 +3,8 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.api.v1.api import api_router
 from app.core.config import settings
+from app.services.push_supervisor import push_supervisor
+from app.services.ffmpeg_progress import quality_recorder
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
@@ -45,6 +47,16 @@ async def root():
 async def root():
     return {"message": "Welcome to Live Streaming SaaS API"}
 
+@app.on_event("startup")
+async def start_quality_recorder():
+    quality_recorder.start()
+
+@app.on_event("shutdown")
+async def stop_push_processes():
+    # 退出前停止所有推流进程，避免遗留 ffmpeg 子进程，再写入剩余的质量指标
+    await push_supervisor.shutdown()
+    await quality_recorder.stop()
+
 @app.get("/health")
 async def health_check():
     return {"status": "ok"}
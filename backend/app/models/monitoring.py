@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, UUID, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, UUID, Float, ForeignKey, Index
 from sqlalchemy.sql import func
 import uuid
 from ..core.database import Base
@@ -16,8 +16,14 @@ class StreamQualityMetrics(Base):
     buffer_health = Column(Float)
     error_rate = Column(Float)
     connection_count = Column(Integer)
+    dropped_frames = Column(Integer)  # 推流累计丢帧数
+    speed = Column(Float)  # 推流速率，1.0 表示实时
     timestamp = Column(DateTime(timezone=True), server_default=func.now())
 
+    __table_args__ = (
+        Index("ix_stream_quality_metrics_stream_id_timestamp", "stream_id", "timestamp"),
+    )
+
 class SystemResourceMetrics(Base):
     __tablename__ = "system_resource_metrics"
 
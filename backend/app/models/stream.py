@@ -1,6 +1,6 @@
 # app/models/stream.py
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, UUID, ForeignKey, Text, JSON
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, UUID, ForeignKey, Text, JSON, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship, backref
 import uuid
@@ -122,6 +122,17 @@ class LiveStream(Base):
     tags = relationship("StreamTag", secondary="stream_tag_relations", back_populates="streams")
     permissions = relationship("StreamPermission", back_populates="stream")
 
+    # 搜索接口按 (created_at, id) 游标分页，索引与可组合的过滤条件对应
+    __table_args__ = (
+        Index("ix_live_stream_created_at_id", "created_at", "id"),
+        Index("ix_live_stream_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_live_stream_category_status_created_at_id", "category_id", "status", "created_at", "id"),
+        Index("ix_live_stream_private_status_created_at_id", "is_private", "status", "created_at", "id"),
+        # 标题包含搜索（ILIKE '%x%'）使用 pg_trgm 三元组索引
+        Index("ix_live_stream_title_trgm", "title",
+              postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}),
+    )
+
 class StreamPermission(Base):
     __tablename__ = "stream_permissions"
 
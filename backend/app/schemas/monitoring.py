@@ -21,6 +21,8 @@ class StreamQualityMetricsBase(BaseModel):
     buffer_health: Optional[float] = Field(None, ge=0.0, le=1.0)
     error_rate: Optional[float] = Field(None, ge=0.0, le=1.0)
     connection_count: Optional[int] = Field(None, ge=0)
+    dropped_frames: Optional[int] = Field(None, ge=0)
+    speed: Optional[float] = Field(None, ge=0.0)
 
 # 创建流质量指标请求模型
 class StreamQualityMetricsCreate(StreamQualityMetricsBase):
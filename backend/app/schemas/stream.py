@@ -107,6 +107,31 @@ class StreamPermission(StreamPermissionBase):
     class Config:
         from_attributes = True
 
+# 直播关联数据的精简模型
+class StreamCategoryBrief(BaseModel):
+    id: UUID4
+    name: str
+
+    class Config:
+        from_attributes = True
+
+class StreamTagBrief(BaseModel):
+    id: UUID4
+    name: str
+
+    class Config:
+        from_attributes = True
+
+class StreamStatisticsBrief(BaseModel):
+    total_viewer_count: int = 0
+    peak_viewer_count: int = 0
+    total_like_count: int = 0
+    total_share_count: int = 0
+    total_comment_count: int = 0
+
+    class Config:
+        from_attributes = True
+
 # 直播响应模型
 class Stream(StreamBase):
     id: UUID4
@@ -129,28 +154,67 @@ class Stream(StreamBase):
     updated_at: Optional[datetime]
     permissions: List[StreamPermission] = []
     permission_rules: List[StreamPermissionRule] = []
+    category: Optional[StreamCategoryBrief] = None
+    tags: List[StreamTagBrief] = []
+    statistics: List[StreamStatisticsBrief] = []
+
+    class Config:
+        from_attributes = True
+
+# 列表页使用的精简响应模型，只包含列表展示需要的列，不加载任何关联
+class StreamSummary(BaseModel):
+    id: UUID4
+    title: str
+    description: Optional[str] = None
+    cover_url: Optional[str] = None
+    stream_key: str
+    storage_type: str
+    status: StreamStatus
+    region: str
+    provider: str
+    is_private: bool = False
+    is_recorded: bool = True
+    created_at: datetime
 
     class Config:
         from_attributes = True
 
 # 直播列表响应模型
 class StreamList(BaseModel):
-    total: int
+    total: Optional[int] = None  # count_mode=none 时不返回总数
+    total_is_estimate: bool = False  # count_mode=estimated 时为 True
+    next_cursor: Optional[str] = None  # 为空表示没有下一页
     items: List[Stream]
 
+# 精简模式的直播列表响应模型
+class StreamSummaryList(BaseModel):
+    total: Optional[int] = None
+    total_is_estimate: bool = False
+    next_cursor: Optional[str] = None
+    items: List[StreamSummary]
+
 # 直播状态更新模型
 class StreamStatusUpdate(BaseModel):
     status: StreamStatus
     start_time: Optional[datetime] = None
     end_time: Optional[datetime] = None
 
+# 搜索结果总数的统计方式
+class StreamCountMode(str, Enum):
+    EXACT = "exact"          # count(*)，大表上代价高
+    ESTIMATED = "estimated"  # 使用查询计划的估算行数
+    NONE = "none"            # 不统计总数
+
 # 直播搜索模型
 class StreamSearch(BaseModel):
     title: Optional[str] = None
     status: Optional[StreamStatus] = None
-    category_id: Optional[int] = None
+    category_id: Optional[UUID] = None
     is_private: Optional[bool] = None
     start_time_from: Optional[datetime] = None
     start_time_to: Optional[datetime] = None
-    page: int = 1
-    page_size: int = 20
\ No newline at end of file
+    cursor: Optional[str] = None  # 上一页返回的 next_cursor，传入后忽略 page
+    count_mode: StreamCountMode = StreamCountMode.EXACT
+    lean: bool = False  # 只返回列表展示需要的列，不加载关联数据
+    page: int = Field(1, ge=1)
+    page_size: int = Field(20, ge=1, le=100)
\ No newline at end of file
@@ -0,0 +1,72 @@
+# app/schemas/upload.py
+from typing import List, Optional
+from pydantic import BaseModel, Field
+
+
+class UploadSessionCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    file_size: int = Field(..., gt=0)
+    chunk_size: Optional[int] = Field(None, gt=0)  # 为空时使用 UPLOAD_CHUNK_SIZE
+
+
+class UploadComplete(BaseModel):
+    sha256: Optional[str] = None  # 客户端计算的组合校验值，传入时校验
+
+
+class UploadSession(BaseModel):
+    upload_id: str
+    stream_id: str
+    filename: str
+    file_size: int
+    chunk_size: int
+    total_chunks: int
+    received_chunks: List[int]
+    received_bytes: int
+    completed: bool
+    file_path: Optional[str] = None
+    sha256: Optional[str] = None
+
+
+class DirectUploadCreate(BaseModel):
+    filename: str = Field(..., min_length=1, max_length=255)
+    file_size: int = Field(..., gt=0)
+    content_type: Optional[str] = None
+    part_size: Optional[int] = Field(None, gt=0)  # 为空时使用 DIRECT_UPLOAD_PART_SIZE
+
+
+class DirectUploadPart(BaseModel):
+    part_number: int
+    url: str
+
+
+class DirectUploadSession(BaseModel):
+    upload_id: str
+    key: str
+    bucket: str
+    part_size: int
+    part_count: int
+    expires_in: int
+    parts: List[DirectUploadPart]  # 首批分片的上传地址，其余通过 parts 接口签发
+
+
+class DirectUploadPartsRequest(BaseModel):
+    key: str
+    part_numbers: List[int] = Field(..., min_length=1)
+
+
+class UploadedPart(BaseModel):
+    part_number: int = Field(..., ge=1)
+    etag: str
+    size: Optional[int] = None
+
+
+class DirectUploadComplete(BaseModel):
+    key: str
+    parts: Optional[List[UploadedPart]] = None  # 为空时以 R2 上已收到的分片为准
+
+
+class DirectUploadResult(BaseModel):
+    bucket: str
+    key: str
+    size: int
+    etag: str
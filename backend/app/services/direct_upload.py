@@ -0,0 +1,160 @@
+# app/services/direct_upload.py
+import logging
+import os
+import uuid
+from typing import Dict, Iterable, List, Optional
+
+from botocore.exceptions import ClientError
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+from app.services.object_storage import AsyncObjectStorage, r2_storage
+
+logger = logging.getLogger(__name__)
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 协议除最后一片外的最小分片
+MAX_PARTS = 10000  # S3 协议单次分片上传的最大分片数
+MAX_KEY_LENGTH = 255  # 对象路径合并后写入 LiveStream.stream_path（String(255)）
+
+
+def object_prefix(stream_id: str) -> str:
+    return f"videos/{stream_id}/"
+
+
+class DirectUploadService:
+    """
+    客户端直传 R2 的分片上传
+
+    API 只负责创建分片上传、签发每个分片的预签名 PUT 地址和合并分片，
+    视频数据由客户端直接上传到 R2，不经过 API 节点的带宽和磁盘。
+    """
+
+    def __init__(self, storage: Optional[AsyncObjectStorage] = None):
+        self.storage = storage or r2_storage
+        self.bucket = self.storage.bucket
+
+    @staticmethod
+    def _part_size(file_size: int, part_size: Optional[int]) -> int:
+        part_size = max(part_size or settings.DIRECT_UPLOAD_PART_SIZE, MIN_PART_SIZE)
+        # 分片数不能超过上限，大文件自动放大分片
+        return max(part_size, -(-file_size // MAX_PARTS))
+
+    @staticmethod
+    def _check_key(stream_id: str, key: str):
+        # key 由客户端回传，只允许操作本直播流前缀下的对象
+        if not key.startswith(object_prefix(stream_id)) or ".." in key:
+            raise ValueError("无效的对象路径")
+
+    async def create(self, stream_id: str, filename: str, file_size: int,
+                     content_type: Optional[str] = None, part_size: Optional[int] = None) -> dict:
+        filename = os.path.basename(filename or "")
+        if not filename:
+            raise ValueError("无效的文件名")
+        part_size = self._part_size(file_size, part_size)
+        part_count = max(1, -(-file_size // part_size))
+        key_prefix = f"{object_prefix(stream_id)}{uuid.uuid4().hex}_"
+        # 文件名过长时保留扩展名截断主文件名，保证合并后能写入直播流
+        max_length = MAX_KEY_LENGTH - len(key_prefix)
+        if len(filename) > max_length:
+            stem, ext = os.path.splitext(filename)
+            if len(ext) >= max_length:
+                raise ValueError("文件名过长")
+            filename = stem[:max_length - len(ext)] + ext
+        key = f"{key_prefix}{filename}"
+
+        params = {"Key": key}
+        if content_type:
+            params["ContentType"] = content_type
+        try:
+            response = await self.storage.call("create_multipart_upload", **params)
+        except ClientError as e:
+            raise ValueError(f"创建分片上传失败: {e.response['Error'].get('Message', e)}") from e
+        upload_id = response["UploadId"]
+
+        first_batch = range(1, min(part_count, settings.DIRECT_UPLOAD_PRESIGN_BATCH) + 1)
+        return {
+            "upload_id": upload_id,
+            "key": key,
+            "bucket": self.bucket,
+            "part_size": part_size,
+            "part_count": part_count,
+            "expires_in": settings.DIRECT_UPLOAD_URL_EXPIRES,
+            "parts": await self.presign_parts(stream_id, key, upload_id, first_batch),
+        }
+
+    async def presign_parts(self, stream_id: str, key: str, upload_id: str,
+                            part_numbers: Iterable[int]) -> List[dict]:
+        """签发分片上传地址，分片数量多或地址过期时客户端按需再次请求"""
+        self._check_key(stream_id, key)
+        part_numbers = sorted(set(part_numbers))
+        if len(part_numbers) > settings.DIRECT_UPLOAD_PRESIGN_BATCH:
+            raise ValueError(f"单次最多签发 {settings.DIRECT_UPLOAD_PRESIGN_BATCH} 个分片地址")
+        if part_numbers and not (1 <= part_numbers[0] and part_numbers[-1] <= MAX_PARTS):
+            raise ValueError(f"分片序号必须在 1 到 {MAX_PARTS} 之间")
+
+        return [
+            {
+                "part_number": number,
+                "url": self.storage.presign("upload_part", settings.DIRECT_UPLOAD_URL_EXPIRES,
+                                            Key=key, UploadId=upload_id, PartNumber=number),
+            }
+            for number in part_numbers
+        ]
+
+    async def list_parts(self, stream_id: str, key: str, upload_id: str) -> List[dict]:
+        """查询 R2 上已经收到的分片，用于断点续传和合并"""
+        self._check_key(stream_id, key)
+
+        def fetch() -> List[dict]:
+            parts = []
+            paginator = self.storage.client.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=self.bucket, Key=key, UploadId=upload_id):
+                parts.extend(
+                    {"part_number": part["PartNumber"], "etag": part["ETag"], "size": part["Size"]}
+                    for part in page.get("Parts", [])
+                )
+            return parts
+
+        try:
+            return await run_in_threadpool(fetch)
+        except ClientError as e:
+            # upload_id 不存在、已合并或已取消
+            raise ValueError(f"查询分片失败: {e.response['Error'].get('Message', e)}") from e
+
+    async def complete(self, stream_id: str, key: str, upload_id: str,
+                       parts: Optional[List[Dict]] = None) -> dict:
+        """
+        合并分片，客户端未提供 ETag 时以 R2 记录的分片为准
+
+        Returns:
+            dict: 对象的 bucket、key、大小和 ETag
+        """
+        self._check_key(stream_id, key)
+        if not parts:
+            parts = await self.list_parts(stream_id, key, upload_id)
+        if not parts:
+            raise ValueError("没有已上传的分片")
+
+        multipart = {"Parts": [
+            {"PartNumber": part["part_number"], "ETag": part["etag"]}
+            for part in sorted(parts, key=lambda p: p["part_number"])
+        ]}
+        try:
+            await self.storage.call("complete_multipart_upload", Key=key, UploadId=upload_id,
+                                    MultipartUpload=multipart)
+        except ClientError as e:
+            # 分片缺失、ETag 不匹配或 upload_id 已失效
+            raise ValueError(f"合并分片失败: {e.response['Error'].get('Message', e)}") from e
+        head = await self.storage.head(key)
+        logger.info(f"直传完成: stream={stream_id}, key={key}, size={head['ContentLength']}")
+        return {"bucket": self.bucket, "key": key, "size": head["ContentLength"], "etag": head["ETag"]}
+
+    async def abort(self, stream_id: str, key: str, upload_id: str):
+        self._check_key(stream_id, key)
+        try:
+            await self.storage.call("abort_multipart_upload", Key=key, UploadId=upload_id)
+        except ClientError as e:
+            raise ValueError(f"取消上传失败: {e.response['Error'].get('Message', e)}") from e
+
+
+direct_upload_service = DirectUploadService()
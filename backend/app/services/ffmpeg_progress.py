@@ -0,0 +1,194 @@
+# app/services/ffmpeg_progress.py
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from sqlalchemy import insert
+
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
+from app.models.monitoring import StreamQualityMetrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProgressSample:
+    """ffmpeg -progress 输出的一个统计块"""
+    bitrate: Optional[int] = None         # 输出码率，bps
+    fps: Optional[float] = None
+    frame: Optional[int] = None
+    dropped_frames: Optional[int] = None  # 累计丢帧数
+    dup_frames: Optional[int] = None      # 累计重复帧数
+    speed: Optional[float] = None         # 相对实时速率，1.0 表示实时
+    total_size: Optional[int] = None      # 已输出字节数
+    out_time_us: Optional[int] = None
+    ended: bool = False                   # progress=end，ffmpeg 即将退出
+
+    def to_dict(self) -> dict:
+        return {
+            "bitrate": self.bitrate,
+            "fps": self.fps,
+            "dropped_frames": self.dropped_frames,
+            "speed": self.speed,
+            "total_size": self.total_size,
+        }
+
+
+def _parse_int(value: str) -> Optional[int]:
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _parse_float(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _parse_bitrate(value: str) -> Optional[int]:
+    # 形如 "1234.5kbits/s"，无数据时为 "N/A"
+    if value.endswith("kbits/s"):
+        kbps = _parse_float(value[:-len("kbits/s")])
+        return round(kbps * 1000) if kbps is not None else None
+    return None
+
+
+def _parse_speed(value: str) -> Optional[float]:
+    # 形如 "1.01x"，无数据时为 "N/A"
+    return _parse_float(value[:-1]) if value.endswith("x") else None
+
+
+class FfmpegProgressParser:
+    """
+    增量解析 ffmpeg -progress 输出
+
+    输出为逐行的 key=value，每个统计块以 progress=continue 或 progress=end 结束。
+    只保存当前未结束的行和统计块，不缓存完整输出。
+    """
+
+    _MAX_PENDING = 64 * 1024  # 单行上限，超出说明不是 progress 输出，直接丢弃
+
+    def __init__(self):
+        self._pending = b""
+        self._block: Dict[str, str] = {}
+
+    def feed(self, data: bytes) -> List[ProgressSample]:
+        """输入一段原始输出，返回其中已经完整的统计块"""
+        samples = []
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        if len(self._pending) > self._MAX_PENDING:
+            self._pending = b""
+
+        for raw in lines:
+            key, sep, value = raw.decode("utf-8", errors="replace").strip().partition("=")
+            if not sep:
+                continue
+            if key == "progress":
+                samples.append(self._build_sample(ended=value == "end"))
+                self._block = {}
+            else:
+                self._block[key] = value.strip()
+        return samples
+
+    def _build_sample(self, ended: bool) -> ProgressSample:
+        block = self._block
+        return ProgressSample(
+            bitrate=_parse_bitrate(block.get("bitrate", "")),
+            fps=_parse_float(block.get("fps", "")),
+            frame=_parse_int(block.get("frame", "")),
+            dropped_frames=_parse_int(block.get("drop_frames", "")),
+            dup_frames=_parse_int(block.get("dup_frames", "")),
+            speed=_parse_speed(block.get("speed", "")),
+            total_size=_parse_int(block.get("total_size", "")),
+            out_time_us=_parse_int(block.get("out_time_us", "")),
+            ended=ended,
+        )
+
+
+class QualityMetricsRecorder:
+    """
+    把推流进程的 progress 采样批量写入 stream_quality_metrics
+
+    每个直播流按 QUALITY_SAMPLE_INTERVAL 抽样，缓冲区满 QUALITY_BATCH_SIZE 条
+    或每隔 QUALITY_FLUSH_INTERVAL 秒批量插入一次。数据库不可用时缓冲区有上限，
+    超出后丢弃最早的采样。
+    """
+
+    def __init__(self):
+        self._buffer: deque = deque(maxlen=settings.QUALITY_BUFFER_MAX)
+        self._last_sampled: Dict[str, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._batch_tasks: set = set()
+        self._flush_lock = asyncio.Lock()
+
+    def record(self, stream_id: str, sample: ProgressSample):
+        now = time.monotonic()
+        last = self._last_sampled.get(stream_id)
+        if not sample.ended and last is not None and now - last < settings.QUALITY_SAMPLE_INTERVAL:
+            return
+        if sample.ended:
+            self._last_sampled.pop(stream_id, None)
+        else:
+            self._last_sampled[stream_id] = now
+
+        self._buffer.append({
+            "stream_id": UUID(stream_id),
+            "bitrate": sample.bitrate,
+            "fps": round(sample.fps) if sample.fps is not None else None,
+            "dropped_frames": sample.dropped_frames,
+            "speed": sample.speed,
+            # 批量写入时才插入，不能依赖数据库默认值，否则同一批的采样时间都是写入时间
+            "timestamp": datetime.now(timezone.utc),
+        })
+        if len(self._buffer) >= settings.QUALITY_BATCH_SIZE and not self._flush_lock.locked():
+            task = asyncio.get_running_loop().create_task(self.flush())
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._buffer:
+                return
+            rows = list(self._buffer)
+            self._buffer.clear()
+            try:
+                await self._insert(rows)
+            except Exception as e:
+                logger.error(f"写入推流质量指标失败: {e}")
+                # 放回缓冲区等待下次写入，超出上限的部分由 deque 丢弃
+                self._buffer = deque(rows + list(self._buffer), maxlen=settings.QUALITY_BUFFER_MAX)
+
+    @staticmethod
+    async def _insert(rows: List[dict]):
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(StreamQualityMetrics), rows)
+            await db.commit()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(settings.QUALITY_FLUSH_INTERVAL)
+            await self.flush()
+
+    def start(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically())
+
+    async def stop(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+
+# 整个进程共享一个指标写入器
+quality_recorder = QualityMetricsRecorder()
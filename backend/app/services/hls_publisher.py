@@ -0,0 +1,296 @@
+# app/services/hls_publisher.py
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from boto3.s3.transfer import TransferConfig
+
+from app.core.config import settings
+from app.services.object_storage import get_r2_client, iter_objects, delete_keys
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_EXTENSIONS = (".m3u8",)
+MANIFEST_NAME = ".hls_manifest.json"
+
+CONTENT_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+    ".m4s": "video/iso.segment",
+    ".mp4": "video/mp4",
+    ".aac": "audio/aac",
+    ".vtt": "text/vtt",
+    ".key": "application/octet-stream",
+}
+
+
+def is_playlist(path: str) -> bool:
+    return path.lower().endswith(PLAYLIST_EXTENSIONS)
+
+
+def object_headers(path: str) -> dict:
+    """按文件类型设置 Content-Type 和 Cache-Control"""
+    ext = os.path.splitext(path)[1].lower()
+    return {
+        "ContentType": CONTENT_TYPES.get(ext, "application/octet-stream"),
+        "CacheControl": settings.HLS_PLAYLIST_CACHE_CONTROL if is_playlist(path)
+        else settings.HLS_SEGMENT_CACHE_CONTROL,
+    }
+
+
+def is_master_playlist(local_path: str) -> bool:
+    with open(local_path, "rb") as f:
+        return b"#EXT-X-STREAM-INF" in f.read()
+
+
+def file_md5(path: str) -> str:
+    digest = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def transfer_config() -> TransferConfig:
+    # 文件级别的并发由线程池负责，单个文件内的分片并发保持较小
+    return TransferConfig(
+        multipart_threshold=settings.HLS_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.HLS_MULTIPART_CHUNKSIZE,
+        max_concurrency=settings.HLS_MULTIPART_CONCURRENCY,
+    )
+
+
+@dataclass
+class PublishStats:
+    """一次 HLS 上传的统计"""
+    objects: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    skipped: int = 0  # 增量同步时内容未变化、没有上传的文件数
+    deleted: int = 0  # 增量同步时删除的远端多余对象数
+    failed: List[str] = field(default_factory=list)
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds else 0.0
+
+    @property
+    def objects_per_second(self) -> float:
+        return self.objects / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "objects": self.objects,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 2),
+            "mb_per_second": round(self.mb_per_second, 2),
+            "objects_per_second": round(self.objects_per_second, 2),
+            "skipped": self.skipped,
+            "deleted": self.deleted,
+            "failed": self.failed,
+        }
+
+
+class SyncManifest:
+    """
+    本地文件清单，记录 相对路径 -> 大小、修改时间、md5 和上次同步时的远端 ETag
+
+    大小和修改时间没变的文件直接使用缓存的 md5，不重新计算。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            with open(path, encoding="utf-8") as f:
+                self.entries: Dict[str, dict] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def md5(self, relative_path: str, local_path: str) -> str:
+        stat = os.stat(local_path)
+        entry = self.entries.setdefault(relative_path, {})
+        if entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, md5=file_md5(local_path))
+        return entry["md5"]
+
+    def synced(self, relative_path: str) -> dict:
+        return self.entries.get(relative_path, {}).get("synced", {})
+
+    def mark_synced(self, relative_path: str, etag: str):
+        entry = self.entries[relative_path]
+        entry["synced"] = {"md5": entry["md5"], "etag": etag}
+
+    def prune(self, relative_paths):
+        self.entries = {path: entry for path, entry in self.entries.items() if path in relative_paths}
+
+    def save(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+
+
+class HlsPublisher:
+    """
+    并发上传 HLS 目录到 R2/S3
+
+    所有工作线程共用一个客户端（boto3 客户端线程安全，连接池大小需不小于线程数）。
+    先并发上传分片等非播放列表文件，全部成功后再上传媒体播放列表，最后上传主播放列表，
+    播放器拿到的播放列表引用的分片一定已经存在。
+    """
+
+    def __init__(self, client, bucket: str, max_workers: Optional[int] = None,
+                 acl: Optional[str] = "public-read"):
+        self.client = client
+        self.bucket = bucket
+        self.max_workers = max_workers or settings.HLS_UPLOAD_WORKERS
+        self.acl = acl
+        self._config = transfer_config()
+
+    def publish(self, local_folder: str, prefix: str = "videos/hls") -> PublishStats:
+        """
+        上传目录下的所有文件，对象路径为 prefix/相对路径
+
+        Raises:
+            RuntimeError: 有文件上传失败，此时不会上传播放列表
+        """
+        files = self.collect(local_folder, prefix)
+        return self.upload_files(files)
+
+    @staticmethod
+    def collect(local_folder: str, prefix: str) -> List[Tuple[str, str]]:
+        prefix = prefix.strip("/")
+        files = []
+        for root, _, names in os.walk(local_folder):
+            for name in names:
+                if name.startswith("."):
+                    # 跳过同步清单等隐藏文件
+                    continue
+                local_path = os.path.join(root, name)
+                relative_path = os.path.relpath(local_path, local_folder).replace(os.sep, "/")
+                files.append((local_path, f"{prefix}/{relative_path}" if prefix else relative_path))
+        return files
+
+    def upload_files(self, files: List[Tuple[str, str]]) -> PublishStats:
+        """按 分片 -> 媒体播放列表 -> 主播放列表 的顺序上传 (本地路径, 对象路径) 列表"""
+        stats = PublishStats()
+        segments = [item for item in files if not is_playlist(item[0])]
+        playlists = [item for item in files if is_playlist(item[0])]
+        masters = [item for item in playlists if is_master_playlist(item[0])]
+        media = [item for item in playlists if item not in masters]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hls-upload") as executor:
+            for batch in (segments, media, masters):
+                futures = {executor.submit(self._upload, local_path, key): key for local_path, key in batch}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    try:
+                        size = future.result()
+                    except Exception as e:
+                        logger.error(f"上传失败: {key}, {e}")
+                        stats.failed.append(key)
+                        continue
+                    stats.objects += 1
+                    stats.bytes += size
+                if stats.failed:
+                    break
+        stats.seconds = time.perf_counter() - start
+
+        logger.info(f"HLS 上传完成: {stats.objects} 个文件, {stats.bytes / 1024 / 1024:.1f}MB, "
+                    f"{stats.seconds:.1f}s, {stats.mb_per_second:.2f}MB/s, "
+                    f"{stats.objects_per_second:.1f} 个/s, 失败 {len(stats.failed)} 个")
+        if stats.failed:
+            raise RuntimeError(f"{len(stats.failed)} 个文件上传失败，未上传播放列表: {stats.failed[:10]}")
+        return stats
+
+    def sync(self, local_folder: str, prefix: str = "videos/hls", delete_orphans: bool = False,
+             manifest_path: Optional[str] = None) -> PublishStats:
+        """
+        增量同步目录到 prefix，只上传远端不存在或内容变化的文件
+
+        单次 PUT 上传的对象 ETag 就是内容的 md5，直接与本地 md5 比较；
+        分片上传的对象 ETag 不是 md5，以清单中上次同步记录的 md5 和 ETag 判断。
+        delete_orphans 为 True 时，在播放列表上传完成后删除远端存在、本地已没有的对象。
+        """
+        prefix = prefix.strip("/")
+        files = self.collect(local_folder, prefix)
+        manifest = SyncManifest(manifest_path or os.path.join(local_folder, MANIFEST_NAME))
+        remote = {obj["Key"]: obj for obj in iter_objects(self.client, self.bucket, f"{prefix}/")}
+
+        def relative(key: str) -> str:
+            return key[len(prefix) + 1:]
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="hls-hash") as executor:
+            hashes = list(executor.map(lambda item: manifest.md5(relative(item[1]), item[0]), files))
+
+        md5s = {key: md5 for (_, key), md5 in zip(files, hashes)}
+        changed = []
+        unchanged = []
+        for local_path, key in files:
+            if self._needs_upload(md5s[key], remote.get(key), manifest.synced(relative(key))):
+                changed.append((local_path, key))
+            else:
+                unchanged.append(key)
+
+        try:
+            stats = self.upload_files(changed)
+        finally:
+            # 上传失败时也保存已计算的 md5，下次同步不用重新计算
+            for key in unchanged:
+                manifest.mark_synced(relative(key), remote[key]["ETag"].strip('"'))
+            manifest.save()
+
+        for local_path, key in changed:
+            manifest.mark_synced(relative(key), self._uploaded_etag(local_path, key, md5s[key]))
+        stats.skipped = len(unchanged)
+
+        if delete_orphans:
+            local_keys = {key for _, key in files}
+            orphans = [key for key in remote if key not in local_keys]
+            errors = delete_keys(self.client, self.bucket, orphans)
+            stats.deleted = len(orphans) - len(errors)
+            if errors:
+                logger.error(f"{len(errors)} 个远端对象删除失败: {errors[:10]}")
+
+        manifest.prune({relative(key) for _, key in files})
+        manifest.save()
+        logger.info(f"HLS 同步完成: 上传 {stats.objects} 个, 跳过 {stats.skipped} 个, 删除 {stats.deleted} 个")
+        return stats
+
+    @staticmethod
+    def _needs_upload(md5: str, remote: Optional[dict], synced: dict) -> bool:
+        if remote is None:
+            return True
+        etag = remote["ETag"].strip('"')
+        if "-" not in etag:
+            return etag != md5
+        return synced.get("etag") != etag or synced.get("md5") != md5
+
+    def _uploaded_etag(self, local_path: str, key: str, md5: str) -> str:
+        # 单次 PUT 上传的 ETag 就是 md5，分片上传的需要向远端查询
+        if os.path.getsize(local_path) < self._config.multipart_threshold:
+            return md5
+        return self.client.head_object(Bucket=self.bucket, Key=key)["ETag"].strip('"')
+
+    def _upload(self, local_path: str, key: str) -> int:
+        extra_args = object_headers(local_path)
+        if self.acl:
+            extra_args["ACL"] = self.acl
+        self.client.upload_file(local_path, self.bucket, key, ExtraArgs=extra_args, Config=self._config)
+        return os.path.getsize(local_path)
+
+
+def publish_hls(local_folder: str, prefix: str = "videos/hls") -> PublishStats:
+    """使用服务配置的 R2 客户端上传 HLS 目录"""
+    return HlsPublisher(get_r2_client(), settings.R2_BUCKET).publish(local_folder, prefix)
+
+
+def sync_hls(local_folder: str, prefix: str = "videos/hls", delete_orphans: bool = False) -> PublishStats:
+    """使用服务配置的 R2 客户端增量同步 HLS 目录"""
+    return HlsPublisher(get_r2_client(), settings.R2_BUCKET).sync(local_folder, prefix, delete_orphans)
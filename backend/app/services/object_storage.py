@@ -0,0 +1,127 @@
+# app/services/object_storage.py
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+
+DELETE_BATCH_SIZE = 1000  # delete_objects 单次最多删除的对象数
+
+_clients: Dict[Tuple[str, str], object] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(endpoint_url: str, bucket: str, access_key: Optional[str] = None,
+               secret_key: Optional[str] = None):
+    """
+    按 (endpoint, bucket) 缓存的 S3 客户端，整个进程共用
+
+    boto3 客户端创建后可以跨线程使用，但创建过程（读取凭证、加载服务模型）不是线程安全的，
+    也比较慢，所以每个 (endpoint, bucket) 只在锁内创建一次，之后复用同一个连接池。
+    """
+    key = (endpoint_url, bucket)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    access_key = access_key or settings.R2_ACCESS_KEY
+    secret_key = secret_key or settings.R2_SECRET_KEY
+    if not all([endpoint_url, bucket, access_key, secret_key]):
+        raise ValueError("对象存储未配置")
+
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            session = boto3.session.Session(aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+            client = session.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name="auto",
+                config=Config(
+                    signature_version="s3v4",
+                    max_pool_connections=settings.r2_max_pool_connections,
+                    connect_timeout=settings.R2_CONNECT_TIMEOUT,
+                    read_timeout=settings.R2_READ_TIMEOUT,
+                    retries={"max_attempts": settings.R2_MAX_ATTEMPTS, "mode": "standard"},
+                ),
+            )
+            _clients[key] = client
+    return client
+
+
+def get_r2_client():
+    """服务层共用的 R2 客户端"""
+    return get_client(settings.R2_ENDPOINT_URL, settings.R2_BUCKET)
+
+
+def iter_objects(client, bucket: str, prefix: str) -> Iterator[Dict]:
+    """分页列出前缀下的所有对象，list_objects_v2 单次最多返回 1000 个"""
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def delete_keys(client, bucket: str, keys: Iterable[str]) -> List[str]:
+    """按每批 1000 个批量删除对象，返回删除失败的 key"""
+    keys = list(keys)
+    errors = []
+    for i in range(0, len(keys), DELETE_BATCH_SIZE):
+        batch = keys[i:i + DELETE_BATCH_SIZE]
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+        )
+        errors.extend(error["Key"] for error in response.get("Errors", []))
+    return errors
+
+
+class AsyncObjectStorage:
+    """
+    供 FastAPI 接口使用的异步封装
+
+    boto3 调用都是阻塞的，统一放到线程池执行，不占用事件循环；
+    所有调用共用 get_client 缓存的客户端和连接池。
+    """
+
+    def __init__(self, endpoint_url: Optional[str] = None, bucket: Optional[str] = None):
+        self.endpoint_url = endpoint_url or settings.R2_ENDPOINT_URL
+        self.bucket = bucket or settings.R2_BUCKET
+
+    @property
+    def client(self):
+        return get_client(self.endpoint_url, self.bucket)
+
+    async def call(self, operation: str, **params) -> dict:
+        """执行一个 S3 API 调用，Bucket 默认为当前存储桶"""
+        params.setdefault("Bucket", self.bucket)
+        return await run_in_threadpool(getattr(self.client, operation), **params)
+
+    async def head(self, key: str) -> dict:
+        return await self.call("head_object", Key=key)
+
+    async def upload_file(self, local_path: str, key: str, extra_args: Optional[dict] = None):
+        await run_in_threadpool(self.client.upload_file, local_path, self.bucket, key, ExtraArgs=extra_args)
+
+    async def list(self, prefix: str) -> List[Dict]:
+        return await run_in_threadpool(lambda: list(iter_objects(self.client, self.bucket, prefix)))
+
+    async def delete_prefix(self, prefix: str) -> Tuple[int, List[str]]:
+        """删除前缀下的所有对象，返回 (删除数, 删除失败的 key)"""
+        def delete() -> Tuple[int, List[str]]:
+            keys = [obj["Key"] for obj in iter_objects(self.client, self.bucket, prefix)]
+            errors = delete_keys(self.client, self.bucket, keys)
+            return len(keys) - len(errors), errors
+
+        return await run_in_threadpool(delete)
+
+    def presign(self, operation: str, expires_in: int, **params) -> str:
+        # 预签名只在本地计算签名，不发起网络请求，不需要放到线程池
+        params.setdefault("Bucket", self.bucket)
+        return self.client.generate_presigned_url(operation, Params=params, ExpiresIn=expires_in)
+
+
+# 服务配置的 R2 存储桶
+r2_storage = AsyncObjectStorage()
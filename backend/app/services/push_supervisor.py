@@ -0,0 +1,254 @@
+# app/services/push_supervisor.py
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from app.core.config import settings
+from app.services.ffmpeg_progress import FfmpegProgressParser, ProgressSample
+
+logger = logging.getLogger(__name__)
+
+
+class PushState(str, Enum):
+    STARTING = "starting"
+    RUNNING = "running"
+    BACKOFF = "backoff"      # 异常退出，等待重启
+    STOPPING = "stopping"
+    STOPPED = "stopped"      # 被主动停止
+    FINISHED = "finished"    # ffmpeg 正常退出（输入文件推完）
+    FAILED = "failed"        # 超过最大重启次数
+
+
+# 推流进程最终退出时的回调: (stream_id, 最终状态, 错误信息)
+ExitCallback = Callable[[str, PushState, Optional[str]], Awaitable[None]]
+# 收到一个 progress 统计块时的回调: (stream_id, 采样)
+ProgressCallback = Callable[[str, ProgressSample], None]
+
+
+@dataclass
+class PushProcess:
+    """单个推流进程的运行信息"""
+    stream_id: str
+    cmd: List[str]
+    rtmp_url: str
+    on_exit: Optional[ExitCallback] = None
+    on_progress: Optional[ProgressCallback] = None
+    process: Optional[asyncio.subprocess.Process] = None
+    state: PushState = PushState.STARTING
+    restarts: int = 0
+    started_at: float = 0.0
+    last_exit_code: Optional[int] = None
+    last_progress: Optional[ProgressSample] = None
+    stderr_tail: deque = field(default_factory=lambda: deque(maxlen=settings.PUSH_STDERR_TAIL_LINES))
+    stop_event: asyncio.Event = field(default_factory=asyncio.Event)
+    task: Optional[asyncio.Task] = None
+
+    @property
+    def last_error(self) -> Optional[str]:
+        return self.stderr_tail[-1] if self.stderr_tail else None
+
+    def snapshot(self) -> dict:
+        return {
+            "stream_id": self.stream_id,
+            "rtmp_url": self.rtmp_url,
+            "pid": self.process.pid if self.process else None,
+            "state": self.state,
+            "restarts": self.restarts,
+            "uptime": round(time.monotonic() - self.started_at, 1) if self.started_at else 0,
+            "last_exit_code": self.last_exit_code,
+            "last_error": self.last_error,
+            "progress": self.last_progress.to_dict() if self.last_progress else None,
+        }
+
+
+class StreamPushSupervisor:
+    """
+    进程级推流管理器
+
+    持有本节点所有 ffmpeg 推流子进程，负责启动/停止/重启，
+    持续读取 stderr 防止管道写满导致推流卡死，
+    并在进程异常退出时按指数退避自动重启。
+    """
+
+    _TERMINAL_STATES = (PushState.STOPPED, PushState.FINISHED, PushState.FAILED)
+
+    def __init__(self):
+        self._pushes: Dict[str, PushProcess] = {}
+        self._lock = asyncio.Lock()
+
+    async def start(self, stream_id: str, cmd: List[str], rtmp_url: str,
+                    on_exit: Optional[ExitCallback] = None,
+                    on_progress: Optional[ProgressCallback] = None) -> dict:
+        """启动推流进程，同一直播流同时只允许一个推流进程"""
+        async with self._lock:
+            existing = self._pushes.get(stream_id)
+            if existing and existing.state not in self._TERMINAL_STATES:
+                raise ValueError("直播流已经在推流中")
+            active = sum(1 for p in self._pushes.values() if p.state not in self._TERMINAL_STATES)
+            if active >= settings.PUSH_MAX_PROCESSES:
+                raise RuntimeError(f"推流进程数已达上限: {settings.PUSH_MAX_PROCESSES}")
+
+            push = PushProcess(stream_id=stream_id, cmd=cmd, rtmp_url=rtmp_url,
+                               on_exit=on_exit, on_progress=on_progress)
+            await self._spawn(push)
+            push.task = asyncio.create_task(self._supervise(push), name=f"push-{stream_id}")
+            self._pushes[stream_id] = push
+        return push.snapshot()
+
+    async def stop(self, stream_id: str) -> bool:
+        """停止推流进程，返回 False 表示本节点没有该推流"""
+        push = self._pushes.get(stream_id)
+        if not push:
+            return False
+
+        push.state = PushState.STOPPING
+        push.stop_event.set()
+        await self._terminate(push)
+        if push.task:
+            await push.task
+        self._pushes.pop(stream_id, None)
+        return True
+
+    async def restart(self, stream_id: str) -> dict:
+        """使用原命令重启推流进程"""
+        push = self._pushes.get(stream_id)
+        if not push:
+            raise KeyError(stream_id)
+        await self.stop(stream_id)
+        return await self.start(stream_id, push.cmd, push.rtmp_url,
+                                on_exit=push.on_exit, on_progress=push.on_progress)
+
+    def get(self, stream_id: str) -> Optional[dict]:
+        push = self._pushes.get(stream_id)
+        return push.snapshot() if push else None
+
+    def list(self) -> List[dict]:
+        return [push.snapshot() for push in self._pushes.values()]
+
+    async def shutdown(self):
+        """应用退出时停止所有推流进程"""
+        await asyncio.gather(*(self.stop(stream_id) for stream_id in list(self._pushes)),
+                             return_exceptions=True)
+
+    async def _spawn(self, push: PushProcess):
+        # 不经过 shell 直接启动 ffmpeg，terminate 才能作用到 ffmpeg 本身；
+        # stdout 是 -progress pipe:1 的统计输出，stderr 保留错误信息，两者都持续读取
+        push.process = await asyncio.create_subprocess_exec(
+            *push.cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE if push.on_progress else asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        push.started_at = time.monotonic()
+        push.state = PushState.RUNNING
+        logger.info(f"推流进程已启动: stream={push.stream_id}, pid={push.process.pid}")
+
+    async def _terminate(self, push: PushProcess):
+        process = push.process
+        if process is None or process.returncode is not None:
+            return
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=settings.PUSH_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"推流进程未在 {settings.PUSH_STOP_TIMEOUT}s 内退出，强制结束: pid={process.pid}")
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+
+    async def _drain_stderr(self, push: PushProcess):
+        """按块读取 stderr，只保留最后若干行用于排查错误"""
+        stream = push.process.stderr
+        pending = b""
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                line = line.strip()
+                if line:
+                    push.stderr_tail.append(line.decode("utf-8", errors="replace"))
+        if pending.strip():
+            push.stderr_tail.append(pending.strip().decode("utf-8", errors="replace"))
+
+    async def _read_progress(self, push: PushProcess):
+        """增量解析 stdout 上的 progress 输出并交给回调"""
+        stream = push.process.stdout
+        parser = FfmpegProgressParser()
+        while True:
+            chunk = await stream.read(4096)
+            if not chunk:
+                break
+            for sample in parser.feed(chunk):
+                push.last_progress = sample
+                try:
+                    push.on_progress(push.stream_id, sample)
+                except Exception as e:
+                    logger.error(f"处理推流进度失败: stream={push.stream_id}, error={e}")
+
+    async def _supervise(self, push: PushProcess):
+        """等待进程退出，异常退出时按退避策略重启"""
+        while True:
+            readers = [asyncio.create_task(self._drain_stderr(push))]
+            if push.on_progress:
+                readers.append(asyncio.create_task(self._read_progress(push)))
+            code = await push.process.wait()
+            await asyncio.gather(*readers)
+            push.last_exit_code = code
+
+            if push.stop_event.is_set():
+                push.state = PushState.STOPPED
+                break
+            if code == 0:
+                push.state = PushState.FINISHED
+                logger.info(f"推流结束: stream={push.stream_id}")
+                break
+
+            # 稳定运行一段时间后再崩溃的，重新计算退避
+            if time.monotonic() - push.started_at >= settings.PUSH_STABLE_AFTER:
+                push.restarts = 0
+            if push.restarts >= settings.PUSH_MAX_RESTARTS:
+                push.state = PushState.FAILED
+                logger.error(f"推流进程多次异常退出，放弃重启: stream={push.stream_id}, "
+                             f"exit={code}, error={push.last_error}")
+                break
+
+            delay = min(settings.PUSH_BACKOFF_MAX, settings.PUSH_BACKOFF_BASE * 2 ** push.restarts)
+            push.restarts += 1
+            push.state = PushState.BACKOFF
+            logger.warning(f"推流进程异常退出: stream={push.stream_id}, exit={code}, "
+                           f"{delay:.1f}s 后第 {push.restarts} 次重启, error={push.last_error}")
+            try:
+                await asyncio.wait_for(push.stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+            if push.stop_event.is_set():
+                push.state = PushState.STOPPED
+                break
+
+            try:
+                await self._spawn(push)
+            except OSError as e:
+                push.stderr_tail.append(f"重启推流进程失败: {e}")
+                push.state = PushState.FAILED
+                break
+
+        if push.state != PushState.STOPPED:
+            # 自然结束或放弃重启的进程由这里清理，主动停止的由 stop() 清理
+            self._pushes.pop(push.stream_id, None)
+            if push.on_exit:
+                try:
+                    await push.on_exit(push.stream_id, push.state, push.last_error)
+                except Exception as e:
+                    logger.error(f"推流退出回调失败: stream={push.stream_id}, error={e}")
+
+
+# 整个进程共享一个推流管理器
+push_supervisor = StreamPushSupervisor()
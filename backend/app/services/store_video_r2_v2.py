@@ -1,8 +1,9 @@
 import os
-import boto3
-from botocore.config import Config
 import logging
 
+from app.services.hls_publisher import HlsPublisher
+from app.services.object_storage import get_client
+
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -13,18 +14,14 @@ SECRET_KEY = '5014e0600f03029c439a7cd19b9ad74b9548197bdeb5559e915c1f74ae19ed95'
 ENDPOINT_URL = 'https://fbc0f7bc8a3bdb7d0a20307c4eaf8cde.r2.cloudflarestorage.com'  # 替换为你的 R2 终端点
 BUCKET_NAME = 'raw-video'  # 替换为你的存储桶名称
 PUB_SUBDOMAIN = 'https://pub-8ea55317b8624238a35e5c73454b9d2d.r2.dev'
+UPLOAD_WORKERS = 16  # HLS 并发上传的文件数
 
 def create_r2_client():
     if not all([ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, BUCKET_NAME, PUB_SUBDOMAIN]):
         raise ValueError("Environment variables are not set correctly.")
 
-    return boto3.client(
-        's3',
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        config=Config(signature_version='s3v4')
-    ), BUCKET_NAME
+    # 同一 endpoint 和存储桶复用进程内缓存的客户端，不再每次调用都重新创建连接
+    return get_client(ENDPOINT_URL, BUCKET_NAME, ACCESS_KEY, SECRET_KEY), BUCKET_NAME
 
 
 # 获取相对路径并规范化为正斜杠
@@ -72,16 +69,11 @@ def upload_hls_to_r2(local_hls_folder):
     r2_client, bucket_name = create_r2_client()
 
     try:
-        # 遍历本地 HLS 文件夹中的所有文件
-        for root, _, files in os.walk(local_hls_folder):
-            for file in files:
-                local_file_path = os.path.join(root, file)
-                relative_path = get_relative_path(local_file_path, local_hls_folder)
-                object_name = f"videos/hls/{relative_path}"  # 在 R2 中存储的路径
-
-                # 上传文件
-                with open(local_file_path, 'rb') as file_data:
-                    r2_client.upload_fileobj(file_data, bucket_name, object_name)
+        # 多线程共用一个客户端并发上传，播放列表在所有分片上传成功后最后上传
+        stats = HlsPublisher(r2_client, bucket_name, acl=None, max_workers=UPLOAD_WORKERS).publish(
+            local_hls_folder, "videos/hls")
+        logging.info(f"Uploaded {stats.objects} files, {stats.mb_per_second:.2f}MB/s, "
+                     f"{stats.objects_per_second:.1f} objects/s")
 
         # 构造播放列表文件的访问地址
         playlist_file = "playlist.m3u8"  # 假设主播放列表文件名为 playlist.m3u8
@@ -105,7 +97,8 @@ def test():
     print(f"Custom Domain URL: {custom_domain_url}")
     print(f"Subdomain URL: {subdomain_url}")
 
-test()
+if __name__ == '__main__':
+    test()
 
 
 
@@ -1,79 +1,232 @@
 # app/services/stream.py
+import base64
+import json
+import logging
 import uuid
-import asyncio
 from datetime import datetime, timezone
 from typing import List, Optional
 from uuid import UUID
-from sqlalchemy.orm import Session
+from sqlalchemy import select, func, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from app.core.config import settings
+from app.db.session import AsyncSessionLocal
 from app.models.stream import LiveStream, StreamStatus, StreamCategory, StreamTag, StreamStatistics, StreamPermission, \
     StreamPermissionRule
 from app.schemas.stream import StreamCreate, StreamUpdate, StreamStatusUpdate, StreamSearch, StreamPermissionCreate, \
-    StreamPermissionUpdate, StreamPermissionRuleCreate, StreamPermissionRuleUpdate
+    StreamPermissionUpdate, StreamPermissionRuleCreate, StreamPermissionRuleUpdate, StreamCountMode
+from app.services.object_storage import AsyncObjectStorage
+from app.services.push_supervisor import push_supervisor, PushState
+from app.services.ffmpeg_progress import quality_recorder
+
+logger = logging.getLogger(__name__)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _redact_command(cmd: List[str], stream_key: Optional[str]) -> str:
+    """推流命令用于日志时隐藏推流密钥和预签名地址的签名参数"""
+    args = []
+    for arg in cmd:
+        if stream_key:
+            arg = arg.replace(stream_key, "***")
+        if arg.startswith(("http://", "https://")) and "?" in arg:
+            arg = arg.split("?", 1)[0] + "?***"
+        args.append(arg)
+    return " ".join(args)
+
+
+def _encode_cursor(created_at: datetime, stream_id: UUID) -> str:
+    payload = json.dumps({"created_at": created_at.isoformat(), "id": str(stream_id)})
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(payload["created_at"]), UUID(payload["id"])
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError("无效的分页游标") from e
+
+
+class _ExplainJson(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) <select>，参数绑定和类型转换由当前连接的方言完成"""
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(_ExplainJson)
+def _compile_explain_json(element, compiler, **kw):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kw)
+
+
+# 各接口显式声明关联的加载方式，序列化 Stream 响应模型时不再逐行懒加载：
+# 多对一的 category 用 JOIN 一并查出，一对多/多对多的关联各用一条 IN 查询批量加载
+STREAM_DETAIL_LOADERS = (
+    joinedload(LiveStream.category),
+    selectinload(LiveStream.statistics),
+    selectinload(LiveStream.tags),
+    selectinload(LiveStream.permissions),
+)
+# 列表页每页最多 100 条，与详情使用相同的批量加载方式
+STREAM_LIST_LOADERS = STREAM_DETAIL_LOADERS
+# 推流、上传等内部流程只需要 live_stream 本身的列
+STREAM_NO_LOADERS = ()
+
+# 精简模式只查询列表页展示需要的列，对应 StreamSummary
+STREAM_SUMMARY_COLUMNS = (
+    LiveStream.id,
+    LiveStream.title,
+    LiveStream.description,
+    LiveStream.cover_url,
+    LiveStream.stream_key,
+    LiveStream.storage_type,
+    LiveStream.status,
+    LiveStream.region,
+    LiveStream.provider,
+    LiveStream.is_private,
+    LiveStream.is_recorded,
+    LiveStream.created_at,
+)
 
 
 class StreamService:
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
-        self.active_streams = {}  # 存储活跃的推流进程
 
+    async def get_stream(self, stream_id: UUID, loaders=STREAM_DETAIL_LOADERS) -> Optional[LiveStream]:
+        result = await self.db.execute(
+            select(LiveStream).options(*loaders).where(LiveStream.id == stream_id)
+        )
+        return result.scalars().first()
 
-    def get_stream(self, stream_id: UUID) -> Optional[LiveStream]:
-        return self.db.query(LiveStream).filter(LiveStream.id == stream_id).first()
+    async def get_user_streams(self, user_id: int, lean: bool = False) -> list:
+        """
+        获取用户的直播流
 
-    def get_user_streams(self, user_id: int) -> List[LiveStream]:
-        return self.db.query(LiveStream).filter(LiveStream.user_id == user_id).all()
+        Args:
+            lean: 为 True 时只查询列表页需要的列，返回行而不是 ORM 对象
+        """
+        if lean:
+            result = await self.db.execute(select(*STREAM_SUMMARY_COLUMNS).where(LiveStream.user_id == user_id))
+            return [dict(row) for row in result.mappings()]
+        result = await self.db.execute(
+            select(LiveStream).options(*STREAM_LIST_LOADERS).where(LiveStream.user_id == user_id)
+        )
+        return list(result.scalars().all())
+
+    async def _refresh_stream(self, db_stream: LiveStream):
+        """提交后重新加载列和响应模型需要的关联"""
+        await self.db.execute(
+            select(LiveStream).options(*STREAM_DETAIL_LOADERS)
+            .where(LiveStream.id == db_stream.id)
+            .execution_options(populate_existing=True)
+        )
 
-    def update_stream(self, stream_id: UUID, stream: StreamUpdate) -> Optional[LiveStream]:
-        db_stream = self.get_stream(stream_id)
+    async def update_stream(self, stream_id: UUID, stream: StreamUpdate) -> Optional[LiveStream]:
+        db_stream = await self.get_stream(stream_id)
         if db_stream:
             for key, value in stream.dict(exclude_unset=True).items():
                 setattr(db_stream, key, value)
-            self.db.commit()
-            self.db.refresh(db_stream)
+            await self.db.commit()
+            await self._refresh_stream(db_stream)
         return db_stream
 
-    def delete_stream(self, stream_id: UUID) -> bool:
-        db_stream = self.get_stream(stream_id)
+    async def delete_stream(self, stream_id: UUID) -> bool:
+        db_stream = await self.get_stream(stream_id)
         if db_stream:
-            self.db.delete(db_stream)
-            self.db.commit()
+            await self.db.delete(db_stream)
+            await self.db.commit()
             return True
         return False
 
-    def update_stream_status(self, stream_id: UUID, status_update: StreamStatusUpdate) -> Optional[LiveStream]:
-        db_stream = self.get_stream(stream_id)
+    async def update_stream_status(self, stream_id: UUID, status_update: StreamStatusUpdate) -> Optional[LiveStream]:
+        db_stream = await self.get_stream(stream_id)
         if db_stream:
             db_stream.status = status_update.status
             if status_update.start_time:
                 db_stream.start_time = status_update.start_time
             if status_update.end_time:
                 db_stream.end_time = status_update.end_time
-            self.db.commit()
-            self.db.refresh(db_stream)
+            await self.db.commit()
+            await self._refresh_stream(db_stream)
         return db_stream
 
-    def search_streams(self, search: StreamSearch) -> tuple[List[LiveStream], int]:
-        query = self.db.query(LiveStream)
+    async def search_streams(self, search: StreamSearch) -> tuple[list, Optional[int], Optional[str]]:
+        """
+        按 (created_at, id) 倒序的游标分页搜索
+
+        Returns:
+            tuple: (当前页直播流, 总数, 下一页游标)，没有下一页时游标为 None；
+                   search.lean 为 True 时当前页是只包含 STREAM_SUMMARY_COLUMNS 的行
+        """
+        query = select(LiveStream)
 
         if search.title:
-            query = query.filter(LiveStream.title.ilike(f"%{search.title}%"))
+            # live_stream.title 上有 pg_trgm GIN 索引，包含匹配由索引完成而不是全表扫描
+            query = query.where(LiveStream.title.ilike(f"%{_escape_like(search.title)}%", escape="\\"))
         if search.status:
-            query = query.filter(LiveStream.status == search.status)
+            query = query.where(LiveStream.status == search.status)
         if search.category_id:
-            query = query.filter(LiveStream.category_id == search.category_id)
+            query = query.where(LiveStream.category_id == search.category_id)
         if search.is_private is not None:
-            query = query.filter(LiveStream.is_private == search.is_private)
+            query = query.where(LiveStream.is_private == search.is_private)
         if search.start_time_from:
-            query = query.filter(LiveStream.start_time >= search.start_time_from)
+            query = query.where(LiveStream.start_time >= search.start_time_from)
         if search.start_time_to:
-            query = query.filter(LiveStream.start_time <= search.start_time_to)
+            query = query.where(LiveStream.start_time <= search.start_time_to)
 
-        total = query.count()
-        streams = query.offset((search.page - 1) * search.page_size).limit(search.page_size).all()
+        if search.count_mode == StreamCountMode.EXACT:
+            total = await self.db.scalar(select(func.count()).select_from(query.subquery()))
+        elif search.count_mode == StreamCountMode.ESTIMATED:
+            total = await self._estimate_count(query)
+        else:
+            total = None
+
+        page_query = query.order_by(LiveStream.created_at.desc(), LiveStream.id.desc())
+        if search.cursor:
+            created_at, stream_id = _decode_cursor(search.cursor)
+            page_query = page_query.where(tuple_(LiveStream.created_at, LiveStream.id) < tuple_(created_at, stream_id))
+        elif search.page > 1:
+            # 兼容旧的页码分页，深分页请使用 cursor
+            page_query = page_query.offset((search.page - 1) * search.page_size)
+
+        # 多取一条判断是否还有下一页
+        page_query = page_query.limit(search.page_size + 1)
+        if search.lean:
+            result = await self.db.execute(page_query.with_only_columns(*STREAM_SUMMARY_COLUMNS))
+            streams = [dict(row) for row in result.mappings()]
+        else:
+            result = await self.db.execute(page_query.options(*STREAM_LIST_LOADERS))
+            streams = list(result.unique().scalars().all())
+        next_cursor = None
+        if len(streams) > search.page_size:
+            streams = streams[:search.page_size]
+            last = streams[-1]
+            next_cursor = _encode_cursor(last["created_at"], last["id"]) if search.lean \
+                else _encode_cursor(last.created_at, last.id)
+
+        return streams, total, next_cursor
+
+    async def _estimate_count(self, query) -> int:
+        """
+        用 EXPLAIN 的估算行数代替 count(*)
 
-        return streams, total
+        不能把编译好的 SQL 字符串再交给 text()：asyncpg 方言会渲染 $1::UUID 这类带类型转换的参数，
+        text() 识别不了，这里让查询和普通语句一样由会话执行。
+        """
+        plan = await self.db.scalar(_ExplainJson(query))
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
 
-    def create_stream_permission(self, permission: StreamPermissionCreate) -> StreamPermission:
+    async def create_stream_permission(self, permission: StreamPermissionCreate) -> StreamPermission:
         db_permission = StreamPermission(
             stream_id=permission.stream_id,
             user_id=permission.user_id,
@@ -81,44 +234,44 @@ class StreamService:
             is_public=permission.is_public
         )
         self.db.add(db_permission)
-        self.db.commit()
-        self.db.refresh(db_permission)
+        await self.db.commit()
+        await self.db.refresh(db_permission)
         return db_permission
 
-    def update_stream_permission(self, permission_id: UUID, permission: StreamPermissionUpdate) -> Optional[
+    async def update_stream_permission(self, permission_id: UUID, permission: StreamPermissionUpdate) -> Optional[
         StreamPermission]:
-        db_permission = self.db.query(StreamPermission).filter(StreamPermission.id == permission_id).first()
+        db_permission = await self.db.get(StreamPermission, permission_id)
         if db_permission:
             for key, value in permission.dict(exclude_unset=True).items():
                 setattr(db_permission, key, value)
-            self.db.commit()
-            self.db.refresh(db_permission)
+            await self.db.commit()
+            await self.db.refresh(db_permission)
         return db_permission
 
-    def create_stream_permission_rule(self, rule: StreamPermissionRuleCreate) -> StreamPermissionRule:
+    async def create_stream_permission_rule(self, rule: StreamPermissionRuleCreate) -> StreamPermissionRule:
         db_rule = StreamPermissionRule(
             rule_type=rule.rule_type,
             rule_value=rule.rule_value.dict(),
             permission_type=rule.permission_type
         )
         self.db.add(db_rule)
-        self.db.commit()
-        self.db.refresh(db_rule)
+        await self.db.commit()
+        await self.db.refresh(db_rule)
         return db_rule
 
-    def update_stream_permission_rule(self, rule_id: UUID, rule: StreamPermissionRuleUpdate) -> Optional[
+    async def update_stream_permission_rule(self, rule_id: UUID, rule: StreamPermissionRuleUpdate) -> Optional[
         StreamPermissionRule]:
-        db_rule = self.db.query(StreamPermissionRule).filter(StreamPermissionRule.id == rule_id).first()
+        db_rule = await self.db.get(StreamPermissionRule, rule_id)
         if db_rule:
             for key, value in rule.dict(exclude_unset=True).items():
                 setattr(db_rule, key, value)
-            self.db.commit()
-            self.db.refresh(db_rule)
+            await self.db.commit()
+            await self.db.refresh(db_rule)
         return db_rule
 
 
 
-    def create_stream(self, stream: StreamCreate, user_id: int) -> LiveStream:
+    async def create_stream(self, stream: StreamCreate, user_id: int) -> LiveStream:
             """创建直播流对象"""
             try:
                 # 生成推流密钥
@@ -142,98 +295,101 @@ class StreamService:
                 )
 
                 self.db.add(db_stream)
-                self.db.commit()
-                self.db.refresh(db_stream)
+                await self.db.commit()
+                await self.db.refresh(db_stream)
 
                 return db_stream
             except Exception as e:
-                self.db.rollback()
+                await self.db.rollback()
                 raise e
 
     async def start_streaming(self, stream_id: UUID) -> bool:
             """开始推流"""
             try:
                 # 获取直播流对象
-                print("1")
-                stream = self.get_stream(stream_id)
+                stream = await self.get_stream(stream_id, loaders=STREAM_NO_LOADERS)
                 if not stream:
                     return False
-                print("2")
                 # 检查直播流状态
                 if stream.is_streaming:
                     raise ValueError("直播流已经在推流中")
-                print("3")
                 # 更新推流开始时间
                 stream.start_time = datetime.now(timezone.utc)
                 stream.status = StreamStatus.STREAMING
                 stream.is_streaming = True
+                stream.stream_error = None
                 #stream.stream_count += 1  # 增加推流次数
-                print("4")
                 # 构建推流命令
                 rtmp_url = self._build_rtmp_url(stream)
-                print(rtmp_url)
                 ffmpeg_cmd = self._build_ffmpeg_command(stream, rtmp_url)
-                print(ffmpeg_cmd)
-                print("5")
-                # 启动推流进程
-                process = await asyncio.create_subprocess_shell(
-                    ffmpeg_cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                print("6")
-                # 存储进程信息
-                self.active_streams[str(stream_id)] = {
-                    'process': process,
-                    'rtmp_url': rtmp_url
-                }
-                print("7")
-                self.db.commit()
-                print("7")
+                logger.debug(f"推流命令: {_redact_command(ffmpeg_cmd, stream.stream_key)}")
+                # 交给进程级推流管理器启动并托管推流进程
+                await push_supervisor.start(str(stream_id), ffmpeg_cmd, rtmp_url,
+                                            on_exit=self._on_push_exit,
+                                            on_progress=quality_recorder.record)
+                try:
+                    await self.db.commit()
+                except Exception:
+                    # 状态没有写入数据库，不保留推流进程
+                    await push_supervisor.stop(str(stream_id))
+                    raise
                 return True
             except Exception as e:
-                self.db.rollback()
+                await self.db.rollback()
                 print(f"启动推流失败: {str(e)}")
                 return False
 
     async def stop_streaming(self, stream_id: UUID) -> bool:
             """停止推流"""
             try:
-                if str(stream_id) not in self.active_streams:
+                # 停止推流进程
+                if not await push_supervisor.stop(str(stream_id)):
                     return False
 
-                # 获取进程信息
-                stream_info = self.active_streams[str(stream_id)]
-                process = stream_info['process']
-
-                # 停止进程
-                process.terminate()
-                await process.wait()
-
                 # 更新直播流状态
-                stream = self.get_stream(stream_id)
+                stream = await self.get_stream(stream_id, loaders=STREAM_NO_LOADERS)
                 if stream:
                     # 更新推流结束时间
                     stream.end_time = datetime.now(timezone.utc)
-                    # 计算本次推流时长
-                    stream.duration = int((stream.end_time - stream.start_time).total_seconds())
-                    # 更新总推流时长
-                    stream.total_stream_time += stream.duration
                     # 更新状态
                     stream.status = StreamStatus.ENDED
                     stream.is_streaming = False
 
-                    self.db.commit()
-
-                # 清理进程信息
-                del self.active_streams[str(stream_id)]
+                    await self.db.commit()
 
                 return True
             except Exception as e:
-                self.db.rollback()
+                await self.db.rollback()
                 print(f"停止推流失败: {str(e)}")
                 return False
 
+    async def restart_streaming(self, stream_id: UUID) -> Optional[dict]:
+        """使用原推流命令重启推流进程"""
+        try:
+            return await push_supervisor.restart(str(stream_id))
+        except KeyError:
+            return None
+
+    def get_push_status(self, stream_id: UUID) -> Optional[dict]:
+        """获取本节点上推流进程的运行状态"""
+        return push_supervisor.get(str(stream_id))
+
+    @staticmethod
+    async def _on_push_exit(stream_id: str, state: PushState, error: Optional[str]):
+        """推流进程自然结束或放弃重启后，回写直播流状态"""
+        async with AsyncSessionLocal() as db:
+            stream = await db.get(LiveStream, UUID(stream_id))
+            if not stream:
+                return
+            stream.end_time = datetime.now(timezone.utc)
+            stream.is_streaming = False
+            if state == PushState.FAILED:
+                stream.status = StreamStatus.ERROR
+                stream.stream_error = (error or "推流进程异常退出")[:255]
+            else:
+                stream.status = StreamStatus.ENDED
+            await db.commit()
+
     def _build_rtmp_url(self, stream: LiveStream) -> str:
         return f"rtmp://124.220.235.226:1935/live/{stream.stream_key}"
         if stream.provider == "aliyun":
@@ -245,44 +401,68 @@ class StreamService:
         else:
             raise ValueError(f"不支持的推流提供商: {stream.provider}")
 
-    def _build_ffmpeg_command(self, stream: LiveStream, rtmp_url: str) -> str:
+    def _build_ffmpeg_command(self, stream: LiveStream, rtmp_url: str) -> List[str]:
         if stream.storage_type == "local":
             input_path = f"file://{stream.stream_path}"
+        elif stream.storage_type == "r2":
+            # 直传到 R2 的视频由 ffmpeg 通过预签名地址直接读取，不经过本机磁盘
+            if not stream.storage_bucket or not stream.stream_path:
+                raise ValueError("直播流没有关联 R2 上的视频")
+            input_path = AsyncObjectStorage(bucket=stream.storage_bucket).presign(
+                "get_object", settings.PUSH_SOURCE_URL_EXPIRES, Key=stream.stream_path)
         else:
-            input_path = "D:\\test.mp4"
-
-        return (
-            f"ffmpeg -re "  # 以实时速率读取输入
-            f"-i {input_path} "
-            f"-c:v libx264 "  # 使用 H.264 编码
-            f"-preset veryfast "  # 编码速度预设
-            f"-b:v 500k "  # 视频比特率
-            f"-maxrate 1000k "  # 最大比特率
-            f"-bufsize 5000k "  # 缓冲区大小
-            f"-g 50 "  # GOP 大小
-            f"-c:a aac "  # 音频编码
-            f"-b:a 128k "  # 音频比特率
-            f"-ar 44100 "  # 音频采样率
-            f"-f flv {rtmp_url}"
-        )
+            raise ValueError(f"不支持的视频存储类型: {stream.storage_type}")
+
+        return [
+            settings.FFMPEG_BINARY,
+            "-hide_banner",
+            "-nostdin",  # 不读取标准输入
+            "-loglevel", "warning",  # 只输出告警和错误
+            "-nostats",  # 关闭 stderr 上的进度行
+            "-progress", "pipe:1",  # 机器可读的进度输出到 stdout
+            "-re",  # 以实时速率读取输入
+            "-i", input_path,
+            "-c:v", "libx264",  # 使用 H.264 编码
+            "-preset", "veryfast",  # 编码速度预设
+            "-b:v", "500k",  # 视频比特率
+            "-maxrate", "1000k",  # 最大比特率
+            "-bufsize", "5000k",  # 缓冲区大小
+            "-g", "50",  # GOP 大小
+            "-c:a", "aac",  # 音频编码
+            "-b:a", "128k",  # 音频比特率
+            "-ar", "44100",  # 音频采样率
+            "-f", "flv", rtmp_url,
+        ]
 
     async def upload_video(self, stream_id: UUID, file_path: str) -> bool:
         """上传视频文件"""
         try:
-            stream = self.get_stream(stream_id)
+            stream = await self.get_stream(stream_id, loaders=STREAM_NO_LOADERS)
             if not stream:
                 return False
 
             # 更新直播流信息
             stream.stream_path = file_path
             stream.status = StreamStatus.CREATED
-            self.db.commit()
+            await self.db.commit()
 
             return True
         except Exception as e:
             print(f"上传视频失败: {str(e)}")
             return False
 
+    async def attach_storage_object(self, stream_id: UUID, bucket: str, key: str) -> bool:
+        """把直传到对象存储的视频设置为直播流的视频源"""
+        stream = await self.get_stream(stream_id, loaders=STREAM_NO_LOADERS)
+        if not stream:
+            return False
+        stream.storage_type = "r2"
+        stream.storage_bucket = bucket
+        stream.stream_path = key
+        stream.status = StreamStatus.CREATED
+        await self.db.commit()
+        return True
+
     def _generate_stream_key(self) -> str:
         """
         生成唯一的流密钥
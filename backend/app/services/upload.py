@@ -0,0 +1,323 @@
+# app/services/upload.py
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass, field, asdict
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UploadConflictError(Exception):
+    """会话已被其他请求完成或取消，客户端需要重新查询会话状态"""
+
+
+@dataclass
+class UploadSession:
+    """
+    一次分片上传的状态
+
+    数据写入 {upload_id}.part，状态保存在同目录的 {upload_id}.json，
+    服务重启后客户端查询会话即可知道哪些分片已经收到，只补传缺失的分片。
+    """
+    upload_id: str
+    stream_id: str
+    filename: str
+    file_size: int
+    chunk_size: int
+    chunks: Dict[int, str] = field(default_factory=dict)  # 分片序号 -> sha256
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    completed: bool = False
+    file_path: Optional[str] = None
+    sha256: Optional[str] = None  # 完成后的组合校验值
+
+    @property
+    def total_chunks(self) -> int:
+        return max(1, -(-self.file_size // self.chunk_size))
+
+    @property
+    def missing_chunks(self) -> List[int]:
+        return [i for i in range(self.total_chunks) if i not in self.chunks]
+
+    @property
+    def received_bytes(self) -> int:
+        return sum(self.chunk_length(i) for i in self.chunks)
+
+    def chunk_length(self, index: int) -> int:
+        if index == self.total_chunks - 1:
+            return self.file_size - index * self.chunk_size
+        return self.chunk_size
+
+    def composite_sha256(self) -> str:
+        """按分片顺序对各分片 sha256 再做一次 sha256，格式为 <hex>-<分片数>"""
+        digest = hashlib.sha256()
+        for i in range(self.total_chunks):
+            digest.update(bytes.fromhex(self.chunks[i]))
+        return f"{digest.hexdigest()}-{self.total_chunks}"
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.update(
+            total_chunks=self.total_chunks,
+            received_chunks=sorted(self.chunks),
+            received_bytes=self.received_bytes,
+        )
+        return data
+
+
+class ChunkedUploadService:
+    """
+    可断点续传的分片上传
+
+    分片按 序号 * chunk_size 的偏移直接写入预分配的 .part 文件，不同分片可以并发上传；
+    文件 I/O 都在线程池中执行，sha256 随写入增量计算，不会阻塞事件循环。
+
+    多个 worker 进程可能处理同一个会话，状态不在内存中缓存，每次都从 .json 读取，
+    并用两把文件锁（flock）协调：
+    - {upload_id}.lock：写分片时持有共享锁，合并和取消时持有排他锁，合并前等待正在写入的分片结束
+    - {upload_id}.json.lock：读取-修改-写回 .json 时持有排他锁，不会互相覆盖已收到的分片
+    """
+
+    def __init__(self, upload_dir: Optional[str] = None):
+        self.upload_dir = upload_dir or settings.UPLOAD_DIR
+
+    def _stream_dir(self, stream_id: str) -> str:
+        return os.path.join(self.upload_dir, stream_id)
+
+    def _part_path(self, session: UploadSession) -> str:
+        return os.path.join(self._stream_dir(session.stream_id), f"{session.upload_id}.part")
+
+    def _state_path(self, stream_id: str, upload_id: str) -> str:
+        return os.path.join(self._stream_dir(stream_id), f"{upload_id}.json")
+
+    def _lock_paths(self, stream_id: str, upload_id: str) -> List[str]:
+        return [os.path.join(self._stream_dir(stream_id), f"{upload_id}.lock"),
+                f"{self._state_path(stream_id, upload_id)}.lock"]
+
+    @contextlib.asynccontextmanager
+    async def _file_lock(self, path: str, shared: bool = False):
+        """flock 文件锁，进程退出时由内核释放；等待锁的阻塞调用放在线程池中"""
+        fd = await run_in_threadpool(os.open, path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            await run_in_threadpool(fcntl.flock, fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _data_lock(self, session: UploadSession, shared: bool = False):
+        return self._file_lock(self._lock_paths(session.stream_id, session.upload_id)[0], shared)
+
+    def _state_lock(self, session: UploadSession):
+        return self._file_lock(self._lock_paths(session.stream_id, session.upload_id)[1])
+
+    async def _reload(self, session: UploadSession) -> UploadSession:
+        """持有状态锁时重新读取 .json，会话已被取消时抛出 UploadConflictError"""
+        current = await run_in_threadpool(self._load, session.stream_id, session.upload_id)
+        if current is None:
+            raise UploadConflictError("上传会话已取消")
+        return current
+
+    async def create_session(self, stream_id: str, filename: str, file_size: int,
+                             chunk_size: Optional[int] = None) -> UploadSession:
+        chunk_size = chunk_size or settings.UPLOAD_CHUNK_SIZE
+        if file_size <= 0 or file_size > settings.UPLOAD_MAX_FILE_SIZE:
+            raise ValueError(f"文件大小必须在 1 到 {settings.UPLOAD_MAX_FILE_SIZE} 字节之间")
+        if chunk_size <= 0 or chunk_size > settings.UPLOAD_MAX_CHUNK_SIZE:
+            raise ValueError(f"分片大小必须在 1 到 {settings.UPLOAD_MAX_CHUNK_SIZE} 字节之间")
+        filename = os.path.basename(filename or "")
+        if not filename or filename.startswith("."):
+            raise ValueError("无效的文件名")
+
+        session = UploadSession(upload_id=uuid.uuid4().hex, stream_id=stream_id,
+                                filename=filename, file_size=file_size, chunk_size=chunk_size)
+        await run_in_threadpool(self._allocate, session)
+        await self._save(session)
+        return session
+
+    def _allocate(self, session: UploadSession):
+        os.makedirs(self._stream_dir(session.stream_id), exist_ok=True)
+        with open(self._part_path(session), "wb") as f:
+            f.truncate(session.file_size)
+
+    async def get_session(self, stream_id: str, upload_id: str) -> Optional[UploadSession]:
+        session = await run_in_threadpool(self._load, stream_id, upload_id)
+        if session is None or session.stream_id != stream_id:
+            return None
+        if not session.completed and time.time() - session.updated_at > settings.UPLOAD_SESSION_TTL:
+            await self.abort(stream_id, upload_id)
+            return None
+        return session
+
+    def _load(self, stream_id: str, upload_id: str) -> Optional[UploadSession]:
+        # upload_id 来自 URL，只接受 create_session 生成的格式，防止路径穿越
+        try:
+            uuid.UUID(hex=upload_id)
+        except ValueError:
+            return None
+        try:
+            with open(self._state_path(stream_id, upload_id), encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        data["chunks"] = {int(k): v for k, v in data["chunks"].items()}
+        return UploadSession(**data)
+
+    async def _save(self, session: UploadSession):
+        session.updated_at = time.time()
+        state = asdict(session)
+        path = self._state_path(session.stream_id, session.upload_id)
+
+        def write():
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+            os.replace(tmp, path)
+
+        await run_in_threadpool(write)
+
+    async def write_chunk(self, session: UploadSession, index: int, body: AsyncIterator[bytes],
+                          expected_sha256: Optional[str] = None) -> UploadSession:
+        """
+        写入一个分片，同一分片重复上传时覆盖之前的数据；写入后失败的分片从已收到的分片中移除
+
+        Raises:
+            ValueError: 分片序号、长度或校验值不正确
+            UploadConflictError: 上传已经完成或被取消
+        """
+        if session.completed:
+            raise UploadConflictError("上传已完成")
+        if index < 0 or index >= session.total_chunks:
+            raise ValueError(f"分片序号必须在 0 到 {session.total_chunks - 1} 之间")
+
+        expected_length = session.chunk_length(index)
+        offset = index * session.chunk_size
+        digest = hashlib.sha256()
+        received = 0
+        pending = bytearray()
+
+        async with self._data_lock(session, shared=True):
+            try:
+                fd = await run_in_threadpool(os.open, self._part_path(session), os.O_WRONLY)
+            except FileNotFoundError:
+                # 另一个请求已经完成合并（.part 已改名）或取消了上传，删除加锁时重新创建的锁文件
+                await run_in_threadpool(self._remove_files, *self._lock_paths(session.stream_id, session.upload_id))
+                raise UploadConflictError("上传已完成或已取消")
+            written = False
+            try:
+                try:
+                    async for data in body:
+                        received += len(data)
+                        if received > expected_length:
+                            raise ValueError(f"分片 {index} 超出预期长度 {expected_length}")
+                        digest.update(data)
+                        pending += data
+                        if len(pending) >= settings.UPLOAD_IO_BLOCK_SIZE:
+                            block, pending = bytes(pending), bytearray()
+                            written = True
+                            await run_in_threadpool(os.pwrite, fd, block, offset)
+                            offset += len(block)
+                    if pending:
+                        written = True
+                        await run_in_threadpool(os.pwrite, fd, bytes(pending), offset)
+                finally:
+                    await run_in_threadpool(os.close, fd)
+
+                if received != expected_length:
+                    raise ValueError(f"分片 {index} 长度为 {received}，预期 {expected_length}")
+                chunk_sha256 = digest.hexdigest()
+                if expected_sha256 and expected_sha256.lower() != chunk_sha256:
+                    raise ValueError(f"分片 {index} 校验失败")
+            except BaseException:
+                # 数据直接写在最终偏移处，重传失败时之前收到的该分片已被覆盖，需要客户端重新上传
+                if written:
+                    await self._discard_chunk(session, index)
+                raise
+
+            # 其他 worker 可能同时写入了别的分片，在锁内基于最新状态合并
+            async with self._state_lock(session):
+                session = await self._reload(session)
+                session.chunks[index] = chunk_sha256
+                await self._save(session)
+        return session
+
+    async def _discard_chunk(self, session: UploadSession, index: int):
+        async with self._state_lock(session):
+            try:
+                current = await self._reload(session)
+            except UploadConflictError:
+                return
+            if current.chunks.pop(index, None) is not None:
+                await self._save(current)
+
+    async def complete(self, session: UploadSession, expected_sha256: Optional[str] = None) -> UploadSession:
+        """
+        所有分片到齐后把 .part 文件移动为正式文件，重复调用返回同一结果
+
+        Raises:
+            ValueError: 仍有分片缺失或组合校验值不一致
+            UploadConflictError: 上传已被取消
+        """
+        async with self._data_lock(session), self._state_lock(session):
+            session = await self._reload(session)
+            if session.completed:
+                return session
+            missing = session.missing_chunks
+            if missing:
+                raise ValueError(f"还有 {len(missing)} 个分片未上传: {missing[:20]}")
+            sha256 = session.composite_sha256()
+            if expected_sha256 and expected_sha256.lower() != sha256:
+                raise ValueError("文件校验失败")
+
+            file_path = os.path.join(self._stream_dir(session.stream_id), session.filename)
+            if os.path.exists(file_path):
+                file_path = os.path.join(self._stream_dir(session.stream_id),
+                                         f"{session.upload_id}_{session.filename}")
+            await run_in_threadpool(self._finalize, self._part_path(session), file_path)
+
+            session.completed = True
+            session.file_path = file_path
+            session.sha256 = sha256
+            await self._save(session)
+            # 之后的写入打开 .part 失败或读到已完成的状态，锁文件不再需要
+            await run_in_threadpool(self._remove_files, *self._lock_paths(session.stream_id, session.upload_id))
+        logger.info(f"分片上传完成: stream={session.stream_id}, file={file_path}, sha256={sha256}")
+        return session
+
+    @staticmethod
+    def _finalize(part_path: str, file_path: str):
+        with open(part_path, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(part_path, file_path)
+
+    async def abort(self, stream_id: str, upload_id: str) -> bool:
+        session = await run_in_threadpool(self._load, stream_id, upload_id)
+        if session is None or session.stream_id != stream_id:
+            return False
+
+        # 等待正在写入的分片结束，之后的写入打开 .part 失败，合并时读取不到 .json
+        async with self._data_lock(session), self._state_lock(session):
+            await run_in_threadpool(self._remove_files, self._part_path(session),
+                                    self._state_path(stream_id, upload_id), *self._lock_paths(stream_id, upload_id))
+        return True
+
+    @staticmethod
+    def _remove_files(*paths: str):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+# 会话状态保存在磁盘上，多个 worker 进程之间通过文件锁协调
+upload_service = ChunkedUploadService()
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+from urllib.parse import urlparse
+
+import httpx
+
+from ts_probe import TsStreamValidator
+
+try:
+    import h2  # noqa: F401  安装了 h2 才能启用 HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+def get_origin(url):
+    """返回 scheme://host[:port]，同一源共用连接池和并发限制"""
+    parsed = urlparse(url)
+    return f"{parsed.scheme}://{parsed.netloc}"
+
+
+class AsyncSegmentEngine:
+    """
+    基于 asyncio + httpx 的 ts 片段下载引擎
+
+    每个源站一个长连接客户端（安装 h2 时使用 HTTP/2 多路复用），
+    每个源站的并发数由信号量限制，响应内容边接收边写入磁盘。
+
+    不支持续传：每次下载都从头请求整个片段，失败时删除临时文件。
+    需要从 .part 文件续传（Range请求、源站Range支持缓存）时使用 M3U8Downloader 的 thread 引擎。
+    """
+
+    def __init__(self, per_host_limit=8, timeout=30, chunk_size=1024 * 1024, max_errors=None,
+                 corrupt_retries=2, cc_error_tolerance=0, logger=None):
+        self.per_host_limit = per_host_limit
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_errors = max_errors  # 失败片段数达到该值时停止下载，None 表示不限制
+        self.corrupt_retries = corrupt_retries  # ts校验失败的片段立即重新下载的次数
+        self.cc_error_tolerance = cc_error_tolerance
+        self.logger = logger or logging.getLogger('AsyncSegmentEngine')
+        self._clients = {}
+        self._semaphores = {}
+
+    def _get_client(self, url):
+        origin = get_origin(url)
+        client = self._clients.get(origin)
+        if client is None:
+            client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                timeout=self.timeout,
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.per_host_limit,
+                                    max_keepalive_connections=self.per_host_limit),
+            )
+            self._clients[origin] = client
+            self._semaphores[origin] = asyncio.Semaphore(self.per_host_limit)
+        return client, self._semaphores[origin]
+
+    async def fetch_segment(self, task, headers):
+        """
+        下载单个片段
+
+        Args:
+            task (dict): {"index": int, "url": str, "filename": str, "validate_ts": bool}
+                validate_ts 为 True 时边接收边校验ts包，损坏的片段立即重新下载
+
+        Returns:
+            dict: {"index", "url", "success", "size", "error", "checksum"}
+
+        下载内容写入 {filename}.part，成功后替换为目标文件，任何失败都删除临时文件。
+        """
+        url, filename = task["url"], task["filename"]
+        temp_file = f"{filename}.part"
+        client, semaphore = self._get_client(url)
+        result = {"index": task["index"], "url": url, "success": False, "size": 0, "error": None, "checksum": None}
+        async with semaphore:
+            for attempt in range(self.corrupt_retries + 1):
+                validator = TsStreamValidator(self.cc_error_tolerance) if task.get("validate_ts") else None
+                try:
+                    async with client.stream('GET', url, headers=headers) as response:
+                        response.raise_for_status()
+                        # Content-Length 是传输的字节数，压缩时与解压后的大小不同，用已接收的原始字节数比较
+                        total_size = int(response.headers.get('content-length', 0))
+                        downloaded_size = 0
+                        # 单次写入的是页缓存，耗时远小于网络等待，直接在事件循环中写
+                        with open(temp_file, 'wb') as f:
+                            # aiter_bytes 按 Content-Encoding 解压，保存和校验的都是原始ts数据
+                            async for chunk in response.aiter_bytes(self.chunk_size):
+                                if validator and not validator.feed(chunk):
+                                    break
+                                f.write(chunk)
+                                downloaded_size += len(chunk)
+                        received_size = response.num_bytes_downloaded
+
+                    if validator and validator.finish():
+                        os.remove(temp_file)
+                        result["error"] = f"ts片段校验失败: {validator.error}"
+                        self.logger.warning(f"TS片段 {task['index']} {result['error']}，"
+                                            f"第 {attempt + 1} 次下载")
+                        continue
+                    if downloaded_size == 0:
+                        raise Exception("下载的文件大小为0")
+                    if total_size and received_size != total_size:
+                        raise Exception(f"文件大小不匹配: 预期 {total_size}, 实际 {received_size}")
+                    os.replace(temp_file, filename)
+                    result["success"] = True
+                    result["size"] = downloaded_size
+                    result["error"] = None
+                    result["checksum"] = validator.checksum if validator else None
+                except Exception as e:
+                    result["error"] = str(e) or e.__class__.__name__
+                finally:
+                    # 失败时删除临时文件，不完整的数据不会被当作已下载的片段
+                    if os.path.exists(temp_file):
+                        try:
+                            os.remove(temp_file)
+                        except OSError:
+                            pass
+                break
+        return result
+
+    async def run_async(self, tasks, headers):
+        """
+        并发下载所有片段
+
+        Returns:
+            tuple: (结果列表, 是否因失败数超限而中止)
+        """
+        pending = [asyncio.create_task(self.fetch_segment(task, headers)) for task in tasks]
+        results = []
+        failed = 0
+        aborted = False
+        try:
+            for next_done in asyncio.as_completed(pending):
+                result = await next_done
+                results.append(result)
+                if not result["success"]:
+                    failed += 1
+                    self.logger.error(f"TS片段 {result['index']} 下载失败: {result['url']}, {result['error']}")
+                    if self.max_errors is not None and failed >= self.max_errors:
+                        aborted = True
+                        break
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await self.close()
+        return results, aborted
+
+    def run(self, tasks, headers):
+        """同步入口，在新的事件循环中执行下载"""
+        return asyncio.run(self.run_async(tasks, headers))
+
+    async def close(self):
+        await asyncio.gather(*(client.aclose() for client in self._clients.values()), return_exceptions=True)
+        self._clients.clear()
+        self._semaphores.clear()
@@ -0,0 +1,101 @@
+"""
+对比 M3U8Downloader 两种 ts 片段下载引擎的吞吐和 CPU 占用
+
+在子进程中启动本地 HTTP 服务模拟 CDN，避免服务端的 CPU 计入下载端；
+片段是连续计数器正确的 ts 包，下载时开启 ts 校验，与实际下载路径一致。
+分别用 thread 和 async 引擎下载同一批片段，输出 片段/秒、MB/秒 和下载进程的 CPU 时间。
+
+用法: python bench_segment_engines.py [片段数] [片段大小KB]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from mediadownloader import M3U8Downloader
+
+SEGMENT_COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+TS_PACKET_SIZE = 188
+# 片段大小取整为 ts 包大小的整数倍
+SEGMENT_SIZE = (int(sys.argv[2]) if len(sys.argv) > 2 else 256) * 1024 // TS_PACKET_SIZE * TS_PACKET_SIZE
+PORT = 18765
+
+
+def make_ts_payload(size):
+    """生成 size 字节的 ts 数据：一个 PID 的连续包，连续计数器递增，负载为随机字节"""
+    packets = []
+    for i in range(size // TS_PACKET_SIZE):
+        # 同步字节 0x47，PID 0x100，只有负载，连续计数器 0-15 循环
+        header = bytes([0x47, 0x41 if i == 0 else 0x01, 0x00, 0x10 | (i % 16)])
+        packets.append(header + os.urandom(TS_PACKET_SIZE - 4))
+    return b"".join(packets)
+
+
+class SegmentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 支持 keep-alive，与真实 CDN 一致
+    payload = make_ts_payload(SEGMENT_SIZE)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp2t")
+        self.send_header("Content-Length", str(len(self.payload)))
+        self.end_headers()
+        self.wfile.write(self.payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve():
+    server = ThreadingHTTPServer(("127.0.0.1", PORT), SegmentHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def run_engine(engine, save_dir):
+    downloader = M3U8Downloader(save_dir, flag='download_for_error_logs', engine=engine)
+    downloader.maximum_error_ts = SEGMENT_COUNT
+    ts_dir = os.path.join(save_dir, engine)
+    os.makedirs(ts_dir, exist_ok=True)
+    tasks = [
+        {"index": i, "url": f"http://127.0.0.1:{PORT}/seg/{i}.ts", "filename": os.path.join(ts_dir, f"{i}.ts"),
+         "validate_ts": True}
+        for i in range(SEGMENT_COUNT)
+    ]
+    m3u8_url = f"http://127.0.0.1:{PORT}/{engine}/index.m3u8"
+    downloader.ledger.add_segments(m3u8_url, engine, tasks)
+    result = {"m3u8_url": m3u8_url, "successful_segments": 0, "failed_segments": 0, "failed_ts_segments": [],
+              "downloaded_bytes": 0, "total_segments": SEGMENT_COUNT}
+
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    downloader.fetch_segments(tasks, {'Accept': '*/*'}, result)
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    mb = result["successful_segments"] * SEGMENT_SIZE / 1024 / 1024
+    print(f"{engine:<7} 成功 {result['successful_segments']:>5}  失败 {result['failed_segments']:>3}  "
+          f"耗时 {wall:6.2f}s  {result['successful_segments'] / wall:8.1f} 片段/s  "
+          f"{mb / wall:7.1f}MB/s  CPU {cpu:6.2f}s ({cpu / wall * 100:5.1f}%)")
+
+
+def main():
+    server = multiprocessing.Process(target=serve, daemon=True)
+    server.start()
+    time.sleep(0.5)
+
+    save_dir = tempfile.mkdtemp(prefix="bench_segments_")
+    try:
+        print(f"{SEGMENT_COUNT} 个片段，每个 {SEGMENT_SIZE // 1024}KB")
+        for engine in ('thread', 'async'):
+            run_engine(engine, save_dir)
+    finally:
+        server.terminate()
+        shutil.rmtree(save_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
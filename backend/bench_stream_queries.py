@@ -0,0 +1,104 @@
+# bench_stream_queries.py
+# 直播流列表接口的 SQL 条数回归检查
+# 在配置的数据库里插入 100 条带关联数据的直播流，统计一页列表实际执行的语句数，
+# 结束后整体回滚，不留下测试数据。用法: python bench_stream_queries.py
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.db.session import async_engine
+from app.models.stream import LiveStream, StreamCategory, StreamTag, StreamStatistics, StreamPermission
+from app.schemas.stream import StreamSearch, StreamCountMode, Stream, StreamSummary
+from app.services.stream import StreamService
+
+PAGE_SIZE = 100
+USER_ID = 987654321  # 只用于本脚本的用户，避免和真实数据混在一起
+
+# 期望的语句条数：分页查询(JOIN category) + statistics/tags/permissions 各一条 IN 查询
+EXPECTED_QUERIES = {
+    "search_full": 4,
+    "search_lean": 1,
+    "list_lean": 1,
+}
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+async def seed(db: AsyncSession) -> str:
+    tag = f"bench-{uuid.uuid4().hex[:8]}"
+    category = StreamCategory(name="bench")
+    tags = [StreamTag(name=f"{tag}-{i}") for i in range(3)]
+    db.add(category)
+    db.add_all(tags)
+    for i in range(PAGE_SIZE):
+        stream = LiveStream(
+            user_id=USER_ID,
+            title=f"{tag} stream {i}",
+            stream_key=uuid.uuid4().hex,
+            storage_type="local",
+            region="bench",
+            provider="bench",
+            category=category,
+            tags=tags,
+        )
+        stream.statistics = [StreamStatistics()]
+        stream.permissions = [StreamPermission(user_id=USER_ID, permission_type="view")]
+        db.add(stream)
+    await db.flush()
+    db.expunge_all()
+    return tag
+
+
+async def measure(name: str, counter: QueryCounter, coro):
+    counter.count = 0
+    start = time.perf_counter()
+    result = await coro
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{name:<12} 查询数: {counter.count:<3} 耗时: {elapsed:.1f}ms")
+    assert counter.count == EXPECTED_QUERIES[name], \
+        f"{name} 期望 {EXPECTED_QUERIES[name]} 条查询，实际 {counter.count} 条"
+    return result
+
+
+async def main():
+    counter = QueryCounter()
+    async with async_engine.connect() as conn:
+        trans = await conn.begin()
+        db = AsyncSession(bind=conn, expire_on_commit=False, join_transaction_mode="create_savepoint")
+        event.listen(async_engine.sync_engine, "before_cursor_execute", counter)
+        try:
+            tag = await seed(db)
+            service = StreamService(db)
+
+            search = StreamSearch(title=tag, page_size=PAGE_SIZE, count_mode=StreamCountMode.NONE)
+            streams, _, _ = await measure("search_full", counter, service.search_streams(search))
+            # 序列化时不应再触发懒加载
+            counter.count = 0
+            items = [Stream.model_validate(stream) for stream in streams]
+            assert counter.count == 0, f"序列化触发了 {counter.count} 条查询"
+            assert len(items) == PAGE_SIZE and all(len(item.tags) == 3 for item in items)
+
+            lean_search = search.model_copy(update={"lean": True})
+            rows, _, _ = await measure("search_lean", counter, service.search_streams(lean_search))
+            [StreamSummary.model_validate(row) for row in rows]
+
+            await measure("list_lean", counter, service.get_user_streams(USER_ID, lean=True))
+        finally:
+            event.remove(async_engine.sync_engine, "before_cursor_execute", counter)
+            await db.close()
+            await trans.rollback()
+    await async_engine.dispose()
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,229 @@
+import contextlib
+import csv
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    content_id TEXT NOT NULL,
+    created_at TEXT,
+    first_seen_at TEXT NOT NULL,
+    PRIMARY KEY (platform, account, content_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS high_water_marks (
+    platform TEXT NOT NULL,
+    account TEXT NOT NULL,
+    content_id TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (platform, account)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS watcher_cursors (
+    platform TEXT NOT NULL,
+    liveroom_id TEXT NOT NULL,
+    page INTEGER NOT NULL DEFAULT 0,
+    max_page INTEGER NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (platform, liveroom_id)
+) WITHOUT ROWID;
+"""
+
+
+def now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def time_key(value):
+    """
+    把接口返回的创建时间转换为可比较的值
+
+    时间戳（数字或数字字符串）按数值比较，"2024-05-01 10:00:00" 这类格式按字符串比较；
+    空值返回 None，表示无法比较。
+    """
+    if value is None or value == '':
+        return None
+    try:
+        return 0, float(value)
+    except (TypeError, ValueError):
+        return 1, str(value)
+
+
+def next_high_water_mark(recorded, blocked=()):
+    """
+    计算本次抓取后可以推进到的高水位
+
+    列表按创建时间从新到旧排列。尚未结束或提取失败的直播间（blocked）下次还要重新抓取，
+    高水位不能越过其中最旧的一个，只取比它们都旧的已记录直播间中最新的一个。
+
+    Args:
+        recorded (list): 本次记录的直播间 [(content_id, created_at)]
+        blocked (list): 本次跳过、下次需要重新抓取的直播间的创建时间
+
+    Returns:
+        tuple: (content_id, created_at)，没有可推进的位置时返回 None
+    """
+    blocked_keys = [key for key in map(time_key, blocked) if key is not None]
+    limit = min(blocked_keys) if blocked_keys else None
+    best = None
+    for content_id, created_at in recorded:
+        key = time_key(created_at)
+        if key is None or (limit is not None and key >= limit):
+            continue
+        if best is None or key > best[0]:
+            best = (key, content_id, created_at)
+    return (best[1], str(best[2])) if best else None
+
+
+class CrawlStateStore:
+    """
+    基于 SQLite（WAL 模式）的增量抓取状态，结构与 DownloadLedger 相同
+
+    - rooms: 每个账号已抓取的直播间，按主键判断是否抓取过，启动时不需要读取整个 CSV
+    - high_water_marks: 每个账号已抓取到的最新直播间及其创建时间，增量抓取只请求比它新的页
+    - watcher_cursors: 每个直播间观看人员已写入文件的最后一页，中断后从下一页继续
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger('CrawlStateStore')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def reset(self, platform):
+        """清除该平台的全部抓取状态，清理旧的抓取结果文件时调用"""
+        with self.transaction() as conn:
+            for table in ('rooms', 'high_water_marks', 'watcher_cursors'):
+                conn.execute(f"DELETE FROM {table} WHERE platform = ?", (platform,))
+
+    # 已抓取的直播间
+
+    def has_rooms(self, platform, account):
+        return bool(self._query(
+            "SELECT 1 FROM rooms WHERE platform = ? AND account = ? LIMIT 1", (platform, account)))
+
+    def is_seen(self, platform, account, content_id):
+        return bool(self._query(
+            "SELECT 1 FROM rooms WHERE platform = ? AND account = ? AND content_id = ?",
+            (platform, account, str(content_id))))
+
+    def add_rooms(self, platform, account, rooms):
+        """记录已抓取的直播间，rooms 为 [(content_id, created_at)]"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO rooms (platform, account, content_id, created_at, first_seen_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(platform, account, str(content_id), str(created_at), now()) for content_id, created_at in rooms],
+            )
+
+    # 高水位
+
+    def high_water_mark(self, platform, account):
+        """返回 {"content_id", "created_at"}，还没有完成过抓取时返回 None"""
+        rows = self._query(
+            "SELECT content_id, created_at FROM high_water_marks WHERE platform = ? AND account = ?",
+            (platform, account))
+        if not rows:
+            return None
+        content_id, created_at = rows[0]
+        return {"content_id": content_id, "created_at": created_at}
+
+    def advance_high_water_mark(self, platform, account, content_id, created_at):
+        """推进高水位，比已记录的高水位旧时不更新"""
+        current = self.high_water_mark(platform, account)
+        if current and time_key(current["created_at"]) >= time_key(created_at):
+            return
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO high_water_marks (platform, account, content_id, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (platform, account, str(content_id), str(created_at), now()),
+            )
+        self.logger.info(f"{platform}/{account} 的高水位推进到 {content_id} ({created_at})")
+
+    # 观看人员抓取进度
+
+    def watcher_cursor(self, platform, liveroom_id):
+        """返回 {"page": 已写入文件的最后一页, "max_page", "done"}，没有记录时返回 None"""
+        rows = self._query(
+            "SELECT page, max_page, done FROM watcher_cursors WHERE platform = ? AND liveroom_id = ?",
+            (platform, str(liveroom_id)))
+        if not rows:
+            return None
+        page, max_page, done = rows[0]
+        return {"page": page, "max_page": max_page, "done": bool(done)}
+
+    def save_watcher_cursor(self, platform, liveroom_id, page, max_page, done=False):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO watcher_cursors (platform, liveroom_id, page, max_page, done, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (platform, str(liveroom_id), page, max_page, int(done), now()),
+            )
+
+    # 旧格式迁移
+
+    def import_legacy_rooms(self, platform, account, csv_file, id_column=1):
+        """
+        该账号还没有记录时，从已有的直播间列表 CSV 导入已抓取的直播间ID，只执行一次
+
+        CSV 仍然是抓取结果的输出文件，导入后不重命名。
+        """
+        if self.has_rooms(platform, account) or not os.path.exists(csv_file):
+            return
+        with open(csv_file, 'r', encoding='utf-8-sig') as f:
+            reader = csv.reader(f)
+            next(reader, None)  # 跳过标题行
+            rooms = [(row[id_column], '') for row in reader if len(row) > id_column and row[id_column]]
+        self.add_rooms(platform, account, rooms)
+        self.logger.info(f"已从 {csv_file} 导入 {len(rooms)} 个已抓取的直播间ID")
+
+    def import_legacy_watcher_checkpoints(self, platform, checkpoint_file):
+        """导入旧版 watchers_checkpoint.json，导入后把旧文件重命名为 .imported"""
+        if not os.path.exists(checkpoint_file):
+            return
+        try:
+            with open(checkpoint_file, 'r', encoding='utf-8') as f:
+                checkpoints = json.load(f)
+        except (OSError, ValueError) as e:
+            self.logger.error(f"解析旧观看人员抓取进度时出错，停止导入: {str(e)}")
+            return
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO watcher_cursors (platform, liveroom_id, page, max_page, done, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(platform, liveroom_id, item["page"], item["max_page"], int(item.get("done", False)), now())
+                 for liveroom_id, item in checkpoints.items()],
+            )
+        os.replace(checkpoint_file, checkpoint_file + '.imported')
+        self.logger.info(f"已从 {checkpoint_file} 导入 {len(checkpoints)} 个直播间的观看人员抓取进度")
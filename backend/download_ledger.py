@@ -0,0 +1,273 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS downloads (
+    url TEXT PRIMARY KEY,
+    content_id TEXT,
+    kind TEXT NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    downloaded_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS segments (
+    m3u8_url TEXT NOT NULL,
+    segment_index INTEGER NOT NULL,
+    content_id TEXT,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    bytes INTEGER NOT NULL DEFAULT 0,
+    checksum TEXT,
+    error TEXT,
+    updated_at TEXT NOT NULL,
+    PRIMARY KEY (m3u8_url, segment_index)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS remuxes (
+    m3u8_url TEXT PRIMARY KEY,
+    content_id TEXT,
+    playlist TEXT NOT NULL,
+    mp4 TEXT NOT NULL,
+    segments INTEGER NOT NULL DEFAULT 0,
+    remuxed_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS images (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    sha256 TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS error_records (
+    content_id TEXT PRIMARY KEY,
+    record TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def now():
+    return time.strftime("%Y-%m-%d %H:%M:%S")
+
+
+class DownloadLedger:
+    """
+    基于 SQLite（WAL 模式）的下载记录
+
+    - downloads: 已成功下载的 m3u8/图片 URL，主键索引查询，启动时不需要加载到内存
+    - segments: 每个 m3u8 的 ts 片段状态，中断后重新下载时跳过已完成的片段
+    - remuxes: 已重新封装为单个 fMP4 的 m3u8，片段已删除，重新下载时整个跳过
+    - images: 图片的 ETag/Last-Modified 和内容哈希，供 ImageFetcher 发条件请求和去重
+    - error_records: 下载失败的直播间记录，供 retry_failed_downloads 重新下载
+
+    所有线程共用一个连接，写操作在锁内以事务提交；WAL 模式下进程崩溃不会损坏已提交的记录。
+    """
+
+    def __init__(self, path, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger('DownloadLedger')
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        """给旧版本创建的表补上新增的列"""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(segments)")}
+        if 'checksum' not in columns:
+            self._conn.execute("ALTER TABLE segments ADD COLUMN checksum TEXT")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    # 成功下载记录
+
+    def is_downloaded(self, url):
+        return bool(self._query("SELECT 1 FROM downloads WHERE url = ?", (url,)))
+
+    def mark_downloaded(self, urls, content_id, kind, size=0):
+        """记录成功下载的 URL，urls 可以是单个 URL 或 URL 列表"""
+        if isinstance(urls, str):
+            urls = [urls]
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO downloads (url, content_id, kind, bytes, downloaded_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(url, content_id, kind, size, now()) for url in urls],
+            )
+
+    def downloaded_count(self):
+        return self._query("SELECT COUNT(*) FROM downloads")[0][0]
+
+    # ts 片段状态
+
+    def add_segments(self, m3u8_url, content_id, tasks):
+        """登记待下载的片段，已登记的片段只更新保存路径，不覆盖已有状态"""
+        with self.transaction() as conn:
+            conn.executemany(
+                "INSERT INTO segments (m3u8_url, segment_index, content_id, url, filename, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (m3u8_url, segment_index) DO UPDATE SET "
+                "url = excluded.url, filename = excluded.filename, updated_at = excluded.updated_at",
+                [(m3u8_url, task["index"], content_id, task["url"], task["filename"], now()) for task in tasks],
+            )
+
+    def mark_segment(self, m3u8_url, index, success, size=0, error=None, checksum=None):
+        """记录片段下载结果，checksum 为下载时边接收边计算的 CRC32"""
+        with self.transaction() as conn:
+            conn.execute(
+                "UPDATE segments SET status = ?, bytes = ?, checksum = ?, error = ?, updated_at = ? "
+                "WHERE m3u8_url = ? AND segment_index = ?",
+                ('success' if success else 'failed', size, checksum, error, now(), m3u8_url, index),
+            )
+
+    def segment_files(self, m3u8_url):
+        """返回已登记的片段 {片段索引: (状态, 保存路径)}，未完成的片段沿用原路径可以从 .part 文件续传"""
+        rows = self._query(
+            "SELECT segment_index, status, filename FROM segments WHERE m3u8_url = ?",
+            (m3u8_url,),
+        )
+        return {index: (status, filename) for index, status, filename in rows}
+
+    def resume_content_id(self, m3u8_url):
+        """
+        m3u8 上次没有下载完时返回当时的内容ID，沿用原目录续传
+
+        同时下载多个码率时片段记录在 {m3u8_url}#{码率目录} 下，也一并查找。
+        """
+        if not m3u8_url or self.is_downloaded(m3u8_url):
+            return None
+        rows = self._query(
+            "SELECT content_id FROM segments WHERE m3u8_url = ? OR (m3u8_url > ? AND m3u8_url < ?) LIMIT 1",
+            (m3u8_url, f"{m3u8_url}#", f"{m3u8_url}$"),
+        )
+        return rows[0][0] if rows else None
+
+    # 重新封装记录
+
+    def mark_remuxed(self, m3u8_url, content_id, playlist, mp4, segments):
+        """记录 m3u8 已重新封装，playlist 为字节范围播放列表，mp4 为封装后的文件"""
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO remuxes (m3u8_url, content_id, playlist, mp4, segments, remuxed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (m3u8_url, content_id, playlist, mp4, segments, now()),
+            )
+
+    def remuxed(self, m3u8_url):
+        """返回 {"playlist", "mp4", "segments"}，没有重新封装过时返回 None"""
+        rows = self._query("SELECT playlist, mp4, segments FROM remuxes WHERE m3u8_url = ?", (m3u8_url,))
+        if not rows:
+            return None
+        playlist, mp4, segments = rows[0]
+        return {"playlist": playlist, "mp4": mp4, "segments": segments}
+
+    # 图片缓存
+
+    def image_cache(self, url):
+        rows = self._query(
+            "SELECT etag, last_modified, sha256, extension FROM images WHERE url = ?", (url,))
+        if not rows:
+            return None
+        etag, last_modified, sha256, extension = rows[0]
+        return {"etag": etag, "last_modified": last_modified, "sha256": sha256, "extension": extension}
+
+    def save_image_cache(self, url, etag, last_modified, sha256, extension, size):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO images (url, etag, last_modified, sha256, extension, bytes, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, sha256, extension, size, now()),
+            )
+
+    # 失败记录
+
+    def save_error_record(self, record):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO error_records (content_id, record, updated_at) VALUES (?, ?, ?)",
+                (record.get("content_id") or f"unknown_{time.time_ns()}",
+                 json.dumps(record, ensure_ascii=False), now()),
+            )
+
+    def delete_error_record(self, content_id):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM error_records WHERE content_id = ?", (content_id,))
+
+    def error_records(self):
+        rows = self._query("SELECT record FROM error_records ORDER BY updated_at")
+        return [json.loads(record) for (record,) in rows]
+
+    # 旧格式迁移
+
+    def import_legacy(self, success_csv, error_log):
+        """
+        导入旧版 successful_downloads.csv 和 download_errors.json，导入后把旧文件重命名为 .imported
+
+        旧错误日志是逐个追加的 JSON 对象，可能跨多行，用 raw_decode 顺序解析。
+        """
+        if os.path.exists(success_csv):
+            rows = []
+            with open(success_csv, 'r', encoding='utf-8') as f:
+                next(f, None)  # 跳过标题行
+                for line in f:
+                    parts = line.strip().split(',')
+                    if len(parts) != 3:
+                        continue
+                    content_id, urls, timestamp = parts
+                    kind = 'm3u8' if '.m3u8' in urls else 'image'
+                    rows.extend((url, content_id, kind, 0, timestamp) for url in urls.split("$$$$$") if url)
+            with self.transaction() as conn:
+                conn.executemany(
+                    "INSERT OR IGNORE INTO downloads (url, content_id, kind, bytes, downloaded_at) "
+                    "VALUES (?, ?, ?, ?, ?)", rows)
+            os.replace(success_csv, success_csv + '.imported')
+            self.logger.info(f"已从 {success_csv} 导入 {len(rows)} 条成功下载记录")
+
+        if os.path.exists(error_log):
+            with open(error_log, 'r', encoding='utf-8') as f:
+                content = f.read()
+            decoder = json.JSONDecoder()
+            position, count = 0, 0
+            while True:
+                while position < len(content) and content[position].isspace():
+                    position += 1
+                if position >= len(content):
+                    break
+                try:
+                    record, position = decoder.raw_decode(content, position)
+                except json.JSONDecodeError as e:
+                    self.logger.error(f"解析旧错误日志时出错，停止导入: {str(e)}")
+                    return
+                self.save_error_record(record)
+                count += 1
+            os.replace(error_log, error_log + '.imported')
+            self.logger.info(f"已从 {error_log} 导入 {count} 条错误记录")
@@ -0,0 +1,130 @@
+import logging
+import threading
+
+import httpx
+
+from page_fetcher import AimdRateLimiter, PageFetcher, ThrottledError, parse_retry_after
+
+try:
+    import h2  # noqa: F401  安装了 h2 才能启用 HTTP/2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# 浏览器中保存登录凭证的 localStorage 键名包含这些关键字
+TOKEN_KEYWORDS = ('token', 'authorization')
+
+
+class DuanShuApiClient:
+    """
+    直接请求短书 JSON 接口，代替用 Playwright 逐个打开接口页面
+
+    登录仍然由浏览器完成，登录后取出浏览器的 Cookie、User-Agent 和 localStorage 中的 token。
+    之后所有请求共用一个同步 httpx.Client 连接池，并共用一个 AimdRateLimiter：
+    单个请求和批量请求都在 429/5xx/超时时降速并按 Retry-After 等待后重试，
+    批量请求由 PageFetcher 在多个线程中调用 get_page。
+    """
+
+    def __init__(self, cookies, headers, concurrency=16, timeout=15, max_retries=3, limiter=None, logger=None):
+        self.cookies = cookies
+        self.headers = headers
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = limiter or AimdRateLimiter()
+        self.logger = logger or logging.getLogger('DuanShuApiClient')
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @classmethod
+    def from_browser(cls, context, page, **kwargs):
+        """从已登录的 Playwright 浏览器上下文中取出 Cookie 和 token"""
+        cookies = httpx.Cookies()
+        for cookie in context.cookies():
+            cookies.set(cookie['name'], cookie['value'], domain=cookie.get('domain', ''), path=cookie.get('path', '/'))
+
+        headers = {
+            'User-Agent': page.evaluate("() => navigator.userAgent"),
+            'Accept': 'application/json, text/plain, */*',
+            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+            'Origin': 'https://my.duanshu.com',
+            'Referer': 'https://my.duanshu.com/',
+        }
+        storage = page.evaluate("() => Object.assign({}, window.localStorage)") or {}
+        for key, value in storage.items():
+            if value and any(keyword in key.lower() for keyword in TOKEN_KEYWORDS):
+                value = value.strip('"')
+                headers['Authorization'] = value if value.lower().startswith('bearer ') else f'Bearer {value}'
+                break
+        return cls(cookies, headers, **kwargs)
+
+    def _sync_client(self):
+        with self._client_lock:
+            if self._client is None:
+                limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+                self._client = httpx.Client(http2=HTTP2_AVAILABLE, cookies=self.cookies, headers=self.headers,
+                                            timeout=self.timeout, limits=limits, follow_redirects=True)
+            return self._client
+
+    def get_page(self, url):
+        """
+        同步请求一页数据，供 PageFetcher 调用，不在内部重试
+
+        Returns:
+            解析后的 JSON，登录失效或请求失败时返回 None
+
+        Raises:
+            ThrottledError: 接口返回 429/5xx、请求超时或连接失败，由调用方降速后重试
+        """
+        try:
+            response = self._sync_client().get(url)
+        except httpx.TransportError as e:
+            # 超时、连接被重置等，视为服务器繁忙
+            raise ThrottledError(f"请求失败: {str(e) or e.__class__.__name__}")
+        except httpx.HTTPError as e:
+            self.logger.error(f"请求接口失败: {url}, {str(e)}")
+            return None
+        if response.status_code == 429 or response.status_code >= 500:
+            raise ThrottledError(f"接口返回 {response.status_code}",
+                                 retry_after=parse_retry_after(response.headers.get('retry-after')))
+        if response.status_code in (401, 403):
+            self.logger.error(f"接口返回 {response.status_code}，登录可能已失效: {url}")
+            return None
+        try:
+            response.raise_for_status()
+            return response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            self.logger.error(f"请求接口失败: {url}, {str(e)}")
+            return None
+
+    def close(self):
+        with self._client_lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def fetch_json(self, url):
+        """请求单个接口，返回解析后的 JSON，失败时返回 None"""
+        for attempt in range(self.max_retries):
+            self.limiter.acquire()
+            try:
+                data = self.get_page(url)
+            except ThrottledError as e:
+                self.limiter.on_throttle(e.retry_after)
+                self.logger.warning(f"请求接口被限流 (尝试 {attempt + 1}/{self.max_retries}): {url}, {str(e)}")
+                continue
+            self.limiter.on_success()
+            return data
+        self.logger.error(f"请求接口失败，已达到最大重试次数: {url}")
+        return None
+
+    def fetch_json_many(self, urls):
+        """
+        并发请求多个接口，并发数为 concurrency，速率由共用的限速器控制
+
+        Returns:
+            dict: {url: 解析后的 JSON，失败时为 None}
+        """
+        fetcher = PageFetcher(self.get_page, max_workers=self.concurrency, limiter=self.limiter,
+                              max_throttle_retries=self.max_retries, logger=self.logger)
+        return dict(fetcher.iter_pages(dict.fromkeys(urls)))
@@ -1,5 +1,7 @@
+import concurrent.futures
 import shutil
 import tempfile
+import threading
 from sys import prefix
 
 from bs4 import BeautifulSoup
@@ -10,6 +12,10 @@ import csv
 import os
 from datetime import datetime
 
+from crawl_state import CrawlStateStore, next_high_water_mark, time_key
+from duanshu_api import DuanShuApiClient
+from page_fetcher import AimdRateLimiter, PageFetcher
+
 
 class DuanShuCrawler:
     def __init__(self):
@@ -22,6 +28,19 @@ class DuanShuCrawler:
         self.liveroomlist_batchsize = 500
         self.liveroom_details_batchsize = 500
 
+        # API模式：浏览器只用于登录，登录后用浏览器的Cookie和token直接并发请求JSON接口，并关闭浏览器
+        self.api_mode = True
+        self.api_concurrency = 16  # 同时请求接口的数量
+        self.api = None
+        # 分页接口的请求速率（每秒请求数），按AIMD在最小值和最大值之间自动调整
+        self.page_rate = 2.0
+        self.page_rate_range = (0.5, 20.0)
+        # 同时抓取观看人员的直播间数量，以及每个直播间内并发请求的页数；所有直播间共用一个限速器
+        self.watcher_workers = 8
+        self.watcher_page_workers = 2
+        # 每次最多抓取观看人员的直播间数量，调试时可以设置，0 表示不限制
+        self.max_watcher_rooms = 0
+
         import tempfile
         import platform
 
@@ -46,6 +65,12 @@ class DuanShuCrawler:
         self.failed_liveroomlist_url = os.path.join(self.temp_dir, 'failed_liveroomlist_urls.txt')
         self.failed_liveroomdetails_url = os.path.join(self.temp_dir, 'failed_liveroomdetails_urls.txt')
         self.failed_liveroom_watchers_url = os.path.join(self.temp_dir, 'failed_watchers_urls.txt')
+        # 旧版的观看人员抓取进度文件，启动时导入 crawl_state.db
+        self.watchers_checkpoint_file = os.path.join(self.temp_dir, 'watchers_checkpoint.json')
+        # 已抓取的直播间、每个账号的高水位和观看人员抓取进度
+        self.crawl_state_file = os.path.join(self.temp_dir, 'crawl_state.db')
+        self.platform = 'duanshu'
+        self._file_lock = threading.Lock()
 
         # 初始化logger为None
         # 设置日志
@@ -54,6 +79,8 @@ class DuanShuCrawler:
 
         self.setup_logging()
         self.create_storage()
+        self.state = CrawlStateStore(self.crawl_state_file, logger=self.logger)
+        self.state.import_legacy_watcher_checkpoints(self.platform, self.watchers_checkpoint_file)
 
     def create_storage(self):
         # 设置临时文件夹
@@ -172,25 +199,95 @@ class DuanShuCrawler:
             #print(self.page.content())
             return self.page
 
+    def ensure_login(self, config):
+        """
+        登录短书
+
+        API模式下只登录一次：登录后取出浏览器的Cookie和token创建接口客户端，然后关闭浏览器释放内存
+        """
+        if not self.api_mode:
+            self.login(config['username'], config['password'])
+            return
+        if self.api is None:
+            self.login(config['username'], config['password'])
+            # 接口客户端的所有请求（单个、批量、分页）共用一个限速器
+            self.api = DuanShuApiClient.from_browser(self.context, self.page, concurrency=self.api_concurrency,
+                                                     limiter=self.new_page_limiter(), logger=self.logger)
+            self.close_browser()
+            self.logger.info("已获取登录凭证，后续直接请求JSON接口")
+
+    def load_json(self, url):
+        """请求一个JSON接口，返回解析后的数据，失败时返回None"""
+        if self.api_mode:
+            return self.api.fetch_json(url)
+        html_content, success = self.wait_for_page_load(url)
+        if not success:
+            return None
+        return self.extract_json_from_html(html_content)
+
+    def load_json_many(self, urls):
+        """
+        请求多个JSON接口，API模式下并发请求，浏览器模式下逐个打开页面
+
+        Returns:
+            dict: {url: 解析后的数据，失败时为None}
+        """
+        if self.api_mode:
+            return self.api.fetch_json_many(urls)
+        return {url: self.load_json(url) for url in urls}
+
+    def iter_json_pages(self, url_for_page, pages, limiter=None, max_workers=None):
+        """
+        按页码顺序生成 (页码, URL, 解析后的数据)，数据为None表示该页获取失败
+
+        API模式下由 PageFetcher 并发请求，请求速率按AIMD自动调整；
+        浏览器模式只有一个页面，逐页打开并在页面之间等待1秒。
+        调用方 break 后不再请求后续页面。默认使用接口客户端的限速器，与其他接口请求共用请求速率。
+        """
+        if not self.api_mode:
+            for i, page in enumerate(pages):
+                if i:
+                    time.sleep(1)  # 添加短暂延迟，避免请求过快
+                url = url_for_page(page)
+                yield page, url, self.load_json(url)
+            return
+
+        fetcher = PageFetcher(
+            lambda page: self.api.get_page(url_for_page(page)),
+            max_workers=max_workers or self.api_concurrency,
+            limiter=limiter or self.api.limiter,
+            logger=self.logger,
+        )
+        for page, json_data in fetcher.iter_pages(pages):
+            yield page, url_for_page(page), json_data
+
+    def new_page_limiter(self):
+        min_rate, max_rate = self.page_rate_range
+        return AimdRateLimiter(initial_rate=self.page_rate, min_rate=min_rate, max_rate=max_rate)
+
+    def extract_json_from_html(self, html_content):
+        """从浏览器打开接口后的页面中取出 <pre> 里的JSON"""
+        try:
+            soup = BeautifulSoup(html_content, 'html.parser')
+            pre_tag = soup.find('pre')
+            if not pre_tag:
+                self.logger.info("未找到JSON数据")
+                return None
+            return json.loads(pre_tag.text)
+        except Exception as e:
+            self.logger.info(f"解析JSON数据时出错: {str(e)}")
+            return None
+
     def extract_liveroomlist_data(self, html_content):
         """从HTML内容中提取直播数据"""
+        return self.parse_liveroomlist_json(self.extract_json_from_html(html_content))
+
+    def parse_liveroomlist_json(self, data):
+        """从直播间列表接口的JSON中提取直播数据"""
         try:
-            # 首先从HTML中提取JSON字符串
-            import json
-            import re
-            import csv
-            from datetime import datetime
-
-            # 使用正则表达式提取JSON部分
-            json_match = re.search(r'<pre>(.*?)</pre>', html_content, re.DOTALL)
-            if not json_match:
-                self.logger.info("未找到JSON数据")
+            if not data:
                 return []
 
-            json_str = json_match.group(1)
-            # 解析JSON数据
-            data = json.loads(json_str)
-
             # 提取直播数据
             live_data = []
             if 'response' in data and 'data' in data['response']:
@@ -291,34 +388,15 @@ class DuanShuCrawler:
                     current_url = f'{url}?page={page}&count=10'
                     self.logger.info(f"正在获取第{page}页数据 (第{retry_count + 1}次尝试)...")
 
-                    # 尝试加载页面
-                    html_content, success = self.wait_for_page_load(current_url)
-                    if not success:
+                    # 请求接口
+                    json_data = self.load_json(current_url)
+                    if not json_data:
                         retry_count += 1
                         self.logger.warning(f"第{page}页第{retry_count}次尝试失败")
                         if retry_count < max_retries:
                             time.sleep(2)  # 等待2秒后重试
                         continue
 
-                    # 解析页面内容
-                    soup = BeautifulSoup(html_content, 'html.parser')
-                    pre_tag = soup.find('pre')
-                    if not pre_tag:
-                        retry_count += 1
-                        self.logger.warning(f"第{page}页未找到pre标签")
-                        if retry_count < max_retries:
-                            time.sleep(2)
-                        continue
-
-                    try:
-                        json_data = json.loads(pre_tag.text)
-                    except json.JSONDecodeError:
-                        retry_count += 1
-                        self.logger.warning(f"第{page}页JSON解析失败")
-                        if retry_count < max_retries:
-                            time.sleep(2)
-                        continue
-
                     # 从响应中获取最大页数
                     if 'response' in json_data and 'page' in json_data['response']:
                         max_page = json_data['response']['page']['last_page']
@@ -396,26 +474,34 @@ class DuanShuCrawler:
 
     def parse_all_liveroomlist_data(self, config):
         """
-        解析直播间列表数据，支持分页
+        解析直播间列表数据，支持分页和增量抓取
+
+        已抓取的直播间和账号的高水位记录在 crawl_state.db 中，启动时不需要读取整个直播间列表CSV；
+        列表按创建时间从新到旧排列，增量抓取到达高水位所在的页后停止。
 
         Args:
             config (dict): 配置信息，包含用户名和密码
         """
-        liveroom_ids = self.extract_liveroom_ids_from_csv(self.liveroom_list_savefile)
-        is_first_crawl = not liveroom_ids
+        account = config['username']
+        self.state.import_legacy_rooms(self.platform, account, self.liveroom_list_savefile)
+        is_first_crawl = not self.state.has_rooms(self.platform, account)
+        high_water_mark = self.state.high_water_mark(self.platform, account)
 
         if is_first_crawl:
-            self.logger.info("未找到直播间ID列表，判定为第一次抓取")
-            liveroom_ids = set()
+            self.logger.info("没有已抓取的直播间记录，判定为第一次抓取")
+        elif high_water_mark:
+            self.logger.info(f"上次抓取到 {high_water_mark['content_id']} ({high_water_mark['created_at']})，判定为增量抓取")
         else:
-            self.logger.info(f"找到 {len(liveroom_ids)} 个已存在的直播间ID，判定为增量抓取")
-            liveroom_ids = set(liveroom_ids)
+            self.logger.info("已有抓取记录但没有高水位，判定为增量抓取，遇到已抓取的页面时停止")
+        mark_key = time_key(high_water_mark['created_at']) if high_water_mark else None
 
-        self.login(config['username'], config['password'])
+        self.ensure_login(config)
 
         all_live_data = []  # 存储所有页的数据
         failed_urls = []  # 存储失败的URL
         total_new_live_data = []  # 用于记录新增的直播间ID
+        recorded_rooms = []  # 本次抓取的页中已结束的直播间，用于推进高水位
+        unfinished_times = []  # 本次跳过的未结束直播间的创建时间，高水位不能越过它们
 
         batch_size = self.liveroomlist_batchsize  # 每500条数据写入一次文件
         url = f'https://api.duanshu.com/admin/content/alive/lists?page=1&count=10'
@@ -437,41 +523,40 @@ class DuanShuCrawler:
             self.logger.warning(f"未找到last_page信息, 爬取失败 ")
             return
 
-        # 记录是否遇到已抓取的直播间
-        found_existing = False
-        page = 1
-        #while page <= max_page:
-        while page <= 3 and not found_existing:
+        # 已知总页数，各页并发请求，按页码顺序处理；到达高水位或遇到已抓取的页面时停止
+        pages = range(1, max_page + 1)
+        for page, url, json_data in self.iter_json_pages(
+                lambda page: f'https://api.duanshu.com/admin/content/alive/lists?page={page}&count=10', pages):
             try:
-                #print(f"正在处理第 {page} 页...")
-                url = f'https://api.duanshu.com/admin/content/alive/lists?page={page}&count=10'
-                # 页面加载策略
-                # 使用新的函数加载页面
-                html_content, success = self.wait_for_page_load(url)
-                if not success:
+                if not json_data:
                     failed_urls.append(url)
-                    page += 1
                     continue
 
                 # 提取当前页的数据
-                live_data = self.extract_liveroomlist_data(html_content)
+                live_data = self.parse_liveroomlist_json(json_data)
                 #分析数据失败，可能抓取的数据有问题，比如json格式不对
                 if len(live_data) == 0:
                     failed_urls.append(url)
-                    page += 1
                     continue
 
                 # 检查当前页的直播间是否都已抓取过
                 new_live_data = []
+                reached_mark = False
                 for item in live_data:
+                    content_id = item['content_id']
+                    created_key = time_key(item['created_at'])
+                    if high_water_mark and (content_id == high_water_mark['content_id'] or
+                                            (created_key is not None and created_key <= mark_key)):
+                        reached_mark = True
                     live_state = item['live_state']
                     #live_state = 0 =1 表示正在直播，表示未开始直播，=2 表示已经直播结束。我们只爬取直播结束的直播间信息
                     if live_state != 2:
+                        unfinished_times.append(item['created_at'])
                         continue
-                    content_id = item['content_id']
-                    if content_id in liveroom_ids:
-                        # 如果遇到已抓取的直播间，标记并退出
-                        self.logger.info(f"在第 {page} 页遇到已抓取的直播间 {content_id}，停止抓取")
+                    recorded_rooms.append((content_id, item['created_at']))
+                    if self.state.is_seen(self.platform, account, content_id):
+                        # 如果遇到已抓取的直播间，跳过
+                        self.logger.info(f"在第 {page} 页遇到已抓取的直播间 {content_id}，跳过")
                         continue
                     else:
                         new_live_data.append(item)
@@ -481,24 +566,18 @@ class DuanShuCrawler:
                 if new_live_data:
                     all_live_data.extend(new_live_data)
                     self.logger.info(f"第 {page} 页成功获取 {len(new_live_data)} 条数据")
-                else:
+                elif not is_first_crawl:
                     self.logger.info(f"在第 {page} 页的所有直播间都被抓取过，推测后续页面也已经被抓取，停止本次抓取任务。")
-                    found_existing = True
                     break
 
                 # 当累积的数据达到batch_size时，写入文件
-                file_exists = os.path.exists(self.liveroom_list_savefile)
                 if len(all_live_data) >= batch_size:
-                    self.save_liveroomlist_to_csv(
-                        all_live_data,
-                        filename=self.liveroom_list_savefile,
-                        mode='a' if file_exists else 'w'  # 根据文件是否存在决定写入模式
-                    )
-
+                    self.save_liveroom_batch(all_live_data, account)
                     all_live_data = []  # 清空缓存
-                # 添加短暂延迟，避免请求过快
-                time.sleep(1)
-                page += 1
+
+                if reached_mark:
+                    self.logger.info(f"第 {page} 页已到达上次抓取的高水位，停止本次抓取任务。")
+                    break
 
             except Exception as e:
                 self.logger.info(f"处理第 {page} 页时出错: {str(e)}")
@@ -514,32 +593,38 @@ class DuanShuCrawler:
         # 保存所有数据
         if all_live_data:
             try:
-                self.save_liveroomlist_to_csv(all_live_data,self.liveroom_list_savefile,mode='a')
+                self.save_liveroom_batch(all_live_data, account)
             except Exception as e:
                 self.logger.info(f"保存数据时出错: {str(e)}")
 
-        if is_first_crawl:
-            # 第一次爬取，复制整个文件
-            try:
-                # 确保目标文件存在,删除它
-                if os.path.exists(self.liveroom_list_savefile_inc):
-                    os.remove(self.liveroom_list_savefile_inc)
-                # 复制文件
-                shutil.copy2(self.liveroom_list_savefile, self.liveroom_list_savefile_inc)
-                self.logger.info("第一次爬取，已复制完整文件到增量文件")
-            except Exception as e:
-                self.logger.error(f"复制文件时出错: {str(e)}")
+        # 增量文件只保存本次新增的数据（第一次抓取时就是全部数据）。total_new_live_data可能为空，这样就创建一个空文件，方便parser_liveroom_elements函数调用
+        try:
+            self.save_liveroomlist_to_csv(
+                total_new_live_data,
+                self.liveroom_list_savefile_inc,
+                mode='w'
+            )
+            self.logger.info(f"已保存 {len(total_new_live_data)} 个新增直播间到增量文件")
+        except Exception as e:
+            self.logger.error(f"保存新增直播间数据时出错: {str(e)}")
+
+        # 有页面失败时不推进高水位，下次增量抓取会重新请求这些页
+        if failed_urls:
+            self.logger.warning("本次有页面获取失败，不推进高水位")
         else:
-            # 增量爬取，只保存新增数据。total_new_live_data可能是null，这样就创建一个空文件，方便parser_liveroom_elements函数调用
-            try:
-                    self.save_liveroomlist_to_csv(
-                        total_new_live_data,
-                        self.liveroom_list_savefile_inc,
-                        mode='w'
-                    )
-                    self.logger.info(f"已保存 {len(total_new_live_data)} 个新增直播间到增量文件")
-            except Exception as e:
-                    self.logger.error(f"保存新增直播间数据时出错: {str(e)}")
+            mark = next_high_water_mark(recorded_rooms, unfinished_times)
+            if mark:
+                self.state.advance_high_water_mark(self.platform, account, *mark)
+
+    def save_liveroom_batch(self, live_data, account):
+        """把一批新增直播间追加到直播间列表文件，写入成功后记录为已抓取"""
+        if not self.save_liveroomlist_to_csv(
+            live_data,
+            filename=self.liveroom_list_savefile,
+            mode='a' if os.path.exists(self.liveroom_list_savefile) else 'w'  # 根据文件是否存在决定写入模式
+        ):
+            return
+        self.state.add_rooms(self.platform, account, [(item['content_id'], item['created_at']) for item in live_data])
 
     def extract_liveroom_ids_from_csv(self,csv_file):
         """
@@ -583,20 +668,14 @@ class DuanShuCrawler:
         Returns:
             dict: 包含提取的信息的字典
         """
-        try:
-            # 使用BeautifulSoup解析HTML
-            soup = BeautifulSoup(html_text, 'html.parser')
+        return self.parse_liveroom_elements_json(self.extract_json_from_html(html_text))
 
-            # 找到包含JSON数据的pre标签
-            pre_tag = soup.find('pre')
-            if not pre_tag:
-                self.logger.info("未找到JSON数据")
+    def parse_liveroom_elements_json(self, json_data):
+        """从直播间详情接口的JSON中解析关键信息，格式同extract_liveroom_elements"""
+        try:
+            if not json_data:
                 return {}
 
-            # 解析JSON数据
-            import json
-            json_data = json.loads(pre_tag.text)
-
             # 时间戳转换函数
             def convert_timestamp(timestamp):
                 if not timestamp:
@@ -723,18 +802,20 @@ class DuanShuCrawler:
             filename (str): 保存的文件名
         """
         try:
-            # 如果文件已存在，先读取现有数据
-            existing_urls = []
-            if os.path.exists(filename):
-                with open(filename, 'r', encoding='utf-8') as f:
-                    existing_urls = json.load(f)
+            # 多个直播间并发抓取时都会写入同一个文件，读取、合并、写入在锁内完成
+            with self._file_lock:
+                # 如果文件已存在，先读取现有数据
+                existing_urls = []
+                if os.path.exists(filename):
+                    with open(filename, 'r', encoding='utf-8') as f:
+                        existing_urls = json.load(f)
 
-            # 合并新的失败URL
-            all_failed_urls = list(set(existing_urls + failed_urls))
+                # 合并新的失败URL
+                all_failed_urls = list(set(existing_urls + failed_urls))
 
-            # 保存到文件
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(all_failed_urls, f, ensure_ascii=False, indent=4)
+                # 保存到文件
+                with open(filename, 'w', encoding='utf-8') as f:
+                    json.dump(all_failed_urls, f, ensure_ascii=False, indent=4)
 
             self.logger.info(f"已保存 {len(failed_urls)} 个失败的URL到 {filename}")
 
@@ -742,7 +823,7 @@ class DuanShuCrawler:
             self.logger.info(f"保存失败URL时出错: {str(e)}")
 
     def parse_liveroom_elements(self,config):
-        self.login(config['username'], config['password'])
+        self.ensure_login(config)
         # 没有新增直播间，新建一个空文件，方便parse_liveroom_watchers函数的执行
         try:
             self.save_liveroom_elements_to_csv(
@@ -765,19 +846,20 @@ class DuanShuCrawler:
         batch_size = self.liveroom_details_batchsize # 每500条数据写入一次文件
 
         file_exists = os.path.exists(self.liveroom_details_savefile)
+        # API模式下一次并发请求所有直播间详情，浏览器模式下逐个打开
+        detail_urls = [self.liveroom_details_url_prefix + liveroom_id for liveroom_id in liveroom_ids]
+        details = self.load_json_many(detail_urls)
         for i, liveroom_id in enumerate(liveroom_ids):
             try:
                 liveroom_detail_url = self.liveroom_details_url_prefix + liveroom_id
                 #print(f"\n正在处理第 {i}/{len(liveroom_ids)} 个直播间: {liveroom_id}")
 
-                # 页面加载策略
-                # 使用新的函数加载页面
-                html_content, success = self.wait_for_page_load(liveroom_detail_url)
-                if not success:
+                json_data = details.get(liveroom_detail_url)
+                if not json_data:
                     failed_urls.append(liveroom_detail_url)
                     continue
 
-                data = self.extract_liveroom_elements(html_content)
+                data = self.parse_liveroom_elements_json(json_data)
                 if data:
                     data['content_id'] = liveroom_id
                     data['liveroom_url'] = liveroom_detail_url
@@ -843,22 +925,13 @@ class DuanShuCrawler:
         Returns:
             list: 包含提取的会员信息的列表
         """
-        # 使用BeautifulSoup解析HTML
-        try:
-            soup = BeautifulSoup(html_text, 'html.parser')
-
-            # 找到包含JSON数据的pre标签
-            pre_tag = soup.find('pre')
-            if not pre_tag:
-                self.logger.info("未找到JSON数据")
-                return {}
-
-            # 解析JSON数据
-            import json
-            json_data = json.loads(pre_tag.text)
+        return self.parse_watchers_json(self.extract_json_from_html(html_text))
 
+    def parse_watchers_json(self, json_data):
+        """从访客列表接口的JSON中提取观看人员信息，格式同extract_watchers_data"""
+        try:
             # 检查是否有数据
-            if 'response' not in json_data or 'data' not in json_data['response']:
+            if not json_data or 'response' not in json_data or 'data' not in json_data['response']:
                 self.logger.info("JSON数据格式不正确")
                 return []
 
@@ -958,95 +1031,137 @@ class DuanShuCrawler:
 
 
 
-    def parse_watchers_data(self, config):
+    def crawl_liveroom_watchers(self, liveroom_id, limiter=None):
         """
-        解析直播间列表数据，支持分页
+        抓取一个直播间的观看人员，每次写入CSV后在 crawl_state.db 中记录进度
 
         Args:
-            config (dict): 配置信息，包含用户名和密码
+            liveroom_id: 直播间ID
+            limiter (AimdRateLimiter, optional): 所有直播间共用的限速器
+
+        某一页失败时停止抓取该直播间，文件中只有按顺序成功的页，进度停在最后写入的一页，
+        下次运行从失败的页重新开始；所有页都成功时才标记为完成。
+
+        Returns:
+            bool: 是否完成该直播间的抓取
         """
+        checkpoint = self.state.watcher_cursor(self.platform, liveroom_id)
+        if checkpoint and checkpoint.get("done"):
+            self.logger.info(f"直播间 {liveroom_id} 的观看人员已抓取完成，跳过")
+            return True
 
-        # 创建watchers文件夹
-        watchers_dir = 'watchers'
-        if not os.path.exists(watchers_dir):
-            os.makedirs(watchers_dir)
-            #print(f"创建文件夹: {watchers_dir}")
+        batch_size = self.liveroom_details_batchsize # 每500条数据写入一次文件
+        failed_urls = []  # 存储失败的URL
+        all_watchers_data = []
+        prefix_url = f'https://api.duanshu.com/fairy/manage/v1/lives/{liveroom_id}/chatgroup_visitors/?'
+
+        if checkpoint:
+            # 从上次写入文件的页之后继续，继续追加到原文件
+            max_page = checkpoint["max_page"]
+            saved_page = checkpoint["page"]
+            mode = 'a'
+            self.logger.info(f"直播间 {liveroom_id} 从第 {saved_page + 1} 页继续抓取")
+        else:
+            # 首先获取最大页数，API模式下该请求同样经过接口客户端的限速器
+            max_page = self.get_max_page(prefix_url.rstrip('?'), max_retries=3, try_pages=3)
+            if max_page is None:
+                self.logger.warning(f"直播间 {liveroom_id} 未找到last_page信息, 爬取失败 ")
+                return False
+            saved_page = 0
+            # 没有进度记录时文件中可能是之前中断时留下的数据，重新写入
+            mode = 'w'
+
+        pages = range(saved_page + 1, max_page + 1)
+        last_page = saved_page  # 按顺序成功获取的最后一页
+        for page, url, json_data in self.iter_json_pages(
+                lambda page: f'{prefix_url}page={page}&count=10', pages,
+                limiter=limiter, max_workers=self.watcher_page_workers):
+            try:
+                if not json_data:
+                    failed_urls.append(url)
+                    break
 
-        self.login(config['username'], config['password'])
-        liveroom_ids = self.extract_liveroom_ids_from_csv(self.liveroom_list_savefile_inc)
-        if not liveroom_ids:
-            self.logger.info("未找到直播间ID列表")
-            return
+                # 提取当前页的数据
+                watchers_data = self.parse_watchers_json(json_data)
+                #分析数据失败，可能原因是json格式不对，等等
+                if len(watchers_data) == 0:
+                    failed_urls.append(url)
+                    break
 
-        #print(liveroom_ids)
+                all_watchers_data.extend(watchers_data)
+                last_page = page
+                self.logger.info(f"直播间 {liveroom_id} 第 {page}/{max_page}页成功获取 {len(watchers_data)} 条数据")
 
-        batch_size = self.liveroom_details_batchsize # 每500条数据写入一次文件
+                # 当累积的数据达到batch_size时，写入文件并记录进度
+                if len(all_watchers_data) >= batch_size:
+                    if self.save_watchers_data_to_csv(all_watchers_data, liveroom_id, mode=mode):
+                        mode = 'a'
+                        all_watchers_data = []  # 清空缓存
+                        self.state.save_watcher_cursor(self.platform, liveroom_id, last_page, max_page)
 
-        for i, liveroom_id in enumerate(liveroom_ids[:211]):
-            failed_urls = []  # 存储失败的URL
-            all_watchers_data = []
+            except Exception as e:
+                self.logger.info(f"直播间 {liveroom_id} 处理第 {page} 页时出错: {str(e)}")
+                failed_urls.append(url)
+                break
 
-            #这并不是一个真实的最大页面数，后面会进行更新
-            # 首先获取第一页数据，并从中获取最大页数
-            url = f'https://api.duanshu.com/fairy/manage/v1/lives/{liveroom_id}/chatgroup_visitors/?page=1&count=10'
-            prefix_url = f'https://api.duanshu.com/fairy/manage/v1/lives/{liveroom_id}/chatgroup_visitors/?'
-            max_page = self.get_max_page(prefix_url, max_retries=3, try_pages=3)
-            if max_page is None:
-                self.logger.warning(f"未找到last_page信息, 爬取失败 ")
-                return
+        # 保存失败URL
+        if failed_urls:
+            self.save_failed_urls(failed_urls, self.failed_liveroom_watchers_url)
+        # 保存所有数据
+        if all_watchers_data:
+            if not self.save_watchers_data_to_csv(all_watchers_data, liveroom_id, mode=mode):
+                return False
+            mode = 'a'
+        elif mode == 'w':
+            self.logger.info(f"直播间 {liveroom_id} 没有获取到任何数据")
+        if failed_urls:
+            if mode == 'a':
+                # 文件中已有按顺序写入的页，下次从失败的页继续
+                self.state.save_watcher_cursor(self.platform, liveroom_id, last_page, max_page)
+            self.logger.warning(f"直播间 {liveroom_id} 第 {last_page + 1} 页获取失败，下次运行从该页继续")
+            return False
+        self.state.save_watcher_cursor(self.platform, liveroom_id, last_page, max_page, done=True)
+        return True
 
-            page = 1
-            #while page <= max_page:
-            while page <=2:
-                try:
-                    #print(f"正在处理第 {page} 页...")
-                    url = f'https://api.duanshu.com/fairy/manage/v1/lives/{liveroom_id}/chatgroup_visitors/?page={page}&count=10'
-                    # 页面加载策略
-                    # 使用新的函数加载页面
-                    html_content, success = self.wait_for_page_load(url)
-                    if not success:
-                        failed_urls.append(url)
-                        page += 1
-                        continue
+    def parse_watchers_data(self, config):
+        """
+        抓取增量文件中各直播间的观看人员
 
-                    # 提取当前页的数据
-                    watchers_data = self.extract_watchers_data(html_content)
-                    #分析数据失败，可能原因是json格式不对，等等
-                    if len(watchers_data) == 0:
-                        failed_urls.append(url)
-                        page += 1
-                        continue
+        API模式下多个直播间并发抓取，所有请求共用一个按AIMD调整速率的限速器；
+        浏览器模式只有一个页面，逐个直播间抓取。每个直播间的进度记录在 crawl_state.db 中，
+        程序中断后重新运行时跳过已完成的直播间，未完成的直播间从上次写入文件的页之后继续。
 
-                    all_watchers_data.extend(watchers_data)
-                    print(f"第 {page}/{max_page}页成功获取 {len(watchers_data)} 条数据")
+        Args:
+            config (dict): 配置信息，包含用户名和密码
+        """
+        self.ensure_login(config)
+        liveroom_ids = self.extract_liveroom_ids_from_csv(self.liveroom_list_savefile_inc)
+        if not liveroom_ids:
+            self.logger.info("未找到直播间ID列表")
+            return
 
-                    # 当累积的数据达到batch_size时，写入文件
-                    if len(all_watchers_data) >= batch_size:
-                        self.save_watchers_data_to_csv(
-                            all_watchers_data,
-                            liveroom_id,
-                            mode='a'
-                        )
-                        all_watchers_data = []  # 清空缓存
-                    # 添加短暂延迟，避免请求过快
-                    time.sleep(1)
-                    page += 1
+        if self.max_watcher_rooms:
+            liveroom_ids = liveroom_ids[:self.max_watcher_rooms]
+        completed = 0
 
-                except Exception as e:
-                    print(f"处理第 {page} 页时出错: {str(e)}")
-                    failed_urls.append(url)
+        if not self.api_mode:
+            for liveroom_id in liveroom_ids:
+                completed += self.crawl_liveroom_watchers(liveroom_id)
+        else:
+            limiter = self.api.limiter
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.watcher_workers,
+                                                       thread_name_prefix='watchers') as executor:
+                futures = {
+                    executor.submit(self.crawl_liveroom_watchers, liveroom_id, limiter): liveroom_id
+                    for liveroom_id in liveroom_ids
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        completed += future.result()
+                    except Exception as e:
+                        self.logger.error(f"抓取直播间 {futures[future]} 的观看人员时出错: {str(e)}")
 
-            # 保存失败URL
-            if failed_urls:
-                self.save_failed_urls(failed_urls, self.failed_liveroom_watchers_url)
-            # 保存所有数据
-            if all_watchers_data:
-                try:
-                    self.save_watchers_data_to_csv(all_watchers_data,liveroom_id,mode='a')
-                except Exception as e:
-                    self.logger.info(f"保存数据时出错: {str(e)}")
-            else:
-                self.logger.info("没有获取到任何数据")
+        self.logger.info(f"观看人员抓取完成: {completed}/{len(liveroom_ids)} 个直播间")
 
     def clean_old_files(self):
         """清理之前运行产生的文件"""
@@ -1077,6 +1192,9 @@ class DuanShuCrawler:
                     except Exception as e:
                         self.logger.info(f"删除文件 {file} 时出错: {str(e)}")
 
+            # 抓取结果文件删除后，已抓取记录和高水位也要清除，下次重新完整抓取
+            self.state.reset(self.platform)
+
             # 清理watchers文件夹
             if os.path.exists(self.liveroom_watchers_savedir):
                 try:
@@ -1093,13 +1211,22 @@ class DuanShuCrawler:
             # 重新设置日志
             self.setup_logging()
 
-    def close(self):
-        """关闭浏览器"""
-        """关闭浏览器并输出日志文件位置"""
-        self.logger.info(f"程序执行完成，日志文件保存在: {self.log_file}")
+    def close_browser(self):
+        """关闭浏览器，API模式下登录完成后即可关闭"""
+        if self.playwright is None:
+            return
         self.context.close()
         self.browser.close()
         self.playwright.stop()
+        self.playwright = self.browser = self.context = self.page = None
+
+    def close(self):
+        """关闭浏览器和接口客户端并输出日志文件位置"""
+        self.logger.info(f"程序执行完成，日志文件保存在: {self.log_file}")
+        if self.api is not None:
+            self.api.close()
+        self.state.close()
+        self.close_browser()
 
 
 def main():
@@ -11,6 +11,9 @@ import csv
 import os
 from datetime import datetime
 
+from crawl_state import CrawlStateStore, next_high_water_mark, time_key
+from page_fetcher import AimdRateLimiter, PageFetcher, ThrottledError, parse_retry_after
+
 
 class DuanShuCrawler_vzan:
     def __init__(self):
@@ -25,6 +28,12 @@ class DuanShuCrawler_vzan:
         self.liveroomlist_batchsize = 100
         self.liveroom_details_batchsize = 500
         self.timeout = 10
+        # 分页接口并发请求的线程数和请求速率（每秒请求数），速率按AIMD在最小值和最大值之间自动调整
+        self.page_workers = 8
+        self.page_rate = 2.0
+        self.page_rate_range = (0.5, 20.0)
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.page_workers))
 
         import tempfile
         import platform
@@ -50,6 +59,9 @@ class DuanShuCrawler_vzan:
         self.failed_liveroomlist_url = os.path.join(self.temp_dir, 'failed_liveroomlist_urls_vzan.txt')
         self.failed_liveroomdetails_url = os.path.join(self.temp_dir, 'failed_liveroomdetails_urls_vzan.txt')
         self.failed_liveroom_watchers_url = os.path.join(self.temp_dir, 'failed_watchers_urls_vzan.txt')
+        # 已抓取的直播间和每个账号的高水位
+        self.crawl_state_file = os.path.join(self.temp_dir, 'crawl_state_vzan.db')
+        self.platform = 'vzan'
 
         # 初始化logger为None
         # 设置日志
@@ -58,6 +70,7 @@ class DuanShuCrawler_vzan:
 
         self.create_storage()
         self.setup_logging()
+        self.state = CrawlStateStore(self.crawl_state_file, logger=self.logger)
 
 
     def create_storage(self):
@@ -98,7 +111,7 @@ class DuanShuCrawler_vzan:
 
     def get_liveroom_list(self, authorization_token, page=1, psize=10, state=-2, keytype=1, keyword="", tag=0,
                               livescene=-1, typeid=-1, types=-1, chanid=0, isOnShelf=-1, isHQOut=0, isGHHQOut=0,
-                              starttime="", endtime=""):
+                              starttime="", endtime="", raise_throttled=False):
         """
         直接调用API获取直播间列表数据
 
@@ -119,6 +132,7 @@ class DuanShuCrawler_vzan:
             isGHHQOut (int): 是否更高清，默认0
             starttime (str): 开始时间，默认空
             endtime (str): 结束时间，默认空
+            raise_throttled (bool): 429/5xx/超时时抛出 ThrottledError，供 PageFetcher 降速重试
 
         Returns:
             dict: API响应数据
@@ -166,16 +180,26 @@ class DuanShuCrawler_vzan:
 
             # 发送请求
             url = self.liveroom_list_url
-            response = requests.post(url, headers=headers, json=data, timeout=self.timeout)
+            try:
+                response = self.session.post(url, headers=headers, json=data, timeout=self.timeout)
+            except requests.exceptions.Timeout as e:
+                if raise_throttled:
+                    raise ThrottledError(f"请求超时: {str(e)}")
+                raise
 
             # 检查响应状态
             if response.status_code == 200:
                 self.logger.info(f"成功获取第{page}页数据")
                 return response.json()
+            elif raise_throttled and (response.status_code == 429 or response.status_code >= 500):
+                raise ThrottledError(f"接口返回 {response.status_code}",
+                                     retry_after=parse_retry_after(response.headers.get('retry-after')))
             else:
                 self.logger.error(f"请求失败，状态码: {response.status_code}")
                 return None
 
+        except ThrottledError:
+            raise
         except Exception as e:
             self.logger.error(f"获取数据时出错: {str(e)}")
             return None
@@ -866,22 +890,32 @@ class DuanShuCrawler_vzan:
         """
         解析直播间列表数据，支持分页和增量爬取
 
+        已抓取的直播间和账号的高水位记录在 crawl_state_vzan.db 中，启动时不需要读取整个直播间列表CSV；
+        列表按创建时间从新到旧排列，增量抓取到达高水位所在的页后停止。
+
         Args:
             config (dict): 配置信息，包含用户名和密码
         """
         try:
             self.logger.info("开始获取直播间列表数据...")
 
-            # 获取已爬取的直播间ID
-            existing_ids = self.extract_liveroom_ids_from_csv(self.liveroom_list_savefile)
-            is_first_crawl = not existing_ids
+            # 获取已爬取的直播间记录和高水位
+            account = config['username']
+            self.state.import_legacy_rooms(self.platform, account, self.liveroom_list_savefile)
+            is_first_crawl = not self.state.has_rooms(self.platform, account)
+            high_water_mark = self.state.high_water_mark(self.platform, account)
 
             if is_first_crawl:
                 self.logger.info("未找到已爬取的直播间ID，将进行首次爬取")
-                existing_ids = set()
+            elif high_water_mark:
+                self.logger.info(
+                    f"上次抓取到 {high_water_mark['content_id']} ({high_water_mark['created_at']})，将进行增量爬取")
             else:
-                self.logger.info(f"找到 {len(existing_ids)} 个已爬取的直播间ID，将进行增量爬取")
-                existing_ids = set(existing_ids)
+                self.logger.info("已有爬取记录但没有高水位，将进行增量爬取")
+            mark_key = time_key(high_water_mark['created_at']) if high_water_mark else None
+            recorded_rooms = []  # 本次抓取的页中提取成功的直播间，用于推进高水位
+            failed_times = []  # 本次提取失败的直播间的创建时间，高水位不能越过它们
+            new_ids = set()  # 本次新增的直播间ID，翻页时列表变化可能导致同一直播间出现在两页
 
             # 获取第一页数据来确定总数
             token = config['token']
@@ -935,18 +969,30 @@ class DuanShuCrawler_vzan:
                 self.logger.error(f"创建增量文件失败: {str(e)}")
                 return
 
-            # 遍历所有页面
-            for page in range(1, 3):
-                try:
-                    self.logger.info(f"正在获取第 {page}/{total_pages} 页数据...")
+            # 已知总页数，各页并发请求，按页码顺序处理；第一页已经获取过，直接使用
+            def fetch_page(page):
+                if page == 1:
+                    return first_page_data
+                self.logger.info(f"正在获取第 {page}/{total_pages} 页数据...")
+                return self.get_liveroom_list(
+                    authorization_token=token,
+                    page=page,
+                    psize=page_size,
+                    raise_throttled=True
+                )
 
-                    # 直接调用API获取当前页数据
-                    page_data = self.get_liveroom_list(
-                        authorization_token=token,
-                        page=page,
-                        psize=page_size
-                    )
+            min_rate, max_rate = self.page_rate_range
+            fetcher = PageFetcher(
+                fetch_page,
+                max_workers=self.page_workers,
+                limiter=AimdRateLimiter(initial_rate=self.page_rate, min_rate=min_rate, max_rate=max_rate),
+                logger=self.logger,
+            )
 
+            # 遍历所有页面
+            pages = range(1, total_pages + 1)
+            for page, page_data in fetcher.iter_pages(pages):
+                try:
                     # 检查API响应
                     if not page_data:
                         self.logger.error(f"获取第 {page} 页数据失败：API返回为空")
@@ -970,6 +1016,17 @@ class DuanShuCrawler_vzan:
                         self.logger.warning(f"第 {page} 页没有提取到任何数据")
                         continue
 
+                    # 本页是否已到达上次抓取的高水位
+                    reached_mark = False
+                    if high_water_mark:
+                        for item in live_data + failed_data:
+                            created_key = time_key(item.get('addtime'))
+                            if (str(item.get('id', '')) == high_water_mark['content_id'] or
+                                    (created_key is not None and created_key <= mark_key)):
+                                reached_mark = True
+                                break
+                    failed_times.extend(item.get('addtime') for item in failed_data)
+
                     # 处理成功的数据
                     if live_data:
                         # 过滤出新增的直播间数据
@@ -979,11 +1036,14 @@ class DuanShuCrawler_vzan:
                                 # 安全地获取ID
                                 item_id = str(item.get('id', '')).strip() if item.get('id') is not None else ''
 
-                                # 检查ID是否有效且不在已存在集合中
-                                if item_id and item_id not in existing_ids:
+                                # 检查ID是否有效且没有抓取过
+                                if not item_id:
+                                    continue
+                                recorded_rooms.append((item_id, item.get('addtime')))
+                                if item_id not in new_ids and not self.state.is_seen(self.platform, account, item_id):
                                     new_data.append(item)
                                     new_live_data.append(item)
-                                    existing_ids.add(item_id)
+                                    new_ids.add(item_id)
 
                             except Exception as e:
                                 self.logger.error(
@@ -1016,6 +1076,7 @@ class DuanShuCrawler_vzan:
                                 filename=self.liveroom_list_savefile_inc,
                                 mode='a'
                             )
+                            self.record_liveroom_batch(all_live_data, account)
                             self.logger.info("batch writing")
                             all_live_data = []  # 清空缓存
                         except Exception as e:
@@ -1023,8 +1084,9 @@ class DuanShuCrawler_vzan:
                             failed_pages.append(page)
                             continue
 
-                    # 添加短暂延迟，避免请求过快
-                    time.sleep(1)
+                    if reached_mark:
+                        self.logger.info(f"第 {page} 页已到达上次抓取的高水位，停止本次抓取任务")
+                        break
 
                 except Exception as e:
                     self.logger.error(f"处理第 {page} 页时出错: {str(e)}")
@@ -1046,6 +1108,7 @@ class DuanShuCrawler_vzan:
                         filename=self.liveroom_list_savefile_inc,
                         mode='a'
                     )
+                    self.record_liveroom_batch(all_live_data, account)
                     self.logger.info(f"成功保存剩余的 {len(all_live_data)} 条数据")
                 except Exception as e:
                     self.logger.error(f"保存剩余数据时出错: {str(e)}")
@@ -1071,6 +1134,14 @@ class DuanShuCrawler_vzan:
                 except Exception as e:
                     self.logger.error(f"保存失败页面时出错: {str(e)}")
 
+            # 有页面失败时不推进高水位，下次增量抓取会重新请求这些页
+            if failed_pages:
+                self.logger.warning("本次有页面获取失败，不推进高水位")
+            else:
+                mark = next_high_water_mark(recorded_rooms, failed_times)
+                if mark:
+                    self.state.advance_high_water_mark(self.platform, account, *mark)
+
             # 输出爬取统计信息
             self.logger.info(
                 f"本次爬取完成，共发现 {len(new_live_data)} 个新增直播间，{len(all_failed_data)} 条数据提取失败")
@@ -1086,6 +1157,11 @@ class DuanShuCrawler_vzan:
             self.logger.error("详细错误信息:")
             self.logger.error(traceback.format_exc())
 
+    def record_liveroom_batch(self, live_data, account):
+        """直播间写入文件后记录为已抓取"""
+        self.state.add_rooms(self.platform, account,
+                             [(str(item.get('id')), item.get('addtime', '')) for item in live_data])
+
     def save_failed_urls(self, failed_urls, filename):
         """
         保存失败的URL到文件
@@ -1142,6 +1218,9 @@ class DuanShuCrawler_vzan:
                     except Exception as e:
                         self.logger.info(f"删除文件 {file} 时出错: {str(e)}")
 
+            # 抓取结果文件删除后，已抓取记录和高水位也要清除，下次重新完整抓取
+            self.state.reset(self.platform)
+
             # 清理watchers文件夹
             if os.path.exists(self.liveroom_watchers_savedir):
                 try:
@@ -1162,6 +1241,8 @@ class DuanShuCrawler_vzan:
         """关闭浏览器"""
         """关闭浏览器并输出日志文件位置"""
         self.logger.info(f"程序执行完成，日志文件保存在: {self.log_file}")
+        self.session.close()
+        self.state.close()
         self.context.close()
         self.browser.close()
         self.playwright.stop()
@@ -0,0 +1,60 @@
+"""
+把下载完成的 HLS 片段重新封装为单个 fMP4 文件，并生成按字节范围引用该文件的播放列表
+
+不重新编码（-c copy），ffmpeg 直接以本地播放列表为输入，加密片段在输入时解密；
+输出使用 hls 封装的 single_file 模式，每个片段是 mp4 文件中的一个 fragment，
+播放列表用 EXT-X-BYTERANGE 指向各 fragment，仍然可以按片段拖动播放。
+几千个 ts 文件变成一个 mp4 和一个播放列表，对象存储的文件数和 PUT 请求数大幅减少。
+"""
+import os
+import shutil
+import subprocess
+
+
+class RemuxError(Exception):
+    pass
+
+
+def ffmpeg_available(ffmpeg='ffmpeg'):
+    return shutil.which(ffmpeg) is not None
+
+
+def remux_to_single_fmp4(playlist_path, output_mp4, output_playlist, hls_time, ffmpeg='ffmpeg', timeout=None):
+    """
+    把本地播放列表引用的片段封装为一个 fMP4 文件
+
+    Args:
+        playlist_path (str): 输入的本地播放列表
+        output_mp4 (str): 输出的 mp4 文件，与 output_playlist 在同一目录
+        output_playlist (str): 输出的字节范围播放列表
+        hls_time (float): 目标片段时长，使用原播放列表的 TARGETDURATION，按关键帧切分
+        timeout (float, optional): ffmpeg 超时时间（秒）
+
+    Raises:
+        RemuxError: ffmpeg 执行失败或没有生成输出文件
+    """
+    cmd = [
+        ffmpeg, '-hide_banner', '-loglevel', 'error', '-y',
+        '-allowed_extensions', 'ALL',
+        '-protocol_whitelist', 'file,crypto,data',
+        '-i', playlist_path,
+        '-map', '0', '-c', 'copy',
+        '-f', 'hls',
+        '-hls_time', str(hls_time),
+        '-hls_playlist_type', 'vod',
+        '-hls_segment_type', 'fmp4',
+        '-hls_flags', 'single_file',
+        '-hls_segment_filename', output_mp4,
+        output_playlist,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        raise RemuxError(f"ffmpeg 重新封装超时: {playlist_path}")
+    if result.returncode != 0:
+        raise RemuxError(f"ffmpeg 重新封装失败: {result.stderr.strip()[-500:]}")
+    if not os.path.exists(output_playlist) or not os.path.exists(output_mp4) or not os.path.getsize(output_mp4):
+        raise RemuxError(f"ffmpeg 没有生成输出文件: {output_mp4}")
+    with open(output_playlist, 'r', encoding='utf-8') as f:
+        if '#EXT-X-BYTERANGE' not in f.read():
+            raise RemuxError(f"输出的播放列表不是字节范围播放列表: {output_playlist}")
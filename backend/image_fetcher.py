@@ -0,0 +1,182 @@
+"""
+直播间图片的共享下载组件
+
+- 所有直播间共用一个有界线程池，排队的任务数达到上限时 submit 阻塞，避免一次性堆积大量任务
+- 每个平台一个令牌桶限速，控制对微赞/短书图片服务器的请求频率，避免触发反爬
+- 记录每个 URL 的 ETag/Last-Modified，再次下载时发条件请求，304 时直接使用已有文件
+- 按内容 sha256 存储一份，各直播间目录中的图片是它的硬链接，同一张封面只占用一份磁盘空间
+"""
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+import requests
+
+STORE_DIR_NAME = '.image_store'
+
+
+class TokenBucket:
+    """令牌桶，rate 为每秒补充的令牌数，capacity 为允许的突发请求数"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """取一个令牌，没有令牌时等待"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class ImageFetchError(Exception):
+    pass
+
+
+class ImageFetcher:
+    """
+    图片下载组件，由 M3U8Downloader 创建，与片段下载共用同一个 requests.Session 连接池
+
+    条件请求的缓存信息和内容哈希记录在 DownloadLedger 的 images 表中。
+    """
+
+    def __init__(self, session, store_root, ledger, rate_limits=None, max_workers=8, max_queue=256,
+                 timeout=30, chunk_size=64 * 1024, max_retries=3, logger=None):
+        self.session = session
+        self.store_dir = os.path.join(store_root, STORE_DIR_NAME)
+        self.ledger = ledger
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.logger = logger or logging.getLogger('ImageFetcher')
+        # 平台 -> 令牌桶，rate_limits 为 {平台: (每秒请求数, 突发请求数)}
+        self._buckets = {platform: TokenBucket(rate, capacity)
+                         for platform, (rate, capacity) in (rate_limits or {}).items()}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image')
+        self._queue_slots = threading.BoundedSemaphore(max_queue)
+        os.makedirs(self.store_dir, exist_ok=True)
+
+    def submit(self, fn, *args, **kwargs):
+        """在共享线程池中执行下载任务，排队任务数达到 max_queue 时阻塞"""
+        self._queue_slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._queue_slots.release()
+            raise
+        future.add_done_callback(lambda _: self._queue_slots.release())
+        return future
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def fetch(self, url, save_path, headers, platform=None, require_image=False):
+        """
+        下载图片到 save_path，失败时重试
+
+        Args:
+            platform (str, optional): 使用该平台的令牌桶限速
+            require_image (bool): 响应的 Content-Type 必须是 image/*
+
+        Returns:
+            int: 本次从网络下载的字节数，304 或内容已存在时为 0
+
+        Raises:
+            ImageFetchError: 重试后仍然失败
+        """
+        for attempt in range(self.max_retries):
+            try:
+                return self._fetch_once(url, save_path, headers, platform, require_image)
+            except requests.exceptions.RequestException as e:
+                if attempt < self.max_retries - 1:
+                    self.logger.warning(f"下载图片失败 (尝试 {attempt + 1}/{self.max_retries}): {str(e)}")
+                    time.sleep(1)  # 等待1秒后重试
+                else:
+                    raise ImageFetchError(f"下载图片失败，已达到最大重试次数: {str(e)}")
+
+    def _fetch_once(self, url, save_path, headers, platform, require_image):
+        bucket = self._buckets.get(platform)
+        if bucket:
+            bucket.acquire()
+
+        cached = self.ledger.image_cache(url)
+        request_headers = dict(headers)
+        cached_blob = None
+        if cached:
+            cached_blob = self.blob_path(cached["sha256"], cached["extension"])
+            if os.path.exists(cached_blob):
+                if cached["etag"]:
+                    request_headers['If-None-Match'] = cached["etag"]
+                if cached["last_modified"]:
+                    request_headers['If-Modified-Since'] = cached["last_modified"]
+            else:
+                cached_blob = None
+
+        with self.session.get(url, headers=request_headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304 and cached_blob:
+                self.logger.info(f"图片未修改，使用已下载的文件: {url}")
+                self.link(cached_blob, save_path)
+                return 0
+            response.raise_for_status()
+            content_type = response.headers.get('content-type', '')
+            if require_image and not content_type.startswith('image/'):
+                raise ImageFetchError(f"响应不是图片类型: {content_type}")
+
+            # 边下载边计算哈希，写入存储目录下的临时文件
+            temp_file = os.path.join(self.store_dir, f"{uuid.uuid4().hex}.part")
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with open(temp_file, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        if chunk:
+                            f.write(chunk)
+                            digest.update(chunk)
+                            size += len(chunk)
+                if size == 0:
+                    raise ImageFetchError("下载的图片大小为0")
+                sha256 = digest.hexdigest()
+                extension = os.path.splitext(save_path)[1]
+                blob = self.blob_path(sha256, extension)
+                if os.path.exists(blob):
+                    self.logger.info(f"图片内容已存在，不重复保存: {url}")
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    os.replace(temp_file, blob)
+            finally:
+                if os.path.exists(temp_file):
+                    os.remove(temp_file)
+
+            self.ledger.save_image_cache(url, response.headers.get('etag'), response.headers.get('last-modified'),
+                                         sha256, extension, size)
+        self.link(blob, save_path)
+        return size
+
+    def blob_path(self, sha256, extension):
+        return os.path.join(self.store_dir, sha256[:2], f"{sha256}{extension}")
+
+    @staticmethod
+    def link(blob, save_path):
+        """在直播间目录中创建指向存储文件的硬链接，不支持硬链接（跨文件系统等）时复制"""
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        if os.path.exists(save_path):
+            os.remove(save_path)
+        try:
+            os.link(blob, save_path)
+        except OSError:
+            shutil.copyfile(blob, save_path)
@@ -1,16 +1,29 @@
+import contextlib
+import hashlib
 import json
 import os
 import random
+import shutil
 import threading
 import uuid
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
 from platform import libc_ver
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, urljoin
 import time
 import logging
 import m3u8
 import concurrent.futures
+import itertools
+
+from download_ledger import DownloadLedger
+from image_fetcher import ImageFetcher, ImageFetchError
+from hls_remux import RemuxError, ffmpeg_available, remux_to_single_fmp4
+from ts_probe import TsStreamValidator, probe_segments, probe_ts
 
 from pycparser.ply.yacc import token
 
@@ -61,15 +74,84 @@ def generate_standard_filename(resource_type, video_id, operation_type, extensio
     return filename
 
 
+def parse_byterange(value, default_start=0):
+    """解析 EXT-X-BYTERANGE 的 长度[@起始位置]，返回 (起始位置, 结束位置)，没有起始位置时接着上一段"""
+    length, _, start = value.partition('@')
+    start = int(start) if start else default_start
+    return start, start + int(length) - 1
+
+
+def parse_tag_attributes(line):
+    """解析 #EXT-X-KEY/#EXT-X-MAP 等标签的属性列表"""
+    _, _, attributes = line.partition(':')
+    return {name: value.strip('"') for name, value in
+            re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', attributes)}
+
+
+def parse_content_range(value):
+    """解析 Content-Range: bytes start-end/total，返回 (start, total)，total 未知时为 None"""
+    try:
+        unit, _, spec = value.partition(' ')
+        byte_range, _, total = spec.partition('/')
+        if unit.lower() != 'bytes':
+            return None, None
+        start = int(byte_range.split('-')[0])
+        return start, (int(total) if total and total != '*' else None)
+    except (AttributeError, ValueError):
+        return None, None
+
+
+@dataclass
+class DownloadJob:
+    """一个直播间（输入文件中的一行）的下载任务状态，每个任务独立，可以并发处理"""
+    line_num: int = 0
+    data: str = ''
+    content_id: Optional[str] = None
+    status: str = 'pending'  # pending / running / success / failed
+    error: Optional[str] = None
+    # 每个码率的媒体播放列表一个下载结果，下载过程中实时更新片段统计
+    m3u8_results: List[dict] = field(default_factory=list)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def segments_total(self):
+        return sum(result["total_segments"] for result in self.m3u8_results)
+
+    @property
+    def segments_done(self):
+        return sum(result["successful_segments"] for result in self.m3u8_results)
+
+    @property
+    def segments_failed(self):
+        return sum(result["failed_segments"] for result in self.m3u8_results)
+
+    @property
+    def downloaded_bytes(self):
+        return sum(result["downloaded_bytes"] for result in self.m3u8_results)
+
+
 class M3U8Downloader:
-    def __init__(self, save_dir, content_id = None, flag = 'inc_download'):
-        """初始化下载器"""
+    def __init__(self, save_dir, content_id = None, flag = 'inc_download', engine = 'thread'):
+        """初始化下载器
+
+        Args:
+            content_id: 已不再使用，内容ID保存在每个DownloadJob中，保留参数以兼容旧的调用方式
+            engine (str): ts片段下载引擎，'thread' 为线程池 + requests，'async' 为 asyncio + httpx。
+                只有 thread 引擎支持从 .part 文件续传片段（Range请求），async 引擎中断的片段从头重新下载
+                bench_segment_engines.py 的本地测试中 async 的吞吐低于 thread、CPU占用更高（httpcore 连接池每个请求的开销），
+                默认使用 thread，async 只在需要 HTTP/2 多路复用的源站上考虑
+        """
         self.save_dir = save_dir
-        self.contend_id = content_id
         self.chunk_size = 1024 * 1024  # 1MB
         self.max_retries = 3
         self.thread_timeout = 30  # 线程超时时间（秒）
         self.download_timeout = 300  # 下载任务总超时时间（秒）
+        self.watchdog_interval = 2  # 看门狗检查片段下载进度的间隔（秒）
+        self.min_segment_throughput = 32 * 1024  # 片段下载吞吐低于该值（字节/秒）视为卡住
+        self.stall_grace_period = 10  # 片段开始下载后多久才开始判断是否卡住（秒）
+        self.max_segment_redispatch = 2  # 同一片段因卡住被重新提交的最大次数
+        self.hedge_factor = 3  # 尾部片段耗时超过已完成片段中位数的倍数时发起对冲请求
         self.timeout = 30
         self.maximum_error_ts = 2
 
@@ -79,82 +161,68 @@ class M3U8Downloader:
         self._stop_event = threading.Event()  # 用于控制线程停止的标志位
 
         self.max_workers = 20  # 同时下载的线程数
+        self.engine = engine
+        self.per_host_limit = 16  # 每个源站的最大并发数
+
+        # 多个直播间并发下载时，所有任务共享片段并发名额和每个源站的并发名额（线程引擎）
+        self.max_concurrent_jobs = 4  # read_and_process_file 同时处理的直播间数
+        self.segment_budget = 48  # 所有直播间同时下载的ts片段总数上限
+        self.progress_interval = 10  # 输出汇总进度的间隔（秒）
+        self._segment_slots = threading.BoundedSemaphore(self.segment_budget)
+        self._origin_slots = {}
+        self._origin_slots_lock = threading.Lock()
+
+        # 断点续传：按源站缓存是否支持Range（从实际响应中得知，不单独探测），大文件分多段并发下载
+        self._range_support = {}
+        self.parallel_download_threshold = 64 * 1024 * 1024  # 超过该大小的单个文件分段并发下载
+        self.parallel_download_connections = 8  # 单个文件分段下载的并发连接数
+        self.parallel_min_chunk_size = 8 * 1024 * 1024  # 每段的最小大小
+
+        self.ts_cc_error_tolerance = 0  # ts片段允许的连续计数器错误数，超过即视为损坏并重新下载
+
+        # 全部片段下载完成后用ffmpeg重新封装为单个fMP4和字节范围播放列表，删除原片段
+        self.remux_after_download = True
+        self.remux_keep_segments = False  # 为True时重新封装后保留原片段
+        self.ffmpeg_path = 'ffmpeg'
+        self.remux_timeout = 1800
+
+        # 图片下载：所有直播间共用的有界线程池，按平台令牌桶限速（每秒请求数, 突发请求数）
+        self.image_workers = 8
+        self.image_queue_size = 256
+        self.image_rate_limits = {'vzan': (5, 10), 'duanshu': (5, 10)}
+
+        # 主播放列表的码率选择：highest 最高码率，lowest 最低码率，closest 最接近 target_bandwidth
+        self.variant_policy = 'highest'
+        self.target_bandwidth = None  # closest 策略的目标码率（bps）
+        self.max_renditions = 1  # 下载的码率数，大于1时按策略顺序取前几个并发下载
+
+        # 所有请求共用一个Session，复用TCP/TLS连接，连接池大小与线程数一致
+        self.session = self.create_session()
 
         # 创建保存目录
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
             print(f"创建保存目录: {save_dir}")
 
-        self.error_log_file = os.path.join(self.save_dir, 'download_errors.json')
-        self.success_log_file = os.path.join(self.save_dir, 'successful_downloads.csv')
-
-        # 初始化成功下载记录
-        self.successful_downloads = []
-
         # 设置日志
         self.setup_logging()
-        #如果是增量下载，则需要判断被下载的视频是否已经成功下载过。第一次下载也属于增量下载
-        if flag == 'inc_download':
-            self.downloaded_urls = self.extract_m3u8_url()
-        #如果是处理错误下载，则不需要抽取extract_m3u8_url去判断是否已经下载了。
-        else:
-            self.downloaded_urls = []
 
-    def extract_m3u8_url(self):
-        """从CSV文件中提取包含m3u8的直播间ID
-
-        Args:
-            csv_file (str): CSV文件路径
-
-        Returns:
-            list: 包含m3u8的直播间ID列表
-        """
-        csv_file = self.success_log_file
-        urls = set()  # 使用集合去重
-
-        try:
-            with (open(csv_file, 'r', encoding='utf-8') as f):
-                # 跳过标题行
-                next(f)
-                for line in f:
-                    content_id, url, _ = line.strip().split(',')
-                    # 检查URL是否包含m3u8
-                    if '.m3u8' in url:
-                        urls.add(url)
-                    #处理图片url，一个直播间可能有多个图片，它们之间通过$$$$$分割，
-                    # 因此需要将它们转化为多个图片url在添加到urls里面
-                    if 'png' in url or 'jpg' in url or 'jpeg' in url or 'gif' in url:
-                        if "$$$$$" in url:
-                            image_urls = url.split("$$$$$")
-                            for image_url in image_urls:
-                                urls.add(image_url)
-                        else:
-                            urls.add(url)
-
-
-            self.logger.info(f"从CSV文件中提取到 {len(urls)} 个包含m3u8或图片的直播间ID")
-            return list(urls)
-
-        except Exception as e:
-            self.logger.error(f"提取m3u8直播间ID时出错: {str(e)}")
-            return []
+        # 成功下载、片段状态和失败记录都保存在SQLite下载记录中，首次启动时导入旧版CSV/JSON记录
+        self.ledger_file = os.path.join(self.save_dir, 'downloads.db')
+        self.ledger = DownloadLedger(self.ledger_file, self.logger)
+        self.ledger.import_legacy(os.path.join(self.save_dir, 'successful_downloads.csv'),
+                                  os.path.join(self.save_dir, 'download_errors.json'))
+        self.image_fetcher = ImageFetcher(self.session, self.save_dir, self.ledger, self.image_rate_limits,
+                                          max_workers=self.image_workers, max_queue=self.image_queue_size,
+                                          timeout=self.timeout, max_retries=self.max_retries, logger=self.logger)
 
+        #如果是增量下载，则需要判断被下载的视频是否已经成功下载过。第一次下载也属于增量下载
+        #如果是处理错误下载，则不需要判断是否已经下载了。
+        self.skip_downloaded = flag == 'inc_download'
 
-    def save_successful_downloads(self):
-        """保存成功下载记录到CSV文件"""
-        try:
-            # 如果文件不存在，创建文件并写入标题行
-            file_exists = os.path.exists(self.success_log_file)
-            with open(self.success_log_file, 'a', encoding='utf-8', newline='') as f:
-                # 如果文件不存在，先写入标题行
-                if not file_exists:
-                    f.write("content_id,m3u8_url/image_url,timestamp\n")
-
-                # 写入所有记录
-                record = self.successful_downloads[-1]
-                f.write(f"{record['content_id']},{record['url']},{record['timestamp']}\n")
-        except Exception as e:
-            self.logger.error(f"保存成功下载记录时出错: {str(e)}")
+    def is_downloaded(self, url):
+        """增量下载时判断URL是否已经成功下载过"""
+        return self.skip_downloaded and self.ledger.is_downloaded(url)
 
     def setup_logging(self):
         """配置日志系统"""
@@ -181,8 +249,26 @@ class M3U8Downloader:
         self.logger.addHandler(file_handler)
         self.logger.addHandler(console_handler)
 
+    def create_session(self):
+        """创建带连接池的Session"""
+        session = requests.Session()
+        session.max_redirects = 5
+        # 多个直播间共用一个Session，连接池按全局片段并发名额设置
+        pool_size = max(self.max_workers, self.segment_budget)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def range_supported(self, url):
+        """源站是否支持Range请求，True/False，还没有请求过该源站时为None"""
+        return self._range_support.get(urlparse(url).netloc)
+
     def check_server_support_range(self, url):
-        """检查服务器是否支持断点续传"""
+        """检查服务器是否支持断点续传，结果按源站缓存，每个源站只发一次HEAD请求"""
+        supported = self.range_supported(url)
+        if supported is not None:
+            return supported
         try:
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
@@ -192,82 +278,93 @@ class M3U8Downloader:
             }
 
             # 发送HEAD请求检查服务器响应头
-            response = requests.head(url, headers=headers, timeout=self.timeout)
-
-            # 打印所有响应头，用于调试
-            self.logger.info("服务器响应头:")
-            for key, value in response.headers.items():
-                self.logger.info(f"{key}: {value}")
+            response = self.session.head(url, headers=headers, timeout=self.timeout, allow_redirects=True)
 
             # 检查是否支持断点续传
-            if 'Accept-Ranges' in response.headers:
-                self.logger.info(f"服务器支持断点续传: {response.headers['Accept-Ranges']}")
-                return True
-            else:
-                self.logger.info("服务器不支持断点续传")
-                return False
+            supported = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+            self.logger.info(f"服务器{'支持' if supported else '不支持'}断点续传: {urlparse(url).netloc}")
+            self._range_support[urlparse(url).netloc] = supported
+            return supported
 
         except Exception as e:
             self.logger.error(f"检查断点续传支持时出错: {str(e)}")
             return False
 
+    def open_ranged(self, url, headers, offset=0, end=None):
+        """
+        从offset处开始请求文件，返回 (response, 实际起始位置, 文件总大小)
+
+        源站不确定或支持Range时带上Range头：返回206则从offset续传，返回200说明不支持，从头下载，
+        两种结果都记入源站缓存；续传位置超出文件大小(416)时从头重新请求。
+        """
+        origin = urlparse(url).netloc
+        for _ in range(2):
+            request_headers = dict(headers)
+            if self._range_support.get(origin) is not False:
+                request_headers['Range'] = f"bytes={offset}-{end if end is not None else ''}"
+            else:
+                request_headers.pop('Range', None)
+                offset = 0
+            response = self.session.get(url, headers=request_headers, stream=True, timeout=self.timeout)
+            if response.status_code == 416 and offset > 0:
+                response.close()
+                self.logger.warning(f"续传位置超出文件大小，从头下载: {url}")
+                offset = 0
+                continue
+            try:
+                response.raise_for_status()
+            except Exception:
+                response.close()
+                raise
+
+            if response.status_code == 206:
+                self._range_support[origin] = True
+                start, total = parse_content_range(response.headers.get('content-range'))
+                if start is not None and start != offset:
+                    response.close()
+                    raise Exception(f"服务器返回的起始位置不匹配: 请求 {offset}, 返回 {start}")
+                if total is None:
+                    total = offset + int(response.headers.get('content-length', 0))
+                return response, offset, total
+
+            if 'Range' in request_headers:
+                self._range_support[origin] = False
+            return response, 0, int(response.headers.get('content-length', 0))
+        raise Exception(f"无法从头下载文件: {url}")
+
     def download_file(self, url, filename, is_ts=False):
-        """下载文件，支持断点续传"""
-        temp_file = f"{filename}.temp"
+        """
+        下载文件，支持断点续传
+
+        下载内容写入 {filename}.part，失败时保留以便下次续传；超过parallel_download_threshold的文件
+        分成多段用多个连接并发下载，分段进度记录在 {filename}.part.json 中，中断后每段从断点继续。
+        """
+        temp_file = f"{filename}.part"
+        state_file = f"{temp_file}.json"
         max_retries = 3
         retry_count = 0
 
-        # 首先检查服务器是否支持断点续传
-        supports_range = self.check_server_support_range(url)
+        # 添加请求头
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Referer': 'https://my.duanshu.com/',
+            'Accept': '*/*',
+            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+        }
 
         while retry_count < max_retries:
             try:
-                # 添加请求头
-                headers = {
-                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                    'Referer': 'https://my.duanshu.com/',
-                    'Accept': '*/*',
-                    'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-                }
-
-                # 检查是否存在未完成的下载
-                downloaded_size = 0
-                if os.path.exists(temp_file) and supports_range:
-                    downloaded_size = os.path.getsize(temp_file)
-                    self.logger.info(f"发现未完成的下载: {filename}, 已下载: {downloaded_size} bytes")
-                    headers['Range'] = f'bytes={downloaded_size}-'
+                # 上次是分段下载的，继续分段下载
+                if os.path.exists(state_file) and os.path.exists(temp_file):
+                    success = self.download_file_parallel(url, temp_file, headers)
                 else:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                        self.logger.info("服务器不支持断点续传，删除临时文件重新下载")
-
-                # 开始下载
-                with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
-                    response.raise_for_status()
-
-                    # 获取文件总大小
-                    total_size = int(response.headers.get('content-length', 0))
-
-                    # 打开文件进行写入
-                    mode = 'ab' if downloaded_size > 0 else 'wb'
-                    with open(temp_file, mode) as f:
-                        for chunk in response.iter_content(chunk_size=self.chunk_size):
-                            if chunk:
-                                f.write(chunk)
-                                downloaded_size += len(chunk)
-
-                                # 计算下载进度
-                                #if total_size > 0:
-                                #    progress = (downloaded_size / total_size) * 100
-                                #    if is_ts:
-                                #        self.logger.debug(f"TS片段下载进度: {progress:.2f}%")
-                                #    else:
-                                #        self.logger.info(f"下载进度: {progress:.2f}%")
+                    success = self.download_file_single(url, temp_file, headers)
+                if not success:
+                    retry_count += 1
+                    continue
 
                 # 下载完成后重命名文件
-                if os.path.exists(filename):
-                    os.remove(filename)  # 如果目标文件已存在，先删除
-                os.rename(temp_file, filename)
+                os.replace(temp_file, filename)
 
                 if is_ts:
                     self.logger.debug(f"TS片段下载完成: {filename}")
@@ -275,30 +372,108 @@ class M3U8Downloader:
                     self.logger.info(f"文件下载完成: {filename}")
                 return True
 
-            except requests.exceptions.HTTPError as e:
-                if e.response.status_code == 416:  # Range Not Satisfiable
-                    self.logger.warning(f"断点续传失败，重新开始下载: {str(e)}")
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                    retry_count += 1
-                    continue
-                else:
-                    self.logger.error(f"下载文件时出错: {str(e)}")
-                    return False
             except Exception as e:
-                self.logger.error(f"下载文件时出错: {str(e)}")
-                return False
-            finally:
-                # 如果下载失败，删除临时文件
-                if not os.path.exists(filename) and os.path.exists(temp_file):
-                    try:
-                        os.remove(temp_file)
-                    except:
-                        pass
+                retry_count += 1
+                self.logger.warning(f"下载文件时出错 (尝试 {retry_count}/{max_retries}): {str(e)}")
+                time.sleep(1)
 
-        self.logger.error(f"下载失败，已达到最大重试次数: {max_retries}")
+        self.logger.error(f"下载失败，已达到最大重试次数: {max_retries}，已下载的部分保留在 {temp_file}")
         return False
 
+    def download_file_single(self, url, temp_file, headers):
+        """单连接下载到temp_file，已有部分时从断点续传；首个响应显示文件很大时转为分段并发下载"""
+        offset = os.path.getsize(temp_file) if os.path.exists(temp_file) else 0
+        if offset:
+            self.logger.info(f"发现未完成的下载: {temp_file}, 已下载: {offset} bytes")
+
+        response, offset, total_size = self.open_ranged(url, headers, offset)
+        with response:
+            if (offset == 0 and response.status_code == 206 and
+                    total_size >= self.parallel_download_threshold and self.parallel_download_connections > 1):
+                response.close()
+                self.init_parallel_state(temp_file, total_size)
+                return self.download_file_parallel(url, temp_file, headers)
+
+            # 服务器不支持续传时offset为0，从头写入
+            mode = 'ab' if offset > 0 else 'wb'
+            with open(temp_file, mode) as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if chunk:
+                        f.write(chunk)
+
+        actual_size = os.path.getsize(temp_file)
+        if total_size and actual_size != total_size:
+            if actual_size > total_size:
+                os.remove(temp_file)
+            raise Exception(f"文件大小不匹配: 预期 {total_size}, 实际 {actual_size}")
+        return True
+
+    def init_parallel_state(self, temp_file, total_size):
+        """预分配temp_file并把文件切成若干段，每段记录 [起始位置, 结束位置, 已下载字节数]"""
+        chunk_count = max(1, min(self.parallel_download_connections, total_size // self.parallel_min_chunk_size))
+        chunk_size = -(-total_size // chunk_count)
+        ranges = [[start, min(start + chunk_size, total_size) - 1, 0] for start in range(0, total_size, chunk_size)]
+        with open(temp_file, 'wb') as f:
+            f.truncate(total_size)
+        self.save_parallel_state(temp_file, total_size, ranges)
+        self.logger.info(f"文件大小 {total_size / 1024 / 1024:.1f}MB，分 {len(ranges)} 段并发下载: {temp_file}")
+
+    @staticmethod
+    def save_parallel_state(temp_file, total_size, ranges):
+        state_file = f"{temp_file}.json"
+        with open(f"{state_file}.tmp", 'w', encoding='utf-8') as f:
+            json.dump({"total_size": total_size, "ranges": ranges}, f)
+        os.replace(f"{state_file}.tmp", state_file)
+
+    def download_file_parallel(self, url, temp_file, headers):
+        """按 {temp_file}.json 中记录的分段并发下载，每段从已下载的位置继续"""
+        state_file = f"{temp_file}.json"
+        with open(state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        total_size, ranges = state["total_size"], state["ranges"]
+        if os.path.getsize(temp_file) != total_size:
+            # 临时文件与记录不一致，重新开始
+            os.remove(state_file)
+            os.remove(temp_file)
+            raise Exception("分段下载的临时文件与记录不一致")
+
+        state_lock = threading.Lock()
+
+        def fetch_range(byte_range):
+            start, end, done = byte_range
+            if start + done > end:
+                return True
+            response, offset, _ = self.open_ranged(url, headers, start + done, end)
+            with response, open(temp_file, 'r+b') as f:
+                if response.status_code != 206 or offset != start + done:
+                    raise Exception("服务器不支持分段下载")
+                f.seek(offset)
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    f.flush()
+                    with state_lock:
+                        byte_range[2] += len(chunk)
+                        self.save_parallel_state(temp_file, total_size, ranges)
+            return start + byte_range[2] > end
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(fetch_range, byte_range) for byte_range in ranges]
+            errors = []
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    if not future.result():
+                        errors.append("分段未下载完整")
+                except Exception as e:
+                    errors.append(str(e))
+
+        if errors:
+            self.logger.warning(f"{len(errors)} 个分段下载失败，已记录进度: {errors[0]}")
+            return False
+        os.remove(state_file)
+        return True
+
     def download_ts_segment(self, url, filename, headers):
         """下载单个ts片段，增加超时和标志位控制"""
         thread_id = threading.get_ident()
@@ -370,203 +545,109 @@ class M3U8Downloader:
 
         return dead_threads
 
-    def download_vzan_image(self, image_url, resource_type, save_dir, authorization, image_name=None):
-            """
-            专门用于下载微赞图片的函数
-
-            Args:
-                image_url (str): 图片URL
-                save_dir (str): 保存目录
-                image_name (str, optional): 图片名称，如果不提供则从URL中提取
-
-            Returns:
-                tuple: (success, saved_path)
-                    - success: 是否下载成功
-                    - saved_path: 保存的路径，如果失败则为None
-            """
-            try:
-                self.logger.info(f"开始下载微赞图片: {image_url}")
-
-                # 检查URL是否为空
-                if not image_url or not image_url.strip():
-                    self.logger.error("图片URL为空")
-                    return False
-                # 从URL中提取文件名
-
-                # 从URL中提取扩展名
-                extension = os.path.splitext(urlparse(image_url).path)[1]
-                if not extension:
-                    extension = '.jpg'
-
-                # 生成标准文件名
-                #content_id = os.path.basename(save_dir)
-                filename = generate_standard_filename(resource_type, self.content_id, 'fetch', extension)
-
-                save_path = os.path.join(save_dir, filename)
-
-                try:
-                    os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                except Exception as e:
-                    self.logger.error(f"创建保存图片文件失败: {str(e)}")
-                    return False
-
-                # 设置请求头
-                headers = {
-                    'accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
-                    'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8',
-                    'authorization': f'Bearer {authorization}',
-                    'lid': '11749549',
-                    'origin': 'https://live.vzan.com',
-                    'referer': 'https://live.vzan.com/',
-                    'sec-ch-ua': '"Not A(Brand";v="99", "Google Chrome";v="136", "Chromium";v="136"',
-                    'sec-ch-ua-mobile': '?0',
-                    'sec-ch-ua-platform': '"Windows"',
-                    'sec-fetch-dest': 'image',
-                    'sec-fetch-mode': 'no-cors',
-                    'sec-fetch-site': 'same-site',
-                    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36',
-                    'zbid': '11749549'
-                }
-
-                # 最多重试3次
-                max_retries = 3
-                for attempt in range(max_retries):
-                    try:
-                        # 发送请求
-                        with requests.get(image_url, headers=headers, stream=True, timeout=self.timeout) as response:
-                            # 检查响应状态
-                            response.raise_for_status()
-                            # 检查Content-Type
-                            content_type = response.headers.get('content-type', '')
-                            if not content_type.startswith('image/'):
-                                self.logger.error(f"响应不是图片类型: {content_type}")
-                                return False
-                            # 获取文件大小
-                            file_size = int(response.headers.get('content-length', 0))
-                            if file_size == 0:
-                                self.logger.error("图片大小为0")
-                                return False
-                            # 保存图片
-                            with open(save_path, 'wb') as f:
-                                downloaded_size = 0
-                                for chunk in response.iter_content(chunk_size=8192):
-                                    if chunk:
-                                        f.write(chunk)
-                                        downloaded_size += len(chunk)
-                                        # 记录下载进度
-                                        #if file_size > 0:
-                                        #    progress = (downloaded_size / file_size) * 100
-                                        #    self.logger.info(f"下载进度: {progress:.1f}%")
-                        # 验证文件是否完整下载
-                        if os.path.getsize(save_path) == 0:
-                            self.logger.error("下载的文件大小为0")
-                            if os.path.exists(save_path):
-                                os.remove(save_path)
-                            return False
-                        self.logger.info(f"成功下载图片: {save_path}")
-                        return True
+    def download_vzan_image(self, image_url, resource_type, save_dir, authorization, image_name=None, content_id=None):
+        """
+        专门用于下载微赞图片的函数
 
-                    except requests.exceptions.RequestException as e:
-                        if attempt < max_retries - 1:
-                            self.logger.warning(f"下载图片失败 (尝试 {attempt + 1}/{max_retries}): {str(e)}")
-                            time.sleep(1)  # 等待1秒后重试
-                        else:
-                            self.logger.error(f"下载图片失败，已达到最大重试次数: {str(e)}")
-                            if os.path.exists(save_path):
-                                os.remove(save_path)
-                            return False
+        Args:
+            image_url (str): 图片URL
+            save_dir (str): 保存目录
+            image_name (str, optional): 图片文件名，不提供时按标准格式生成
+            content_id (str): 直播间的内容ID，用于生成文件名
 
-            except Exception as e:
-                self.logger.error(f"下载图片时发生错误: {str(e)}")
-                if 'save_path' in locals() and os.path.exists(save_path):
-                    os.remove(save_path)
-                return False
+        Returns:
+            bool: 是否下载成功
+        """
+        # 设置请求头
+        headers = {
+            'accept': 'image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8',
+            'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8',
+            'authorization': f'Bearer {authorization}',
+            'lid': '11749549',
+            'origin': 'https://live.vzan.com',
+            'referer': 'https://live.vzan.com/',
+            'sec-ch-ua': '"Not A(Brand";v="99", "Google Chrome";v="136", "Chromium";v="136"',
+            'sec-ch-ua-mobile': '?0',
+            'sec-ch-ua-platform': '"Windows"',
+            'sec-fetch-dest': 'image',
+            'sec-fetch-mode': 'no-cors',
+            'sec-fetch-site': 'same-site',
+            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36',
+            'zbid': '11749549'
+        }
+        self.logger.info(f"开始下载微赞图片: {image_url}")
+        return self.fetch_image(image_url, resource_type, save_dir, headers, 'vzan', image_name, content_id,
+                                require_image=True)
+
+    def download_duanshu_image(self, url, resource_type, save_dir, authorization=None, content_id=None):
+        """下载短书图片"""
+        # 添加请求头
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+            'Referer': 'https://my.duanshu.com/',
+            'Accept': '*/*',
+            'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
+        }
+        self.logger.info(f"开始下载短书图片: {url}")
+        return self.fetch_image(url, resource_type, save_dir, headers, 'duanshu', content_id=content_id)
 
+    def fetch_image(self, url, resource_type, save_dir, headers, platform, image_name=None, content_id=None,
+                    require_image=False):
+        """
+        通过image_fetcher下载图片（平台限速、条件请求、按内容去重）
 
-    def download_duanshu_image(self, url, resource_type, save_dir, authorization=None):
-        """下载图片，使用简单重试机制"""
+        标准文件名中加入URL的哈希，同一直播间的多张图片并发下载时不会重名
+        """
         try:
-            self.logger.info(f"开始下载短书图片: {url}")
             # 检查URL是否为空
             if not url or not url.strip():
                 self.logger.error("图片URL为空")
                 return False
 
-            # 从URL中提取扩展名
-            extension = os.path.splitext(urlparse(url).path)[1]
-            if not extension:
-                extension = '.jpg'
-
-            # 生成标准文件名
-            #content_id = os.path.basename(save_dir)
-            filename = generate_standard_filename(resource_type, self.content_id, 'fetch', extension)
+            if not image_name:
+                # 从URL中提取扩展名
+                extension = os.path.splitext(urlparse(url).path)[1] or '.jpg'
+                url_hash = hashlib.md5(url.encode('utf-8')).hexdigest()[:8]
+                image_name = generate_standard_filename(resource_type, content_id, f'fetch_{url_hash}', extension)
+            save_path = os.path.join(save_dir, image_name)
 
+            self.image_fetcher.fetch(url, save_path, headers, platform, require_image=require_image)
+            self.logger.info(f"成功下载图片: {save_path}")
+            return True
+        except ImageFetchError as e:
+            self.logger.error(f"{str(e)}: {url}")
+            return False
+        except Exception as e:
+            self.logger.error(f"下载图片时发生错误: {str(e)}")
+            return False
 
-            save_path = os.path.join(save_dir, filename)
+    def download_images(self, urls, save_dir, authorization, content_id=None):
+        """
+        在image_fetcher的共享线程池中并发下载多张图片
 
+        Returns:
+            dict: {url: 是否下载成功}
+        """
+        futures = {url: self.image_fetcher.submit(self.download_image, url, save_dir, authorization,
+                                                  content_id=content_id)
+                   for url in urls}
+        results = {}
+        for url, future in futures.items():
             try:
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
+                results[url] = future.result()
             except Exception as e:
-                self.logger.error(f"创建保存图片文件失败: {str(e)}")
-                return False
-
-            # 添加请求头
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-                'Referer': 'https://my.duanshu.com/',
-                'Accept': '*/*',
-                'Accept-Language': 'zh-CN,zh;q=0.9,en;q=0.8',
-            }
-
-            max_retries = 3
-            retry_count = 0
-
-            while retry_count < max_retries:
-                try:
-                    # 开始下载
-                    with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
-                        response.raise_for_status()
+                self.logger.error(f"下载图片时出错: {str(e)}")
+                results[url] = False
+        return results
 
-                        # 获取文件总大小
-                        total_size = int(response.headers.get('content-length', 0))
-
-                        # 直接写入文件
-                        with open(save_path, 'wb') as f:
-                            downloaded_size = 0
-                            for chunk in response.iter_content(chunk_size=self.chunk_size):
-                                if chunk:
-                                    f.write(chunk)
-                                    downloaded_size += len(chunk)
-
-                                    # 计算下载进度
-                                    #if total_size > 0:
-                                    #    progress = (downloaded_size / total_size) * 100
-                                    #    self.logger.info(f"下载进度: {progress:.2f}%")
-
-                    self.logger.info(f"图片下载完成: {save_path}")
-                    return True
-
-                except Exception as e:
-                    retry_count += 1
-                    self.logger.warning(f"下载图片失败 (尝试 {retry_count}/{max_retries}): {str(e)}")
-                    if retry_count < max_retries:
-                        time.sleep(1)  # 等待1秒后重试
-                    continue
-
-            self.logger.error(f"图片下载失败，已达到最大重试次数: {url}")
-            return False
-
-        except Exception as e:
-            self.logger.error(f"下载图片时出错: {str(e)}")
-            return False
-
-    def download_image(self, url, save_dir, authorization):
+    def download_image(self, url, save_dir, authorization, content_id=None):
         """下载图片的统一入口
 
         Args:
             url (str): 图片URL
             save_dir (str): 保存目录
             authorization (str): 授权token
+            content_id (str): 直播间的内容ID，用于生成文件名
 
         Returns:
             bool: 下载是否成功
@@ -586,9 +667,9 @@ class M3U8Downloader:
                 return False
 
             if "duanshu" in url:
-                return self.download_duanshu_image(url, 'image', images_dir, authorization)
+                return self.download_duanshu_image(url, 'image', images_dir, authorization, content_id=content_id)
             elif "vzan" in url:
-                return self.download_vzan_image(url, 'image', images_dir, authorization)
+                return self.download_vzan_image(url, 'image', images_dir, authorization, content_id=content_id)
             else:
                 self.logger.error(f"不支持的图片URL类型: {url}")
                 return False
@@ -596,70 +677,137 @@ class M3U8Downloader:
             self.logger.error(f"下载图片时出错: {str(e)}")
             return False
 
-    def download_and_verify_ts_segment(self, url, filename, headers, index):
+    def download_and_verify_ts_segment(self, url, filename, headers, index, attempt=None, byterange=None,
+                                       validate_ts=False):
         """
         下载并验证单个ts片段
 
+        下载内容写入 {filename}.part，中断后从已下载的位置续传（源站支持Range时），校验通过后再替换为目标文件。
+
         Args:
             url (str): ts片段的URL
             filename (str): 保存的文件路径
             headers (dict): 请求头
             index (int): 片段的索引号
+            attempt (dict, optional): 看门狗跟踪的下载尝试，下载过程中更新已接收字节数，
+                被设置 cancelled 时中止下载。同一片段可能有多个尝试并发，拿到 part_lock 的尝试使用
+                {filename}.part 续传，对冲请求等其他尝试写入自己的临时文件
+            byterange (tuple, optional): EXT-X-BYTERANGE 片段在文件中的 (起始位置, 结束位置)，只下载这一段
+            validate_ts (bool): 边接收边校验ts包的同步字节和连续计数器，并计算校验和（attempt["checksum"]）；
+                校验失败时删除临时文件并设置 attempt["corrupt"]，由调用方立即重新下载
 
         Returns:
-            dict: 包含下载和验证结果的字典
-            {
-                "success": bool,  # 是否成功
-                "index": int,     # 片段索引
-                "size": int,      # 文件大小
-                "url": str,       # 下载URL
-                "error": str      # 错误信息（如果失败）
-            }
+            bool: 是否下载并验证成功
         """
+        part_lock = attempt.get("part_lock") if attempt else None
+        # 被重新提交的尝试稍等被中止的旧尝试退出，接着它的进度下载；对冲请求不等待
+        owns_part = part_lock is None or part_lock.acquire(timeout=0 if attempt["hedge"] else 1)
+        temp_file = f"{filename}.part" if owns_part else f"{filename}.{attempt['id']}.part"
         try:
-            with requests.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
-                response.raise_for_status()
-
-                # 获取文件大小
-                total_size = int(response.headers.get('content-length', 0))
-
-                # 下载文件
-                with open(filename, 'wb') as f:
-                    downloaded_size = 0
-                    for chunk in response.iter_content(chunk_size=self.chunk_size):
-                        if chunk:
-                            f.write(chunk)
-                            downloaded_size += len(chunk)
-
-                # 验证文件大小
-                actual_size = os.path.getsize(filename)
-                if actual_size != total_size:
-                    raise Exception(f"文件大小不匹配: 预期 {total_size}, 实际 {actual_size}")
-
-                # 验证文件是否为空
-                if actual_size == 0:
-                    raise Exception("下载的文件大小为0")
-
-                # 验证文件是否可读
-                try:
-                    with open(filename, 'rb') as f:
-                        # 读取文件头部，检查是否是有效的ts文件
-                        header = f.read(4)
-                        if not header:
-                            raise Exception("无法读取文件头部")
-                except Exception as e:
-                    raise Exception(f"文件验证失败: {str(e)}")
-
-                return True
+            with self.segment_slot(url):
+                if attempt is not None:
+                    if attempt["cancelled"].is_set():
+                        return False
+                    # 拿到下载名额后才开始计时，排队时间不算入吞吐
+                    attempt["start_time"] = attempt["checked_at"] = time.time()
+                offset = os.path.getsize(temp_file) if owns_part and os.path.exists(temp_file) else 0
+                if byterange:
+                    range_start, range_end = byterange
+                    total_size = range_end - range_start + 1
+                    if offset >= total_size:
+                        offset = 0
+                    response, start, _ = self.open_ranged(url, headers, range_start + offset, range_end)
+                    if response.status_code != 206 or start < range_start:
+                        response.close()
+                        raise Exception(f"服务器不支持字节范围片段: {url}")
+                    offset = start - range_start
+                else:
+                    response, offset, total_size = self.open_ranged(url, headers, offset)
+                validator = TsStreamValidator(self.ts_cc_error_tolerance) if validate_ts else None
+                if validator and offset:
+                    # 续传时先校验已下载的部分，只在续传时读一次
+                    with open(temp_file, 'rb') as f:
+                        for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                            validator.feed(chunk)
+                with response:
+                    if attempt is not None:
+                        attempt["response"] = response
+
+                    # 下载文件，续传时追加到已下载的部分之后
+                    with open(temp_file, 'ab' if offset else 'wb') as f:
+                        downloaded_size = offset
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            if attempt is not None and attempt["cancelled"].is_set():
+                                return False
+                            if chunk:
+                                if validator and not validator.feed(chunk):
+                                    break
+                                f.write(chunk)
+                                downloaded_size += len(chunk)
+                                if attempt is not None:
+                                    attempt["bytes"] = downloaded_size - offset
+
+            if validator and validator.finish():
+                # 损坏的数据不能用于续传
+                os.remove(temp_file)
+                if attempt is not None:
+                    attempt["corrupt"] = True
+                self.logger.warning(f"TS片段 {index} 校验失败: {validator.error}")
+                raise Exception(f"ts片段校验失败: {validator.error}")
+
+            # 验证文件大小
+            actual_size = os.path.getsize(temp_file)
+            if actual_size != total_size:
+                # 大小不对的临时文件不能用于续传
+                os.remove(temp_file)
+                raise Exception(f"文件大小不匹配: 预期 {total_size}, 实际 {actual_size}")
+
+            # 验证文件是否为空
+            if actual_size == 0:
+                raise Exception("下载的文件大小为0")
+
+            if validator and attempt is not None:
+                attempt["checksum"] = validator.checksum
+            os.replace(temp_file, filename)
+            return True
         except requests.exceptions.RequestException as e:
             return False
         except Exception as e:
             return False
+        finally:
+            # {filename}.part 保留用于续传，对冲请求的临时文件直接删除
+            if not owns_part and os.path.exists(temp_file):
+                try:
+                    os.remove(temp_file)
+                except OSError:
+                    pass
+            if owns_part and part_lock is not None:
+                # 对冲请求已经完成该片段时，续传文件不再需要
+                if os.path.exists(filename) and os.path.exists(temp_file):
+                    try:
+                        os.remove(temp_file)
+                    except OSError:
+                        pass
+                part_lock.release()
+
+    @contextlib.contextmanager
+    def segment_slot(self, url):
+        """占用一个源站并发名额和一个全局片段并发名额，所有并发的直播间共用"""
+        origin = urlparse(url).netloc
+        with self._origin_slots_lock:
+            origin_slots = self._origin_slots.get(origin)
+            if origin_slots is None:
+                origin_slots = self._origin_slots[origin] = threading.BoundedSemaphore(self.per_host_limit)
+        # 先占源站名额，等待繁忙源站时不占用全局名额
+        with origin_slots, self._segment_slots:
+            yield
 
     def get_video_info_from_ts(self, ts_file_path):
         """
         从ts片段中获取视频信息
 
+        先在进程内解析ts文件头尾（ts_probe），解析不出分辨率时（非ts封装、SPS不在片段开头等）再调用ffprobe
+
         Args:
             ts_file_path (str): ts文件路径
 
@@ -672,6 +820,37 @@ class M3U8Downloader:
                 'frame_rate': float # 帧率
             }
         """
+        try:
+            video_info = probe_ts(ts_file_path)
+        except Exception as e:
+            self.logger.warning(f"解析ts文件失败，改用ffprobe: {str(e)}")
+            video_info = None
+        if video_info and video_info['resolution']:
+            return video_info
+        return self.get_video_info_with_ffprobe(ts_file_path)
+
+    def get_video_info_from_segments(self, ts_files, sample_size=10):
+        """
+        批量解析多个ts片段获取视频信息，码率按抽样片段的总大小和总时长计算
+
+        Args:
+            ts_files (list): ts文件路径列表，均匀抽取sample_size个解析
+            sample_size (int): 最多解析的片段数
+
+        Returns:
+            dict: 同get_video_info_from_ts
+        """
+        if not ts_files:
+            return None
+        step = max(1, len(ts_files) // sample_size)
+        samples = ts_files[::step][:sample_size]
+        video_info = probe_segments(samples)
+        if video_info and video_info['resolution']:
+            return video_info
+        return self.get_video_info_with_ffprobe(samples[0])
+
+    def get_video_info_with_ffprobe(self, ts_file_path):
+        """使用ffprobe子进程获取视频信息，返回格式同get_video_info_from_ts"""
         try:
             import subprocess
             import json
@@ -771,20 +950,44 @@ class M3U8Downloader:
             self.logger.error(f"重命名hls文件夹时出错: {str(e)}")
             return video_dir
 
-    def download_m3u8(self, url, save_dir=None):
-        # 初始化结果
-        result = {
+    def new_m3u8_result(self, url):
+        return {
             "success": True,
             "error": None,
+            "m3u8_url": url,
             "failed_ts_segments": [],
             "ts_urls": [],
             "download_start_time": time.strftime("%Y-%m-%d %H:%M:%S"),
             "download_end_time": None,
             "total_segments": 0,
             "successful_segments": 0,
-            "failed_segments": 0
+            "failed_segments": 0,
+            "downloaded_bytes": 0
         }
 
+    def fetch_playlist(self, url, headers):
+        """下载播放列表，返回 (内容, 解析相对地址用的最终URL)"""
+        response = self.session.get(url, headers=headers, timeout=self.timeout, allow_redirects=True)
+        response.raise_for_status()
+        return response.content, getattr(response, 'url', None) or url
+
+    def download_m3u8(self, url, save_dir=None, job=None):
+        """
+        下载m3u8及其全部片段
+
+        媒体播放列表直接下载到 hls/ 目录；主播放列表按 variant_policy 选择 max_renditions 个码率，
+        只选一个时同样下载到 hls/，选多个时每个码率下载到 hls/{分辨率}_{码率}/ 并发进行，
+        再在 hls/ 下生成引用各码率本地播放列表的主播放列表。
+
+        Args:
+            url (str): m3u8地址
+            save_dir (str, optional): 保存目录，默认为self.save_dir
+            job (DownloadJob, optional): 所属的下载任务，提供内容ID并实时反映片段下载进度
+        """
+        job = job or DownloadJob()
+        # 初始化结果
+        result = self.new_m3u8_result(url)
+
         try:
             # 使用指定的保存目录或默认目录
             if save_dir is None:
@@ -795,15 +998,6 @@ class M3U8Downloader:
             os.makedirs(video_dir, exist_ok=True)
             self.logger.info(f"视频文件将保存在: {video_dir}")
 
-            # 下载m3u8文件
-            #m3u8_filename = os.path.join(video_dir, 'playlist.m3u8')
-            #self.logger.info(f"开始下载m3u8文件: {url}")
-            # 生成标准m3u8文件名
-            #content_id = os.path.basename(save_dir)
-            standard_filename = generate_standard_filename('video', self.content_id, 'fetch', '.m3u8')
-            m3u8_filename = os.path.join(video_dir, standard_filename)
-            self.logger.info(f"开始下载m3u8文件: {url}")
-
             # 模拟VLC的请求头
             headers = {
                 'User-Agent': 'VLC/3.0.18 LibVLC/3.0.18',
@@ -819,188 +1013,39 @@ class M3U8Downloader:
                 'Cache-Control': 'no-cache',
             }
 
-            # 创建session来保持连接
-            session = requests.Session()
-            session.max_redirects = 5
-
             # 尝试下载m3u8文件
-            response = session.get(url, headers=headers, timeout=self.timeout, allow_redirects=True)
-            response.raise_for_status()
-            # 保存m3u8文件
-            with open(m3u8_filename, 'wb') as f:
-                f.write(response.content)
-
+            self.logger.info(f"开始下载m3u8文件: {url}")
+            content, base_url = self.fetch_playlist(url, headers)
             self.logger.info("m3u8文件下载成功")
+            playlist = m3u8.loads(content.decode('utf-8'))
 
-            # 解析m3u8文件
-            with open(m3u8_filename, 'r') as f:
-                m3u8_content = f.read()
-
-            playlist = m3u8.loads(m3u8_content)
-
-            # 获取所有ts片段的URL
-            ts_urls = []
-            for segment in playlist.segments:
-                ts_url = urljoin(url, segment.uri)
-                #print("ts_url", ts_url)
-                ts_urls.append(ts_url)
-
-            result["ts_urls"] = ts_urls
-            result["total_segments"] = len(ts_urls)
-            self.logger.info(f"找到 {len(ts_urls)} 个视频片段")
-
-            # 创建ts文件保存目录
-            ts_dir = os.path.join(video_dir, 'ts')
-            os.makedirs(ts_dir, exist_ok=True)
-
-            # 创建ts文件名映射
-            ts_mapping = {}
-            # 使用线程池并发下载ts片段
-            with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
-                futures = []
-                self.logger.info(f"开始下载 {len(ts_urls)} 个视频片段")
-
-                # 提交所有下载任务
-                for i, ts_url in enumerate(ts_urls[:7]):
-                    #ts_filename = os.path.join(ts_dir, f'segment_{i:06d}.ts')
-                    original_filename = os.path.basename(ts_url)
-                    standard_filename = generate_standard_filename('video', self.content_id, 'fetch', '.ts', segment_index=i)
-                    # 保存映射关系
-                    ts_mapping[original_filename] = standard_filename
-
-                    ts_filename = os.path.join(ts_dir, standard_filename)
-                    future = executor.submit(self.download_and_verify_ts_segment, ts_url, ts_filename, headers, i)
-                    futures.append((i, ts_url, future,i))
-
-                # 等待所有下载完成，同时监控线程健康状态
-                while futures:
-                    # 检查失败数量是否超过限制
-                    if result["failed_segments"] >= self.maximum_error_ts:
-                        print("2-1")
-                        self.logger.error(f'失败片段数量超过{self.maximum_error_ts}个，停止当前视频下载')
-                        # 取消所有未完成的下载任务
-                        for _, _, future, i in futures:
-                            future.cancel()
-                        # 更新结果
-                        futures.clear()
-                        result["success"] = False
-                        result["error"] = f'失败片段数量超过{self.maximum_error_ts}个，停止当前视频下载'
-                        result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
-                        result['failed_m3u8'] = None
-                        # 清空futures列表，退出while循环，继续处理下一个视频
-
-                        return result
-
-                    # 检查线程健康状态
-                    current_time = time.time()
-                    for thread_id, status in list(self.thread_status.items()):
-                        # 检查线程是否超时或僵死
-                        if (current_time - status["start_time"] > self.thread_timeout or
-                                current_time - status.get("last_active", status["start_time"]) > 30):
-                            self.logger.warning(f"发现僵死线程 {thread_id}，正在重启")
-                            # 找到对应的future
-                            for idx, (i, ts_url, future,segment_index) in enumerate(futures):
-                                if future.done():
-                                    continue
-                                # 取消旧的future
-                                future.cancel()
-                                # 创建新的下载任务
-                                original_filename = os.path.basename(ts_url)
-                                try:
-                                    standard_filename = ts_mapping[original_filename]
-                                except KeyError:
-                                    # 如果获取不到映射，使用保存的segment_index重新生成
-                                    standard_filename = generate_standard_filename('video', self.content_id, 'fetch',
-                                                                                   '.ts', segment_index=segment_index)
-                                ts_filename = os.path.join(ts_dir, standard_filename)
-
-                                new_future = executor.submit(
-                                    self.download_and_verify_ts_segment,
-                                    ts_url,
-                                    ts_filename,
-                                    headers,
-                                    i
-                                )
-                                futures[idx] = (i, ts_url, new_future, segment_index)
-                                break
-
-                    # 检查已完成的future
-                    for i, ts_url, future, segment_index in futures[:]:
-                        try:
-                            if future.done():
-                                if not future.result():
-                                    self.logger.error(f"TS片段 {i} 下载失败: {ts_url}")
-                                    result["failed_ts_segments"].append({
-                                        "url": ts_url,
-                                        "segment_index": i,
-                                        "error": "TS片段下载失败",
-                                        "total_segments": len(ts_urls),
-                                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                                        "retry_count": 0
-                                    })
-                                    result["failed_segments"] += 1
-                                else:
-                                    result["successful_segments"] += 1
-                                futures.remove((i, ts_url, future, segment_index))
-                        except concurrent.futures.TimeoutError:
-                            self.logger.error(f"TS片段 {i} 下载超时: {ts_url}")
-                            result["failed_ts_segments"].append({
-                                "url": ts_url,
-                                "segment_index": i,
-                                "error": "下载超时",
-                                "total_segments": len(ts_urls),
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                                "retry_count": 0
-                            })
-                            result["failed_segments"] += 1
-                            futures.remove((i, ts_url, future,segment_index))
-                        except Exception as e:
-                            self.logger.error(f"TS片段 {i} 下载出错: {str(e)}")
-                            result["failed_ts_segments"].append({
-                                "url": ts_url,
-                                "segment_index": i,
-                                "error": str(e),
-                                "total_segments": len(ts_urls),
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-                                "retry_count": 0
-                            })
-                            result["failed_segments"] += 1
-                            futures.remove((i, ts_url, future,segment_index))
-
-                    time.sleep(1)
-
-                # 更新下载结束时间
-                result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
-
-                # 保存ts文件名映射
-                mapping_file = os.path.join(video_dir, 'ts_mapping.json')
-                with open(mapping_file, 'w', encoding='utf-8') as f:
-                    json.dump(ts_mapping, f, ensure_ascii=False, indent=2)
-                self.logger.info(f"已保存ts文件名映射到: {mapping_file}")
-
-                # 下载完成后，修改m3u8文件
-                if result["success"]:
-                    self.modify_m3u8_for_local_playback(m3u8_filename, ts_dir, ts_urls, ts_mapping=ts_mapping)
-
-
-
-                # 检查是否有失败的片段
-                if result["failed_ts_segments"]:
-                    result["success"] = False
-                    result["error"] = f"有 {len(result['failed_ts_segments'])} 个TS片段下载失败"
-                    self.logger.error(result["error"])
-                    # 记录详细的失败统计
-                    self.logger.error(f"下载统计: 总数={result['total_segments']}, "
-                                      f"成功={result['successful_segments']}, "
-                                      f"失败={result['failed_segments']}")
-                else:
-                    self.logger.info("所有视频片段下载完成")
-                    self.logger.info(f"下载统计: 总数={result['total_segments']}, "
-                                     f"成功={result['successful_segments']}, "
-                                     f"失败={result['failed_segments']}")
+            if not playlist.is_variant:
+                job.m3u8_results.append(result)
+                self.download_media_playlist(base_url, content, playlist, video_dir, headers, job, result)
+                return result
 
+            # 主播放列表：保存原文件，按策略选择码率
+            master_filename = os.path.join(video_dir, generate_standard_filename('video', job.content_id, 'master',
+                                                                                 '.m3u8'))
+            with open(master_filename, 'wb') as f:
+                f.write(content)
+            variants = self.select_variants(playlist, base_url)
+            if not variants:
+                raise Exception("主播放列表中没有可下载的码率")
+            self.logger.info(f"主播放列表包含 {len(playlist.playlists)} 个码率，按 {self.variant_policy} 策略选择: "
+                             + ", ".join(f"{variant.stream_info.bandwidth}bps" for _, variant in variants))
+
+            if len(variants) == 1:
+                variant_url = variants[0][0]
+                job.m3u8_results.append(result)
+                variant_content, variant_base_url = self.fetch_playlist(variant_url, headers)
+                self.download_media_playlist(variant_base_url, variant_content,
+                                             m3u8.loads(variant_content.decode('utf-8')),
+                                             video_dir, headers, job, result)
                 return result
 
+            return self.download_renditions(variants, video_dir, headers, job, result)
+
         except requests.exceptions.RequestException as e:
             error_msg = f"下载m3u8文件时出错: {str(e)}"
             self.logger.error(error_msg)
@@ -1016,7 +1061,577 @@ class M3U8Downloader:
             result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
             return result
 
-    def modify_m3u8_for_local_playback(self, m3u8_filename, ts_dir, ts_urls, ts_mapping=None, create_new_file=True):
+    def select_variants(self, master, base_url):
+        """按 variant_policy 排序主播放列表中的码率，返回前 max_renditions 个 [(媒体播放列表URL, 码率信息), ...]"""
+        def bandwidth(variant):
+            info = variant.stream_info
+            return info.bandwidth or info.average_bandwidth or 0
+
+        variants = [variant for variant in master.playlists if variant.uri]
+        if self.variant_policy == 'lowest':
+            variants.sort(key=bandwidth)
+        elif self.variant_policy == 'closest':
+            target = self.target_bandwidth or 0
+            variants.sort(key=lambda variant: (abs(bandwidth(variant) - target), -bandwidth(variant)))
+        else:
+            variants.sort(key=bandwidth, reverse=True)
+
+        selected = []
+        seen = set()
+        for variant in variants:
+            # 同一媒体播放列表可能因音频组不同出现多次
+            variant_url = urljoin(base_url, variant.uri)
+            if variant_url in seen:
+                continue
+            seen.add(variant_url)
+            if variant.stream_info.audio:
+                self.logger.warning(f"码率 {bandwidth(variant)}bps 使用独立的音频组 {variant.stream_info.audio}，"
+                                    f"只下载视频播放列表")
+            selected.append((variant_url, variant))
+            if len(selected) >= max(1, self.max_renditions):
+                break
+        return selected
+
+    def download_renditions(self, variants, video_dir, headers, job, result):
+        """并发下载多个码率，每个码率一个子目录，完成后生成本地主播放列表并合并下载结果"""
+        renditions = []
+        for index, (variant_url, variant) in enumerate(variants):
+            info = variant.stream_info
+            name = f"{info.resolution[1]}p_{(info.bandwidth or 0) // 1000}kbps" if info.resolution \
+                else f"variant_{index}_{(info.bandwidth or 0) // 1000}kbps"
+            # 片段记录以 主播放列表URL#码率目录 区分，续传时按主播放列表URL找回内容ID
+            rendition_result = self.new_m3u8_result(f"{result['m3u8_url']}#{name}")
+            job.m3u8_results.append(rendition_result)
+            renditions.append((name, variant_url, variant, rendition_result))
+
+        def download_rendition(name, variant_url, rendition_result):
+            rendition_dir = os.path.join(video_dir, name)
+            os.makedirs(rendition_dir, exist_ok=True)
+            try:
+                content, base_url = self.fetch_playlist(variant_url, headers)
+                return self.download_media_playlist(base_url, content, m3u8.loads(content.decode('utf-8')),
+                                                    rendition_dir, headers, job, rendition_result)
+            except Exception as e:
+                rendition_result["success"] = False
+                rendition_result["error"] = f"下载码率 {name} 时出错: {str(e)}"
+                self.logger.error(rendition_result["error"])
+                return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(renditions)) as executor:
+            local_playlists = list(executor.map(lambda item: download_rendition(item[0], item[1], item[3]),
+                                                renditions))
+
+        # 本地主播放列表只引用下载成功的码率
+        lines = ['#EXTM3U']
+        for (name, _, variant, _), local_playlist in zip(renditions, local_playlists):
+            if not local_playlist:
+                continue
+            info = variant.stream_info
+            attributes = [f"BANDWIDTH={info.bandwidth or 0}"]
+            if info.average_bandwidth:
+                attributes.append(f"AVERAGE-BANDWIDTH={info.average_bandwidth}")
+            if info.resolution:
+                attributes.append(f"RESOLUTION={info.resolution[0]}x{info.resolution[1]}")
+            if info.codecs:
+                attributes.append(f'CODECS="{info.codecs}"')
+            if info.frame_rate:
+                attributes.append(f"FRAME-RATE={info.frame_rate}")
+            lines.append(f"#EXT-X-STREAM-INF:{','.join(attributes)}")
+            lines.append(f"{name}/{os.path.basename(local_playlist)}")
+        if len(lines) > 1:
+            master_local = os.path.join(video_dir, generate_standard_filename('video', job.content_id, 'local', '.m3u8'))
+            with open(master_local, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.logger.info(f"已创建本地播放的主播放列表: {master_local}")
+
+        # 合并各码率的结果；多码率下失败的片段不单独重试，重试时整体重新下载（已完成的片段会跳过）
+        for _, _, _, rendition_result in renditions:
+            for key in ("total_segments", "successful_segments", "failed_segments", "downloaded_bytes"):
+                result[key] += rendition_result[key]
+            result["ts_urls"].extend(rendition_result["ts_urls"])
+            if not rendition_result["success"]:
+                result["success"] = False
+                result["error"] = rendition_result["error"]
+        result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        return result
+
+    def download_media_playlist(self, base_url, content, playlist, video_dir, headers, job, result):
+        """
+        下载媒体播放列表的全部片段，包括 EXT-X-MAP 初始化片段、AES-128 密钥和 EXT-X-BYTERANGE 片段
+
+        片段保存在 video_dir/ts/，密钥保存在 video_dir/keys/；加密片段保持加密，本地播放列表引用本地密钥。
+        字节范围片段各自保存为独立文件，本地播放列表中不再带 BYTERANGE。
+
+        Returns:
+            str: 本地播放列表路径，失败片段数超限时为None
+        """
+        m3u8_url = result["m3u8_url"]
+        # 上次已重新封装完成（片段已删除）时直接沿用封装结果，不再重新下载
+        remuxed = self.ledger.remuxed(m3u8_url)
+        if remuxed and os.path.exists(remuxed["playlist"]) and os.path.exists(remuxed["mp4"]):
+            segment_count = len(playlist.segments)
+            result["ts_urls"] = [urljoin(base_url, segment.uri) for segment in playlist.segments]
+            result["total_segments"] = segment_count
+            result["successful_segments"] = segment_count
+            result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            self.logger.info(f"{m3u8_url} 上次已重新封装为 {remuxed['mp4']}，跳过下载")
+            return remuxed["playlist"]
+
+        # 保存m3u8文件
+        m3u8_filename = os.path.join(video_dir, generate_standard_filename('video', job.content_id, 'fetch', '.m3u8'))
+        with open(m3u8_filename, 'wb') as f:
+            f.write(content)
+
+        # 创建ts文件保存目录
+        ts_dir = os.path.join(video_dir, 'ts')
+        os.makedirs(ts_dir, exist_ok=True)
+
+        # 先下载初始化片段和密钥，片段离开它们无法播放
+        key_paths = self.download_keys(playlist, base_url, video_dir, headers)
+        map_paths = self.download_init_sections(playlist, base_url, ts_dir, headers, job)
+        # 只有普通ts播放列表可以在重试时单独补下载失败的片段
+        segment_retry = not (key_paths or map_paths or any(segment.byterange for segment in playlist.segments))
+
+        # 获取所有片段的URL和字节范围
+        ts_urls = []
+        byteranges = []
+        encrypted = []  # 加密的片段无法校验ts包结构
+        last_end = {}
+        for segment in playlist.segments:
+            ts_url = urljoin(base_url, segment.uri)
+            encrypted.append(bool(segment.key and (segment.key.method or 'NONE').upper() != 'NONE'))
+            byterange = None
+            if segment.byterange:
+                byterange = parse_byterange(segment.byterange, last_end.get(ts_url, 0))
+                last_end[ts_url] = byterange[1] + 1
+            ts_urls.append(ts_url)
+            byteranges.append(byterange)
+
+        result["ts_urls"] = ts_urls
+        result["total_segments"] = len(ts_urls)
+        self.logger.info(f"找到 {len(ts_urls)} 个视频片段")
+
+        # 创建ts文件名映射，上次已下载完成且文件仍在的片段直接沿用，
+        # 未完成的片段沿用原文件名，从留下的 .part 文件续传
+        previous_segments = self.ledger.segment_files(m3u8_url)
+        ts_mapping = {}
+        segment_files = []
+        tasks = []
+        for i, (ts_url, byterange) in enumerate(zip(ts_urls, byteranges)):
+            original_filename = os.path.basename(urlparse(ts_url).path)
+            previous_status, previous_filename = previous_segments.get(i, (None, None))
+            if previous_status == 'success' and os.path.exists(previous_filename):
+                ts_mapping[original_filename] = os.path.basename(previous_filename)
+                segment_files.append(previous_filename)
+                result["successful_segments"] += 1
+                continue
+            if previous_filename and os.path.dirname(previous_filename) == ts_dir:
+                standard_filename = os.path.basename(previous_filename)
+            else:
+                standard_filename = self.segment_filename(job.content_id, ts_url, i)
+            # 保存映射关系
+            ts_mapping[original_filename] = standard_filename
+            filename = os.path.join(ts_dir, standard_filename)
+            segment_files.append(filename)
+            tasks.append({"index": i, "url": ts_url, "filename": filename, "byterange": byterange,
+                          "validate_ts": filename.endswith('.ts') and not encrypted[i]})
+        self.ledger.add_segments(m3u8_url, job.content_id, tasks)
+
+        if result["successful_segments"]:
+            self.logger.info(f"{result['successful_segments']} 个视频片段上次已下载完成，跳过")
+        self.logger.info(f"开始下载 {len(tasks)} 个视频片段，下载引擎: {self.engine}")
+        if not self.fetch_segments(tasks, headers, result):
+            self.logger.error(f'失败片段数量超过{self.maximum_error_ts}个，停止当前视频下载')
+            result["success"] = False
+            result["error"] = f'失败片段数量超过{self.maximum_error_ts}个，停止当前视频下载'
+            result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            result['failed_m3u8'] = None
+            if not segment_retry:
+                result["failed_ts_segments"] = []
+            return None
+
+        # 更新下载结束时间
+        result["download_end_time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+
+        # 保存ts文件名映射
+        mapping_file = os.path.join(video_dir, 'ts_mapping.json')
+        with open(mapping_file, 'w', encoding='utf-8') as f:
+            json.dump(ts_mapping, f, ensure_ascii=False, indent=2)
+        self.logger.info(f"已保存ts文件名映射到: {mapping_file}")
+
+        # 下载完成后，生成本地播放的m3u8文件
+        local_filename = os.path.join(video_dir, generate_standard_filename('video', job.content_id, 'local', '.m3u8'))
+        self.write_local_playlist(content.decode('utf-8'), base_url, local_filename, segment_files,
+                                  key_paths, map_paths)
+
+        # 检查是否有失败的片段
+        if result["failed_ts_segments"]:
+            result["success"] = False
+            result["error"] = f"有 {len(result['failed_ts_segments'])} 个TS片段下载失败"
+            self.logger.error(result["error"])
+            # 记录详细的失败统计
+            self.logger.error(f"下载统计: 总数={result['total_segments']}, "
+                              f"成功={result['successful_segments']}, "
+                              f"失败={result['failed_segments']}")
+            if not segment_retry:
+                # 不记录失败片段，重试时重新下载整个m3u8，已完成的片段会跳过
+                result["failed_ts_segments"] = []
+        else:
+            self.logger.info("所有视频片段下载完成")
+            self.logger.info(f"下载统计: 总数={result['total_segments']}, "
+                             f"成功={result['successful_segments']}, "
+                             f"失败={result['failed_segments']}")
+            self.remux_media_playlist(video_dir, local_filename, job.content_id, playlist.target_duration,
+                                      m3u8_url=m3u8_url)
+        return local_filename
+
+    def remux_media_playlist(self, video_dir, local_filename, content_id, hls_time=None, m3u8_url=None):
+        """
+        把本地播放列表的全部片段重新封装为一个fMP4文件，用字节范围播放列表替换本地播放列表
+
+        新播放列表沿用本地播放列表的文件名，主播放列表和查找 local 播放列表的代码不需要修改。
+        成功后在下载记录中记下 m3u8_url 已封装，再删除 ts/、keys/ 和 ts_mapping.json（加密片段已在封装时解密），
+        之后重新下载该 m3u8 时直接沿用封装结果；ffmpeg 不可用或封装失败时保留原片段和播放列表。
+
+        Returns:
+            str: 生成的mp4文件路径，未封装时为None
+        """
+        if not self.remux_after_download:
+            return None
+        if not ffmpeg_available(self.ffmpeg_path):
+            self.logger.warning("找不到ffmpeg，跳过重新封装，保留ts片段")
+            return None
+
+        if hls_time is None:
+            with open(local_filename, 'r', encoding='utf-8') as f:
+                match = re.search(r'#EXT-X-TARGETDURATION:(\d+)', f.read())
+            hls_time = int(match.group(1)) if match else 6
+
+        output_mp4 = os.path.join(video_dir, generate_standard_filename('video', content_id, 'archive', '.mp4'))
+        output_playlist = f"{local_filename}.remux"
+        start = time.time()
+        try:
+            remux_to_single_fmp4(local_filename, output_mp4, output_playlist, hls_time,
+                                 ffmpeg=self.ffmpeg_path, timeout=self.remux_timeout)
+        except RemuxError as e:
+            self.logger.error(f"{str(e)}，保留ts片段")
+            for path in (output_mp4, output_playlist):
+                if os.path.exists(path):
+                    os.remove(path)
+            return None
+        os.replace(output_playlist, local_filename)
+
+        segment_count = len(os.listdir(os.path.join(video_dir, 'ts'))) if os.path.isdir(
+            os.path.join(video_dir, 'ts')) else 0
+        if m3u8_url:
+            # 先记录再删除片段，删除后中断也能识别为已完成
+            self.ledger.mark_remuxed(m3u8_url, content_id, local_filename, output_mp4, segment_count)
+        if not self.remux_keep_segments:
+            shutil.rmtree(os.path.join(video_dir, 'ts'), ignore_errors=True)
+            shutil.rmtree(os.path.join(video_dir, 'keys'), ignore_errors=True)
+            mapping_file = os.path.join(video_dir, 'ts_mapping.json')
+            if os.path.exists(mapping_file):
+                os.remove(mapping_file)
+        self.logger.info(f"已将 {segment_count} 个片段重新封装为 {output_mp4} "
+                         f"({os.path.getsize(output_mp4) / 1024 / 1024:.1f}MB, 耗时 {time.time() - start:.1f}s)")
+        return output_mp4
+
+    @staticmethod
+    def segment_filename(content_id, ts_url, index):
+        """片段的标准文件名，保留原扩展名（.ts/.m4s/.aac 等）"""
+        extension = os.path.splitext(urlparse(ts_url).path)[1] or '.ts'
+        standard_filename = generate_standard_filename('video', content_id, 'fetch', '.ts', segment_index=index)
+        return standard_filename[:-len('.ts')] + extension
+
+    def download_keys(self, playlist, base_url, video_dir, headers):
+        """
+        下载 AES-128/SAMPLE-AES 密钥，返回 {密钥URL: 本地相对路径}
+
+        Raises:
+            Exception: 密钥下载失败，此时片段无法解密播放
+        """
+        key_paths = {}
+        for key in playlist.keys:
+            if not key or not key.uri or (key.method or 'NONE').upper() == 'NONE':
+                continue
+            key_url = urljoin(base_url, key.uri)
+            if not key_url.startswith(('http://', 'https://')) or key_url in key_paths:
+                # skd:// 等DRM密钥无法下载，保持原地址
+                continue
+            relative_path = f"keys/key_{len(key_paths):03d}.key"
+            key_file = os.path.join(video_dir, relative_path)
+            os.makedirs(os.path.dirname(key_file), exist_ok=True)
+            if not os.path.exists(key_file) and not self.download_and_verify_ts_segment(key_url, key_file, headers, -1):
+                raise Exception(f"密钥下载失败: {key_url}")
+            key_paths[key_url] = relative_path
+        if key_paths:
+            self.logger.info(f"已下载 {len(key_paths)} 个 {playlist.keys[-1].method} 密钥")
+        return key_paths
+
+    def download_init_sections(self, playlist, base_url, ts_dir, headers, job):
+        """
+        下载 EXT-X-MAP 初始化片段，返回 {(URL, 字节范围): 本地相对路径}
+
+        Raises:
+            Exception: 初始化片段下载失败
+        """
+        map_paths = {}
+        for segment in playlist.segments:
+            init_section = getattr(segment, 'init_section', None)
+            if not init_section or not init_section.uri:
+                continue
+            map_url = urljoin(base_url, init_section.uri)
+            key = (map_url, init_section.byterange or None)
+            if key in map_paths:
+                continue
+            extension = os.path.splitext(urlparse(map_url).path)[1] or '.mp4'
+            filename = generate_standard_filename('video', job.content_id, f'init{len(map_paths)}', extension)
+            byterange = parse_byterange(init_section.byterange) if init_section.byterange else None
+            map_file = os.path.join(ts_dir, filename)
+            if not os.path.exists(map_file) and not self.download_and_verify_ts_segment(map_url, map_file, headers, -1,
+                                                                                        byterange=byterange):
+                raise Exception(f"初始化片段下载失败: {map_url}")
+            map_paths[key] = f"ts/{filename}"
+        return map_paths
+
+    def write_local_playlist(self, content, base_url, local_filename, segment_files, key_paths, map_paths):
+        """
+        按原播放列表生成本地播放列表
+
+        已下载的片段、密钥和初始化片段改为本地相对路径（片段的 BYTERANGE 去掉），
+        未下载成功的片段改为绝对地址，之后可以用 modify_m3u8_for_local_playback 替换为重试下载的文件。
+        """
+        lines = []
+        segment_index = 0
+        pending_byterange = None
+        for line in content.splitlines():
+            stripped = line.strip()
+            if stripped.startswith('#EXT-X-BYTERANGE'):
+                # 等到片段URI行再决定是否保留
+                pending_byterange = line
+                continue
+            if stripped.startswith('#EXT-X-KEY'):
+                attributes = parse_tag_attributes(stripped)
+                key_url = urljoin(base_url, attributes.get('URI', ''))
+                if key_url in key_paths:
+                    line = re.sub(r'URI="[^"]*"', f'URI="{key_paths[key_url]}"', line)
+            elif stripped.startswith('#EXT-X-MAP'):
+                attributes = parse_tag_attributes(stripped)
+                key = (urljoin(base_url, attributes.get('URI', '')), attributes.get('BYTERANGE') or None)
+                if key in map_paths:
+                    line = f'#EXT-X-MAP:URI="{map_paths[key]}"'
+            elif stripped and not stripped.startswith('#'):
+                local_file = segment_files[segment_index] if segment_index < len(segment_files) else None
+                if local_file and os.path.exists(local_file):
+                    line = f"ts/{os.path.basename(local_file)}"
+                else:
+                    if pending_byterange:
+                        lines.append(pending_byterange)
+                    line = urljoin(base_url, stripped)
+                pending_byterange = None
+                segment_index += 1
+            lines.append(line)
+
+        with open(local_filename, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.logger.info(f"已创建本地播放的m3u8文件: {local_filename}")
+        self.logger.info(f"共处理 {segment_index} 个ts片段")
+
+    def record_segment_result(self, result, index, url, success, error=None, size=0, checksum=None):
+        """把单个片段的下载结果计入download_m3u8的结果，并记录到下载记录中用于续传"""
+        self.ledger.mark_segment(result["m3u8_url"], index, success, size, error, checksum)
+        if success:
+            result["successful_segments"] += 1
+            result["downloaded_bytes"] += size
+            return
+        self.logger.error(f"TS片段 {index} 下载失败: {url}")
+        result["failed_ts_segments"].append({
+            "url": url,
+            "segment_index": index,
+            "error": error or "TS片段下载失败",
+            "total_segments": result["total_segments"],
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "retry_count": 0
+        })
+        result["failed_segments"] += 1
+
+    def fetch_segments(self, tasks, headers, result):
+        """
+        按self.engine选择的引擎下载ts片段
+
+        Args:
+            tasks (list): [{"index": int, "url": str, "filename": str, "byterange": (起始, 结束) 或 None}, ...]
+            headers (dict): 请求头
+            result (dict): download_m3u8的结果，逐个片段更新成功/失败统计
+
+        Returns:
+            bool: False表示失败片段数达到maximum_error_ts，下载被中止
+        """
+        if self.engine == 'async' and not any(task.get("byterange") for task in tasks):
+            # async 引擎只能整文件下载，字节范围片段使用线程池引擎
+            return self._fetch_segments_async(tasks, headers, result)
+        return self._fetch_segments_threaded(tasks, headers, result)
+
+    def _fetch_segments_async(self, tasks, headers, result):
+        from async_segment_engine import AsyncSegmentEngine
+
+        engine = AsyncSegmentEngine(per_host_limit=self.per_host_limit, timeout=self.timeout,
+                                    chunk_size=self.chunk_size, max_errors=self.maximum_error_ts,
+                                    corrupt_retries=self.max_segment_redispatch,
+                                    cc_error_tolerance=self.ts_cc_error_tolerance, logger=self.logger)
+        segment_results, aborted = engine.run(tasks, headers)
+        for segment in segment_results:
+            self.record_segment_result(result, segment["index"], segment["url"], segment["success"],
+                                       segment["error"], segment["size"], segment.get("checksum"))
+        return not aborted
+
+    def _fetch_segments_threaded(self, tasks, headers, result):
+        """
+        使用线程池并发下载ts片段，由看门狗按字节进度监控每个片段
+
+        - 吞吐低于 min_segment_throughput 的片段视为卡住，中止该次下载并只重新提交这一个片段
+        - 队列排空后，耗时明显长于已完成片段的尾部片段会再发一个对冲请求，先完成的为准
+        - 校验失败（ts包损坏）的片段立即重新提交，与卡住的片段共用 max_segment_redispatch 次数
+        - 一个片段的所有尝试都失败才计入失败数
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        pending = {}  # future -> 下载尝试
+        # 片段索引 -> 片段状态，futures 为该片段正在进行的下载尝试
+        segments = {task["index"]: {"task": task, "futures": {}, "redispatched": 0, "hedged": False, "done": False,
+                                    "part_lock": threading.Lock()}
+                    for task in tasks}
+        durations = []  # 已完成片段的下载耗时，用于判断哪些片段是慢尾
+        attempt_ids = itertools.count(1)
+
+        def submit(segment, hedge=False):
+            task = segment["task"]
+            attempt = {"id": next(attempt_ids), "index": task["index"], "hedge": hedge,
+                       "start_time": None, "bytes": 0, "checked_at": None, "checked_bytes": 0,
+                       "cancelled": threading.Event(), "response": None, "part_lock": segment["part_lock"]}
+            future = executor.submit(self.download_and_verify_ts_segment, task["url"], task["filename"],
+                                     headers, task["index"], attempt, task.get("byterange"),
+                                     task.get("validate_ts", False))
+            pending[future] = attempt
+            segment["futures"][future] = attempt
+
+        try:
+            for segment in segments.values():
+                submit(segment)
+
+            last_check = time.time()
+            while pending:
+                done, _ = concurrent.futures.wait(pending, timeout=self.watchdog_interval,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    attempt = pending.pop(future)
+                    segment = segments[attempt["index"]]
+                    del segment["futures"][future]
+                    if segment["done"]:
+                        continue
+                    try:
+                        success, error = future.result(), None
+                    except Exception as e:
+                        success, error = False, str(e)
+
+                    if success:
+                        segment["done"] = True
+                        durations.append(time.time() - attempt["start_time"])
+                        self._cancel_attempts(pending, segment)
+                        self.record_segment_result(result, attempt["index"], segment["task"]["url"], True,
+                                                   size=attempt["bytes"], checksum=attempt.get("checksum"))
+                    elif (attempt.get("corrupt") and not segment["futures"] and
+                          segment["redispatched"] < self.max_segment_redispatch):
+                        # 内容损坏的片段立即重新下载
+                        segment["redispatched"] += 1
+                        submit(segment)
+                    elif not segment["futures"]:
+                        # 同一片段没有其他尝试在下载时才算失败
+                        segment["done"] = True
+                        self.record_segment_result(result, attempt["index"], segment["task"]["url"], False, error)
+
+                # 检查失败数量是否超过限制
+                if result["failed_segments"] >= self.maximum_error_ts:
+                    return False
+
+                now = time.time()
+                if now - last_check >= self.watchdog_interval:
+                    last_check = now
+                    for attempt in self._find_stalled_attempts(pending, now):
+                        segment = segments[attempt["index"]]
+                        if segment["redispatched"] >= self.max_segment_redispatch:
+                            continue
+                        self.logger.warning(f"TS片段 {attempt['index']} 下载过慢，重新提交: "
+                                            f"{attempt['bytes']} 字节, 已用时 {now - attempt['start_time']:.1f}s")
+                        self._cancel_attempts(pending, segment, attempt["id"])
+                        segment["redispatched"] += 1
+                        submit(segment)
+                    self._hedge_slow_tail(pending, segments, durations, now, submit)
+            return True
+        finally:
+            for attempt in pending.values():
+                self._cancel_attempt(attempt)
+            # 中止时取消排队中的任务，不等待正在下载的片段
+            executor.shutdown(wait=not pending, cancel_futures=True)
+
+    def _find_stalled_attempts(self, pending, now):
+        """返回最近一个检查周期内吞吐低于 min_segment_throughput 的下载尝试"""
+        stalled = []
+        for attempt in pending.values():
+            if (attempt["start_time"] is None or attempt["cancelled"].is_set() or
+                    now - attempt["start_time"] < self.stall_grace_period):
+                continue
+            elapsed = now - attempt["checked_at"]
+            throughput = (attempt["bytes"] - attempt["checked_bytes"]) / elapsed if elapsed > 0 else 0
+            attempt["checked_at"], attempt["checked_bytes"] = now, attempt["bytes"]
+            if throughput < self.min_segment_throughput:
+                stalled.append(attempt)
+        return stalled
+
+    def _hedge_slow_tail(self, pending, segments, durations, now, submit):
+        """队列排空、有空闲线程时，为耗时超过已完成片段中位数 hedge_factor 倍的片段发对冲请求"""
+        in_flight = [attempt for attempt in pending.values() if not attempt["cancelled"].is_set()]
+        started = [attempt for attempt in in_flight if attempt["start_time"] is not None]
+        if not durations or len(in_flight) >= self.max_workers:
+            return
+        median = sorted(durations)[len(durations) // 2]
+        threshold = max(median * self.hedge_factor, self.stall_grace_period)
+        free_workers = self.max_workers - len(in_flight)
+        for attempt in sorted(started, key=lambda item: item["start_time"]):
+            if free_workers <= 0:
+                break
+            segment = segments[attempt["index"]]
+            if segment["hedged"] or segment["done"] or now - attempt["start_time"] < threshold:
+                continue
+            self.logger.info(f"TS片段 {attempt['index']} 耗时 {now - attempt['start_time']:.1f}s，"
+                             f"超过中位数 {median:.1f}s 的 {self.hedge_factor} 倍，发起对冲请求")
+            segment["hedged"] = True
+            submit(segment, hedge=True)
+            free_workers -= 1
+
+    def _cancel_attempts(self, pending, segment, attempt_id=None):
+        """中止片段的下载尝试并不再等待其结果，attempt_id 不为空时只中止该次尝试"""
+        for future, attempt in list(segment["futures"].items()):
+            if attempt_id is not None and attempt["id"] != attempt_id:
+                continue
+            # 排队中的直接取消，正在下载的线程在下一次读取时退出
+            self._cancel_attempt(attempt)
+            future.cancel()
+            del segment["futures"][future]
+            del pending[future]
+
+    @staticmethod
+    def _cancel_attempt(attempt):
+        attempt["cancelled"].set()
+        response = attempt.get("response")
+        if response is not None:
+            # 关闭连接让阻塞在读取上的线程尽快返回
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def modify_m3u8_for_local_playback(self, m3u8_filename, ts_dir, ts_urls, ts_mapping=None, create_new_file=True,
+                                       content_id=None):
         """
         修改m3u8文件以便本地播放，使用ts_mapping.json中的映射关系
 
@@ -1026,6 +1641,7 @@ class M3U8Downloader:
             ts_urls (list): 新下载的ts文件URL列表
             ts_mapping (dict, optional): ts文件名映射关系
             create_new_file (bool): 是否创建新的m3u8文件，默认为True
+            content_id (str, optional): 直播间的内容ID，创建新文件时用于生成文件名
         """
         try:
             if ts_mapping is None:
@@ -1088,7 +1704,7 @@ class M3U8Downloader:
                 # 创建新的m3u8文件名
                 dir_name = os.path.dirname(m3u8_filename)
                 new_m3u8_filename = os.path.join(dir_name,
-                                                 generate_standard_filename('video', self.content_id, 'local', '.m3u8'))
+                                                 generate_standard_filename('video', content_id, 'local', '.m3u8'))
             else:
                 new_m3u8_filename = m3u8_filename
 
@@ -1104,8 +1720,17 @@ class M3U8Downloader:
             self.logger.error(f"修改m3u8文件时出错: {str(e)}")
             return False
 
-    def process_data(self, data, token):
-        """处理输入数据(一个直播间的视频和图像)，下载视频和图片"""
+    def process_data(self, data, token, job=None):
+        """
+        处理输入数据(一个直播间的视频和图像)，下载视频和图片
+
+        Args:
+            data (str): 输入文件中的一行
+            token (str): 授权token
+            job (DownloadJob, optional): 该行对应的下载任务，为空时新建；内容ID和下载进度都保存在任务上，
+                不同任务可以在多个线程中同时处理
+        """
+        job = job or DownloadJob(data=data)
         try:
             # 解析数据
             fields = data.split(',')
@@ -1113,17 +1738,30 @@ class M3U8Downloader:
                 self.logger.error("数据格式错误")
                 return False
 
+            # 提取视频URL
+            video_url = None
+            for column in fields:
+                if '.m3u8' in column and (column.startswith('http://') or column.startswith('https://')):
+                    video_url = column
+                    break
+
             #content_id = fields[0]  # 获取ID
             # 获取content_id并进行异常处理
             try:
                 random_hash = str(uuid.uuid4()).replace('-', '')[:4]  # 去掉连字符后取前4位
                 #content_id = 直播间id + 一个4位随机数
-                self.content_id = fields[0] + '_' + random_hash
-
-                if not self.content_id or not self.content_id.strip():
+                job.content_id = fields[0] + '_' + random_hash
+                # 视频上次没有下载完时沿用原来的内容ID和目录，已下载的片段不再重新下载
+                resumed_content_id = self.ledger.resume_content_id(video_url)
+                if resumed_content_id:
+                    self.logger.info(f"视频上次未下载完成，继续使用内容ID: {resumed_content_id}")
+                    job.content_id = resumed_content_id
+
+                if not job.content_id or not job.content_id.strip():
                     raise ValueError("content_id为空")
             except (IndexError, ValueError) as e:
                 error_msg = f"无法获取content_id: {str(e)}"
+                job.error = error_msg
                 self.logger.error(error_msg)
                 # 记录错误到错误日志
                 error_record = {
@@ -1138,17 +1776,13 @@ class M3U8Downloader:
                     },
                     "total_ts_segments": 0
                 }
-                with open(self.error_log_file, 'a', encoding='utf-8') as f:
-                    if os.path.getsize(self.error_log_file) == 0:
-                        f.write(json.dumps(error_record, ensure_ascii=False))
-                    else:
-                        f.write('\n' + json.dumps(error_record, ensure_ascii=False))
+                self.ledger.save_error_record(error_record)
                 return False
 
-            self.logger.info(f"处理内容ID: {self.content_id}")
+            self.logger.info(f"处理内容ID: {job.content_id}")
 
             # 创建以ID命名的目录，使用短路径
-            content_dir = os.path.join(self.save_dir, self.content_id)  # 只使用ID的前8位
+            content_dir = os.path.join(self.save_dir, job.content_id)  # 只使用ID的前8位
             os.makedirs(content_dir, exist_ok=True)
             self.logger.info(f"创建内容目录: {content_dir}")
 
@@ -1156,25 +1790,18 @@ class M3U8Downloader:
 
             # 初始化错误记录
             error_record = {
-                "content_id": self.content_id,
+                "content_id": job.content_id,
                 "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
                 "failed_images": [],
                 "failed_m3u8": None,
                 "total_ts_segments": 0
             }
 
-            # 提取视频URL
-            video_url = None
-            for field in fields:
-                if '.m3u8' in field and (field.startswith('http://') or field.startswith('https://')):
-                    video_url = field
-                    break
-
             # 提取图片URL
             image_urls = []
-            for field in fields:
-                if field.startswith(('http://', 'https://')):
-                    urls = field.split(';')
+            for column in fields:
+                if column.startswith(('http://', 'https://')):
+                    urls = column.split(';')
                     for url in urls:
                         url = url.strip()
                         if url and ('.png' in url or '.jpg' in url or 'gif' in url or 'jpeg' in url):
@@ -1187,38 +1814,27 @@ class M3U8Downloader:
             if image_urls:
                 self.logger.info(f"开始下载 {len(image_urls)} 张图片")
                 success_flag = True
-                for i, url in enumerate(image_urls, 1):
-                    self.logger.info(f"下载第 {i}/{len(image_urls)} 张图片: {url}")
-                    try:
-                        # 使用content_dir而不是self.save_dir
-                        #if not self.download_image(url, content_dir):
-                         if url in self.downloaded_urls:
-                            self.logger.info(f"该直播间的图片已经下载，{url}，跳过")
-                            continue
-                         if not self.download_image(url, content_dir,token):
-                            error_record["failed_images"].append({
-                                "url": url,
-                                "error": "图片下载失败"
-                            })
-                            success_flag = False
-                         else:
-                             self.logger.info(f"该直播间的图片下载成功，{url}")
-                    except Exception as e:
+                pending_urls = []
+                for url in image_urls:
+                    if self.is_downloaded(url):
+                        self.logger.info(f"该直播间的图片已经下载，{url}，跳过")
+                    else:
+                        pending_urls.append(url)
+                # 使用content_dir而不是self.save_dir
+                for url, success in self.download_images(pending_urls, content_dir, token,
+                                                         content_id=job.content_id).items():
+                    if success:
+                        self.ledger.mark_downloaded(url, job.content_id, 'image')
+                        self.logger.info(f"该直播间的图片下载成功，{url}")
+                    else:
                         error_record["failed_images"].append({
                             "url": url,
-                            "error": str(e)
+                            "error": "图片下载失败"
                         })
                         success_flag = False
 
                 if success_flag:
-                    successful_download = {
-                            "content_id": self.content_id,
-                            "url": '$$$$$'.join(str(x) for x in image_urls) if image_urls else "",
-                            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    self.successful_downloads.append(successful_download)
-                    self.save_successful_downloads()
-                    self.logger.info(f"已记录成功下载的images: {image_urls} (直播间ID: {self.content_id})")
+                    self.logger.info(f"该直播间的图片全部下载成功: {image_urls} (直播间ID: {job.content_id})")
 
 
             # 下载视频
@@ -1229,21 +1845,14 @@ class M3U8Downloader:
                     #content_id = os.path.basename(content_dir)
                     #print(content_id,self.downloaded_content_ids)
                     #if content_id in self.downloaded_content_ids:
-                    if video_url in self.downloaded_urls:
+                    if self.is_downloaded(video_url):
                         self.logger.info(f"该直播间的视频已经下载，{video_url}，跳过")
                         return True
-                    m3u8_result = self.download_m3u8(video_url, content_dir)
+                    m3u8_result = self.download_m3u8(video_url, content_dir, job)
                     if  m3u8_result["success"]:
                         # 记录成功下载的m3u8信息
-
-                        successful_download = {
-                            "content_id": self.content_id,
-                            "url": video_url,
-                            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                        }
-                        self.successful_downloads.append(successful_download)
-                        self.save_successful_downloads()
-                        self.logger.info(f"已记录成功下载的m3u8: {video_url} (直播间ID: {self.content_id})")
+                        self.ledger.mark_downloaded(video_url, job.content_id, 'm3u8', m3u8_result["downloaded_bytes"])
+                        self.logger.info(f"已记录成功下载的m3u8: {video_url} (直播间ID: {job.content_id})")
                     else:
                         error_record["failed_m3u8"] = {
                             "url": video_url,
@@ -1262,152 +1871,140 @@ class M3U8Downloader:
 
             # 如果有错误，保存到JSON文件
             if error_record["failed_images"] or error_record["failed_m3u8"]:
-                with open(self.error_log_file, 'a', encoding='utf-8') as f:
-                    # 检查文件是否为空
-                    if os.path.getsize(self.error_log_file) == 0:
-                        # 如果文件为空，直接写入JSON对象
-                        f.write(json.dumps(error_record, ensure_ascii=False))
-                    else:
-                        # 如果文件不为空，先写入换行符，再写入JSON对象
-                        f.write('\n' + json.dumps(error_record, ensure_ascii=False))
-                self.logger.info(f"错误记录已保存到: {self.error_log_file}")
-                self.logger.info(f"错误记录已保存到: {self.error_log_file}")
+                self.ledger.save_error_record(error_record)
+                self.logger.info(f"错误记录已保存到: {self.ledger_file}")
 
             return True
 
         except Exception as e:
+            job.error = str(e)
             self.logger.error(f"处理数据时出错: {str(e)}")
             return False
 
-    def read_and_process_file(self, file_path, vzan_token):
-        """读取CSV文件并处理每一行数据"""
-        error_records = []  # 用于记录处理失败的数据
-        success_count = 0
-        error_count = 0
+    def read_and_process_file(self, file_path, vzan_token, max_jobs=None):
+        """
+        读取CSV文件，并发处理每一行数据
+
+        每行是一个直播间，作为一个DownloadJob提交到任务线程池，同时处理max_jobs个直播间；
+        所有直播间共享segment_budget个片段下载名额和每个源站per_host_limit个名额，
+        处理过程中每隔progress_interval秒输出一次汇总进度。
 
+        Args:
+            file_path (str): 输入文件路径
+            vzan_token (str): 授权token
+            max_jobs (int, optional): 同时处理的直播间数，默认为self.max_concurrent_jobs
+        """
         try:
+            jobs = []
             with open(file_path, 'r', encoding='utf-8') as f:
                 # 读取标题行
                 header = f.readline().strip()
                 self.logger.info(f"文件标题: {header}")
 
-                # 读取每一行数据
                 for line_num, line in enumerate(f, 2):  # 从第2行开始计数
-                    try:
-                        line = line.strip()
-                        if not line:  # 跳过空行
-                            continue
-
-                        self.logger.info(f"正在处理第 {line_num} 行数据")
-
-                        # 处理数据
-                        if self.process_data(line,vzan_token):
-                            success_count += 1
-                            self.logger.info(f"第 {line_num} 行数据处理成功")
-                        else:
-                            error_count += 1
-                            error_records.append({
-                                "line_number": line_num,
-                                "data": line,
-                                "error": "处理失败",
-                                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                            })
-                            self.logger.error(f"第 {line_num} 行数据处理失败")
-
-                    except Exception as e:
-                        error_count += 1
-                        error_records.append({
-                            "line_number": line_num,
-                            "data": line,
-                            "error": str(e),
-                            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                        })
-                        self.logger.error(f"处理第 {line_num} 行数据时出错: {str(e)}")
-                        continue  # 继续处理下一行
+                    line = line.strip()
+                    if line:  # 跳过空行
+                        jobs.append(DownloadJob(line_num=line_num, data=line))
+
+            max_jobs = max_jobs or self.max_concurrent_jobs
+            self.logger.info(f"共 {len(jobs)} 行数据，同时处理 {max_jobs} 个直播间")
+
+            start_time = time.time()
+            last_report = start_time
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix='job') as executor:
+                pending = {executor.submit(self.run_job, job, vzan_token) for job in jobs}
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=self.progress_interval,
+                                                            return_when=concurrent.futures.FIRST_COMPLETED)
+                    if pending and time.time() - last_report >= self.progress_interval:
+                        last_report = time.time()
+                        self.log_progress(jobs, start_time)
+            self.log_progress(jobs, start_time)
 
             # 保存错误记录
+            error_records = [{
+                "line_number": job.line_num,
+                "data": job.data,
+                "error": job.error or "处理失败",
+                "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(job.finished_at))
+            } for job in jobs if job.status == 'failed']
+            success_count = len(jobs) - len(error_records)
             if error_records:
                 error_log_file = os.path.join(self.save_dir, 'processing_errors.json')
                 with open(error_log_file, 'w', encoding='utf-8') as f:
                     json.dump({
-                        "total_records": line_num - 1,
+                        "total_records": len(jobs),
                         "success_count": success_count,
-                        "error_count": error_count,
+                        "error_count": len(error_records),
                         "error_records": error_records,
                         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
                     }, f, ensure_ascii=False, indent=2)
                 self.logger.info(f"错误记录已保存到: {error_log_file}")
 
             # 输出处理统计
-            self.logger.info(f"处理完成: 总数={line_num - 1}, 成功={success_count}, 失败={error_count}")
+            self.logger.info(f"处理完成: 总数={len(jobs)}, 成功={success_count}, 失败={len(error_records)}")
             return True
 
         except Exception as e:
             self.logger.error(f"读取文件时出错: {str(e)}")
             return False
 
+    def run_job(self, job, token):
+        """在任务线程中处理一个直播间，结果记录在job上"""
+        job.status = 'running'
+        job.started_at = time.time()
+        self.logger.info(f"正在处理第 {job.line_num} 行数据")
+        try:
+            success = self.process_data(job.data, token, job)
+        except Exception as e:
+            job.error = str(e)
+            success = False
+        job.status = 'success' if success else 'failed'
+        job.finished_at = time.time()
+        if success:
+            self.logger.info(f"第 {job.line_num} 行数据处理成功")
+        else:
+            self.logger.error(f"第 {job.line_num} 行数据处理失败")
+        return success
+
+    def log_progress(self, jobs, start_time):
+        """输出所有直播间的汇总进度"""
+        elapsed = max(time.time() - start_time, 1e-6)
+        finished = sum(1 for job in jobs if job.status in ('success', 'failed'))
+        running = sum(1 for job in jobs if job.status == 'running')
+        failed = sum(1 for job in jobs if job.status == 'failed')
+        segments_total = sum(job.segments_total for job in jobs)
+        segments_done = sum(job.segments_done for job in jobs)
+        segments_failed = sum(job.segments_failed for job in jobs)
+        mb = sum(job.downloaded_bytes for job in jobs) / 1024 / 1024
+        self.logger.info(f"总进度: 直播间 {finished}/{len(jobs)} (进行中 {running}, 失败 {failed}), "
+                         f"片段 {segments_done}/{segments_total} (失败 {segments_failed}), "
+                         f"{mb:.1f}MB, {mb / elapsed:.2f}MB/s, 已用时 {elapsed:.0f}s")
+
     def retry_failed_downloads(self, token):
         """
-        读取错误日志并重新下载失败的内容
+        读取下载记录中的失败记录并重新下载失败的内容
 
         Args:
             token (str): 授权token
         """
         try:
-            # 首先检查错误日志文件是否存在
-            if not os.path.exists(self.error_log_file):
-                self.logger.info(f"错误日志文件不存在: {self.error_log_file}")
-                return
-
-
-            self.logger.info(f"开始处理错误日志: {self.error_log_file}")
-
-            # 读取错误日志
-            # 读取错误日志
-            # 读取错误日志
-            with open(self.error_log_file, 'r', encoding='utf-8') as f:
-                content = f.read().strip()
-                error_records = []
-
-                # 将内容按完整的JSON对象分割
-                json_objects = []
-                current_object = ""
-                brace_count = 0
-
-                for line in content.split('\n'):
-                    current_object += line + '\n'
-                    brace_count += line.count('{') - line.count('}')
-
-                    if brace_count == 0 and current_object.strip():
-                        # 找到一个完整的JSON对象
-                        json_objects.append(current_object.strip())
-                        current_object = ""
-
-                # 解析每个JSON对象
-                for json_str in json_objects:
-                    try:
-                        record = json.loads(json_str)
-                        error_records.append(record)
-                    except json.JSONDecodeError as e:
-                        self.logger.error(f"解析JSON记录时出错: {str(e)}")
-                        self.logger.error(f"问题JSON字符串: {json_str}")
-                        continue
-
-            self.logger.info(f"从错误日志中读取到 {len(error_records)} 条记录")
-            # 如果没有成功解析任何记录，抛出异常
+            error_records = self.ledger.error_records()
+            self.logger.info(f"从下载记录中读取到 {len(error_records)} 条错误记录")
             if not error_records:
-                raise Exception("错误日志文件中没有有效的记录")
+                return
 
             # 处理每条错误记录
             for record in error_records:
-                self.content_id = record.get('content_id')
-                if not self.content_id:
+                job = DownloadJob(content_id=record.get('content_id'))
+                if not job.content_id:
                     continue
+                m3u8_url = (record.get('failed_m3u8') or {}).get('url')
 
-                self.logger.info(f"处理内容ID: {self.content_id}")
+                self.logger.info(f"处理内容ID: {job.content_id}")
 
                 # 创建内容目录
-                content_dir = os.path.join(self.save_dir, self.content_id)
+                content_dir = os.path.join(self.save_dir, job.content_id)
                 os.makedirs(content_dir, exist_ok=True)
 
                 # 处理失败的图片
@@ -1415,19 +2012,17 @@ class M3U8Downloader:
                 if failed_images:
                     self.logger.info(f"重新下载 {len(failed_images)} 张失败的图片")
                     success_images = []
+                    image_results = self.download_images([image_info['url'] for image_info in failed_images
+                                                          if image_info.get('url')],
+                                                         content_dir, token, content_id=job.content_id)
                     for image_info in failed_images:
                         url = image_info.get('url')
-                        if not url:
-                            continue
-
-                        try:
-                            if self.download_image(url, content_dir, token):
-                                success_images.append(image_info)
-                                self.logger.info(f"成功重新下载图片: {url}")
-                            else:
-                                self.logger.error(f"重新下载图片失败: {url}")
-                        except Exception as e:
-                            self.logger.error(f"重新下载图片时出错: {str(e)}")
+                        if image_results.get(url):
+                            success_images.append(image_info)
+                            self.ledger.mark_downloaded(url, job.content_id, 'image')
+                            self.logger.info(f"成功重新下载图片: {url}")
+                        elif url:
+                            self.logger.error(f"重新下载图片失败: {url}")
 
                     # 更新错误记录中的失败图片列表
                     record['failed_images'] = [img for img in failed_images if img not in success_images]
@@ -1469,6 +2064,8 @@ class M3U8Downloader:
                                 futures = []
 
                                 ts_mapping = {}
+                                # 下载记录中登记的保存路径，本地播放列表引用的是这些文件，.part 续传文件也在这里
+                                ledger_files = self.ledger.segment_files(url)
 
                                 for ts_info in failed_ts_segments:
                                     ts_url = ts_info.get('url')
@@ -1476,17 +2073,21 @@ class M3U8Downloader:
                                     self.logger.info(f"处理ts片段: URL={ts_url}, segment_index={segment_index}")
                                     if ts_url and segment_index is not None:
                                         original_filename = os.path.basename(ts_url)
-                                        # 生成标准文件名
-                                        standard_filename = generate_standard_filename('video', self.content_id, 'fetch',
-                                                                                       '.ts',
-                                                                                       segment_index=segment_index)
+                                        _, ts_filename = ledger_files.get(segment_index, (None, None))
+                                        if ts_filename:
+                                            standard_filename = os.path.basename(ts_filename)
+                                        else:
+                                            # 没有登记的片段生成标准文件名
+                                            standard_filename = generate_standard_filename('video', job.content_id,
+                                                                                           'fetch', '.ts',
+                                                                                           segment_index=segment_index)
+                                            ts_filename = os.path.join(ts_dir, standard_filename)
                                         # 保存映射关系
                                         ts_mapping[original_filename] = standard_filename
 
-                                        # 使用标准文件名保存ts文件
-                                        ts_filename = os.path.join(ts_dir, standard_filename)
                                         future = executor.submit(self.download_and_verify_ts_segment, ts_url, ts_filename,
-                                                                 headers, segment_index)
+                                                                 headers, segment_index,
+                                                                 validate_ts=ts_filename.endswith('.ts'))
                                         futures.append((ts_info, future))
 
                                 # 等待所有下载完成
@@ -1494,6 +2095,7 @@ class M3U8Downloader:
                                     try:
                                         if future.result():
                                             success_ts.append(ts_info)
+                                            self.ledger.mark_segment(url, ts_info['segment_index'], True)
                                             self.logger.info(f"成功重新下载ts片段: {ts_info['url']}")
                                         else:
                                             self.logger.error(f"重新下载ts片段失败: {ts_info['url']}")
@@ -1542,6 +2144,7 @@ class M3U8Downloader:
 
                                     self.modify_m3u8_for_local_playback(m3u8_filename, ts_dir, [ts_info['url'] for ts_info in failed_ts_segments],
                                                                         ts_mapping = None, create_new_file = False)
+                                    self.remux_media_playlist(video_dir, m3u8_filename, job.content_id, m3u8_url=url)
                                 else:
                                     self.logger.error(f"找不到m3u8文件: {m3u8_filename}")
                             else:
@@ -1550,7 +2153,7 @@ class M3U8Downloader:
                             # 如果没有失败的ts片段，说明是m3u8文件本身下载失败，需要重新下载整个m3u8
                             self.logger.info(f"重新下载失败的m3u8: {url}")
                             try:
-                                m3u8_result = self.download_m3u8(url, content_dir)
+                                m3u8_result = self.download_m3u8(url, content_dir, job)
                                 if m3u8_result["success"]:
                                     self.logger.info(f"成功重新下载m3u8: {url}")
                                     record['failed_m3u8'] = None
@@ -1572,39 +2175,22 @@ class M3U8Downloader:
                                 }
                                 self.logger.error(f"重新下载m3u8时出错: {str(e)}")
 
-                # 更新错误记录的时间戳
-                #print("1")
+                # 每条记录处理完立即更新下载记录，中途退出时已重新下载成功的内容不会丢失
                 if (record.get('failed_m3u8') is None and
                         (not record.get('failed_images') or len(record.get('failed_images', [])) == 0)):
-                    #print("2")
-                    self.logger.info(f'所有下载失败的图片和视频都重新下载成功，更新{self.success_log_file}文件')
-                    successful_download = {
-                        "content_id": self.content_id,
-                        "url": url,
-                        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")
-                    }
-                    self.successful_downloads.append(successful_download)
-                    self.save_successful_downloads()
-
-                record['timestamp'] = time.strftime("%Y-%m-%d %H:%M:%S")
-
-            # 保存更新后的错误记录
-            updated_error_records = [record for record in error_records
-                                     if record.get('failed_images') or record.get('failed_m3u8')]
+                    self.logger.info(f'所有下载失败的图片和视频都重新下载成功 (直播间ID: {job.content_id})')
+                    if m3u8_url:
+                        self.ledger.mark_downloaded(m3u8_url, job.content_id, 'm3u8')
+                    self.ledger.delete_error_record(job.content_id)
+                else:
+                    record['timestamp'] = time.strftime("%Y-%m-%d %H:%M:%S")
+                    self.ledger.save_error_record(record)
 
-            if updated_error_records:
-                with open(self.error_log_file, 'w', encoding='utf-8') as f:
-                    for record in updated_error_records:
-                        # 保持原始格式，每个记录单独一行
-                        f.write(json.dumps(record, ensure_ascii=False) + '\n')
-                self.logger.info(f"更新后的错误记录已保存到: {self.error_log_file}")
+            remaining = len(self.ledger.error_records())
+            if remaining:
+                self.logger.info(f"仍有 {remaining} 条错误记录，已保存到: {self.ledger_file}")
             else:
-                # 只有在所有记录都成功处理后才删除文件
-                if all(not record.get('failed_images') and not record.get('failed_m3u8') for record in error_records):
-                    os.remove(self.error_log_file)
-                    self.logger.info("所有内容下载成功，已删除错误日志文件")
-                else:
-                    self.logger.warning("错误日志文件格式可能有问题，保留文件以供检查")
+                self.logger.info("所有内容下载成功，已清空错误记录")
         except Exception as e:
             self.logger.error(f"处理错误日志时出错: {str(e)}")
             import traceback
@@ -0,0 +1,125 @@
+"""
+分页接口的并发抓取
+
+知道总页数之后各页互不依赖，可以并发请求；但列表接口有频率限制，固定并发容易触发 429。
+PageFetcher 用 AIMD（加性增、乘性减）调整请求速率：
+- 响应正常时速率每次增加 increase_step
+- 遇到 429/5xx/超时时速率乘以 decrease_factor，并按 Retry-After 暂停，该页稍后重试
+结果按页码顺序返回，调用方遇到已抓取的页面时停止迭代即可，未发出的请求不会再发。
+"""
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class ThrottledError(Exception):
+    """接口返回 429/5xx 或超时，需要降低请求速率"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 响应头（秒数），无法解析时返回 None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class AimdRateLimiter:
+    """速率（每秒请求数）按 AIMD 调整的限速器，多个线程共用"""
+
+    def __init__(self, initial_rate=2.0, min_rate=0.5, max_rate=20.0, increase_step=0.5, decrease_factor=0.5):
+        self.rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, stop_event=None):
+        """等到下一个请求的发送时间，stop_event 被设置时返回 False"""
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(now, self._next_at)
+            self._next_at = send_at + 1.0 / self.rate
+        wait = send_at - time.monotonic()
+        if wait > 0:
+            if stop_event is not None:
+                return not stop_event.wait(wait)
+            time.sleep(wait)
+        return stop_event is None or not stop_event.is_set()
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            if retry_after:
+                self._next_at = max(self._next_at, time.monotonic() + retry_after)
+
+
+class PageFetcher:
+    """
+    按页码顺序返回结果的并发分页抓取器
+
+    fetch_page(page) 返回该页数据，失败时返回 None；
+    需要限速时抛出 ThrottledError，该页会在降速后重试，最多 max_throttle_retries 次。
+    同时在途的页数不超过 max_workers * 2，提前停止时浪费的请求有限。
+    """
+
+    def __init__(self, fetch_page, max_workers=8, limiter=None, max_throttle_retries=5, logger=None):
+        self.fetch_page = fetch_page
+        self.max_workers = max_workers
+        self.limiter = limiter or AimdRateLimiter()
+        self.max_throttle_retries = max_throttle_retries
+        self.logger = logger or logging.getLogger('PageFetcher')
+
+    def _fetch(self, page, stop_event):
+        for attempt in range(self.max_throttle_retries + 1):
+            if not self.limiter.acquire(stop_event):
+                return None
+            try:
+                result = self.fetch_page(page)
+            except ThrottledError as e:
+                self.limiter.on_throttle(e.retry_after)
+                self.logger.warning(f"第 {page} 页请求被限流 (尝试 {attempt + 1}/{self.max_throttle_retries + 1}): "
+                                    f"{str(e)}，速率降至 {self.limiter.rate:.2f} 次/秒")
+                continue
+            except Exception as e:
+                self.logger.error(f"获取第 {page} 页时出错: {str(e)}")
+                return None
+            self.limiter.on_success()
+            return result
+        self.logger.error(f"第 {page} 页多次被限流，放弃该页")
+        return None
+
+    def iter_pages(self, pages):
+        """
+        并发获取 pages 中的各页，按顺序生成 (页码, 数据)，数据为 None 表示该页获取失败
+
+        调用方 break 后生成器关闭，未开始的请求被取消。
+        """
+        pages = list(pages)
+        stop_event = threading.Event()
+        window = self.max_workers * 2
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='page')
+        futures = {}
+        submitted = 0
+        try:
+            for page in pages:
+                while submitted < len(pages) and len(futures) < window:
+                    futures[pages[submitted]] = executor.submit(self._fetch, pages[submitted], stop_event)
+                    submitted += 1
+                yield page, futures.pop(page).result()
+        finally:
+            stop_event.set()
+            for future in futures.values():
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -1,8 +1,9 @@
 import os
 import boto3
-from botocore.config import Config
 import logging
 
+from app.services.object_storage import get_client, iter_objects, delete_keys
+
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -18,13 +19,8 @@ def create_r2_client():
     if not all([ENDPOINT_URL, ACCESS_KEY, SECRET_KEY, BUCKET_NAME, PUB_SUBDOMAIN]):
         raise ValueError("Environment variables are not set correctly.")
 
-    return boto3.client(
-        's3',
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        config=Config(signature_version='s3v4')
-    ), BUCKET_NAME
+    # 同一 endpoint 和存储桶复用进程内缓存的客户端，不再每次调用都重新创建连接
+    return get_client(ENDPOINT_URL, BUCKET_NAME, ACCESS_KEY, SECRET_KEY), BUCKET_NAME
 
 
 # 获取相对路径并规范化为正斜杠
@@ -85,29 +81,17 @@ def get_r2_client():
 
 # 删除指定 prefix 的所有对象
 def delete_folder(folder_prefix):
-    # 列出所有匹配的对象
+    # 分页列出所有匹配的对象，list_objects_v2 单次最多返回 1000 个
     r2_client, bucket_name = create_r2_client()
-    bucket_name = 'raw-video'
-    print(bucket_name)
-    response = r2_client.list_objects_v2(
-        Bucket="raw-video",
-        Prefix=folder_prefix
-    )
+    keys = [obj['Key'] for obj in iter_objects(r2_client, bucket_name, folder_prefix)]
 
-    if 'Contents' not in response:
+    if not keys:
         print(f"No objects found with prefix: {folder_prefix}")
         return
 
-    # 准备删除请求
-    objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
-
-    # 执行批量删除
-    delete_response = r2_client.delete_objects(
-        Bucket=bucket_name,
-        Delete={'Objects': objects_to_delete}
-    )
-
-    print("Deleted objects:", delete_response.get('Deleted', []))
+    # 每批最多 1000 个执行批量删除
+    errors = delete_keys(r2_client, bucket_name, keys)
+    print(f"Deleted {len(keys) - len(errors)} objects, failed: {errors}")
 # 上传 HLS 流文件到 R2
 def upload_hls_to_r2(local_hls_folder):
     r2_client, bucket_name = create_r2_client()
@@ -1,8 +1,9 @@
 import os
-import boto3
-from botocore.config import Config
 import logging
 
+from app.services.hls_publisher import HlsPublisher
+from app.services.object_storage import get_client, iter_objects, delete_keys
+
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -12,16 +13,12 @@ SECRET_KEY = '5014e0600f03029c439a7cd19b9ad74b9548197bdeb5559e915c1f74ae19ed95'
 ENDPOINT_URL = 'https://fbc0f7bc8a3bdb7d0a20307c4eaf8cde.r2.cloudflarestorage.com'
 BUCKET_NAME = 'raw-video'
 PUB_SUBDOMAIN = 'https://pub-8ea55317b8624238a35e5c73454b9d2d.r2.dev'
+UPLOAD_WORKERS = 16  # HLS 并发上传的文件数
 
 # 创建 R2 客户端
 def create_r2_client():
-    return boto3.client(
-        's3',
-        endpoint_url=ENDPOINT_URL,
-        aws_access_key_id=ACCESS_KEY,
-        aws_secret_access_key=SECRET_KEY,
-        config=Config(signature_version='s3v4')
-    ), BUCKET_NAME
+    # 同一 endpoint 和存储桶复用进程内缓存的客户端，不再每次调用都重新创建连接
+    return get_client(ENDPOINT_URL, BUCKET_NAME, ACCESS_KEY, SECRET_KEY), BUCKET_NAME
 
 # 构造 R2 自定义域名访问地址
 def construct_custom_domain_r2_url(object_name):
@@ -60,27 +57,12 @@ def upload_single_video_to_r2(local_file_path):
         logging.error(f"上传失败: {e}")
         raise
 
-# 上传 HLS 文件夹（支持递归）
+# 上传 HLS 文件夹（支持递归），多线程共用一个客户端并发上传，播放列表最后上传
 def upload_hls_to_r2(local_hls_folder):
     r2_client, bucket_name = create_r2_client()
     try:
-        for root, _, files in os.walk(local_hls_folder):
-            for file in files:
-                local_file_path = os.path.join(root, file)
-                relative_path = get_relative_path(local_file_path, local_hls_folder)
-                object_name = f"videos/hls/{relative_path}"
-
-                with open(local_file_path, 'rb') as file_data:
-                    r2_client.upload_fileobj(
-                        file_data,
-                        bucket_name,
-                        object_name,
-                        ExtraArgs={
-                            'ACL': 'public-read',
-                            'CacheControl': 'public, max-age=604800'
-                        }
-                    )
-                logging.info(f"已上传: {object_name}")
+        stats = HlsPublisher(r2_client, bucket_name, max_workers=UPLOAD_WORKERS).publish(local_hls_folder, "videos/hls")
+        logging.info(f"已上传 {stats.objects} 个文件, {stats.mb_per_second:.2f}MB/s, {stats.objects_per_second:.1f} 个/s")
 
         playlist_url = construct_subdomain_r2_url("videos/hls/playlist.m3u8")
         logging.info(f"✅ HLS 主播放列表地址: {playlist_url}")
@@ -89,52 +71,39 @@ def upload_hls_to_r2(local_hls_folder):
         logging.error(f"HLS 上传失败: {e}")
         raise
 
-# 上传 HLS 文件夹（改用 put_object，一次性上传完整文件，避免 aws-chunked）
+# 分片小于 HLS_MULTIPART_THRESHOLD 时本来就是单次 PUT 上传，不会出现 aws-chunked，
+# 不再需要把整个文件读入内存，保留该函数名兼容旧调用
 def upload_hls_to_r2_no_chunk(local_hls_folder):
+    return upload_hls_to_r2(local_hls_folder)
+
+# 增量同步 HLS 文件夹，只上传新增或内容变化的文件，delete_orphans 为 True 时删除远端多余的对象
+def sync_hls_to_r2(local_hls_folder, delete_orphans=False):
     r2_client, bucket_name = create_r2_client()
     try:
-        for root, _, files in os.walk(local_hls_folder):
-            for file in files:
-                local_file_path = os.path.join(root, file)
-                relative_path = get_relative_path(local_file_path, local_hls_folder)
-                object_name = f"videos/hls/{relative_path}"
-
-                with open(local_file_path, 'rb') as file_data:
-                    file_bytes = file_data.read()  # 一次性读取完整文件内容
-
-                # 用 put_object 上传，避免分块上传，防止出现 aws-chunked
-                r2_client.put_object(
-                    Bucket=bucket_name,
-                    Key=object_name,
-                    Body=file_bytes,
-                    ACL='public-read',
-                    CacheControl='public, max-age=604800'
-                )
-
-                logging.info(f"已上传: {object_name}")
+        stats = HlsPublisher(r2_client, bucket_name, max_workers=UPLOAD_WORKERS).sync(
+            local_hls_folder, "videos/hls", delete_orphans=delete_orphans)
+        logging.info(f"已上传 {stats.objects} 个, 跳过 {stats.skipped} 个, 删除 {stats.deleted} 个")
 
         playlist_url = construct_subdomain_r2_url("videos/hls/playlist.m3u8")
         logging.info(f"✅ HLS 主播放列表地址: {playlist_url}")
         return playlist_url
     except Exception as e:
-        logging.error(f"HLS 上传失败: {e}")
+        logging.error(f"HLS 同步失败: {e}")
         raise
 
-# 删除指定前缀下的所有对象
+# 删除指定前缀下的所有对象，分页列出，每批最多删除 1000 个
 def delete_folder(folder_prefix):
     r2_client, bucket_name = create_r2_client()
-    response = r2_client.list_objects_v2(Bucket=bucket_name, Prefix=folder_prefix)
+    keys = [obj['Key'] for obj in iter_objects(r2_client, bucket_name, folder_prefix)]
 
-    if 'Contents' not in response:
+    if not keys:
         logging.info(f"📁 无需删除，未找到前缀：{folder_prefix}")
         return
 
-    objects_to_delete = [{'Key': obj['Key']} for obj in response['Contents']]
-    delete_response = r2_client.delete_objects(
-        Bucket=bucket_name,
-        Delete={'Objects': objects_to_delete}
-    )
-    logging.info(f"🗑️ 已删除对象: {delete_response.get('Deleted', [])}")
+    errors = delete_keys(r2_client, bucket_name, keys)
+    logging.info(f"🗑️ 已删除 {len(keys) - len(errors)} 个对象，失败 {len(errors)} 个")
+    if errors:
+        logging.error(f"删除失败的对象: {errors[:10]}")
 
 # 测试入口
 def test():
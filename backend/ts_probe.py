@@ -0,0 +1,438 @@
+"""
+进程内解析 MPEG-TS 片段，获取分辨率、编码、帧率和码率，代替每个文件启动一次 ffprobe
+
+只读取文件开头和结尾各 probe_size 字节：
+- PAT/PMT 找到节目的视频、音频流类型和 PID
+- 视频 PES 中的 H.264/H.265 SPS 计算分辨率
+- 视频 PES 的 PTS 间隔计算帧率，开头和结尾的 PTS 差值计算时长，文件大小除以时长得到码率
+
+TsStreamValidator 在下载过程中逐块校验同步字节和连续计数器。
+"""
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+TS_PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+
+# PMT 中的 stream_type -> ffprobe 的 codec_name
+VIDEO_STREAM_TYPES = {
+    0x01: 'mpeg1video',
+    0x02: 'mpeg2video',
+    0x10: 'mpeg4',
+    0x1b: 'h264',
+    0x24: 'hevc',
+}
+AUDIO_STREAM_TYPES = {
+    0x03: 'mp2',
+    0x04: 'mp2',
+    0x0f: 'aac',
+    0x11: 'aac_latm',
+    0x81: 'ac3',
+    0x87: 'eac3',
+}
+
+# 带 chroma_format_idc 等扩展字段的 H.264 profile
+H264_HIGH_PROFILES = {100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135}
+
+
+class BitReader:
+    """按位读取 RBSP，支持无符号/有符号指数哥伦布编码"""
+
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def u(self, bits):
+        value = 0
+        for _ in range(bits):
+            byte = self.data[self.position >> 3]  # 越界时抛出 IndexError，由调用方处理
+            value = (value << 1) | ((byte >> (7 - (self.position & 7))) & 1)
+            self.position += 1
+        return value
+
+    def skip(self, bits):
+        self.position += bits
+
+    def ue(self):
+        zeros = 0
+        while self.u(1) == 0:
+            zeros += 1
+            if zeros > 31:
+                raise ValueError("指数哥伦布编码过长")
+        return (1 << zeros) - 1 + self.u(zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+def remove_emulation_prevention(data):
+    """去掉 NAL 中的防竞争字节 00 00 03"""
+    return data.replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+def iter_nal_units(data):
+    """按起始码 00 00 01 切分 Annex B 字节流"""
+    start = data.find(b'\x00\x00\x01')
+    while start != -1:
+        start += 3
+        end = data.find(b'\x00\x00\x01', start)
+        nal = data[start:end if end != -1 else len(data)]
+        yield nal.rstrip(b'\x00')
+        start = end
+
+
+def parse_h264_sps(nal):
+    """解析 H.264 SPS（含 NAL 头），返回 (宽, 高)"""
+    reader = BitReader(remove_emulation_prevention(nal[1:]))
+    profile_idc = reader.u(8)
+    reader.skip(16)  # constraint_set_flags, level_idc
+    reader.ue()  # seq_parameter_set_id
+    chroma_format_idc = 1
+    separate_colour_plane = 0
+    if profile_idc in H264_HIGH_PROFILES:
+        chroma_format_idc = reader.ue()
+        if chroma_format_idc == 3:
+            separate_colour_plane = reader.u(1)
+        reader.ue()  # bit_depth_luma_minus8
+        reader.ue()  # bit_depth_chroma_minus8
+        reader.skip(1)  # qpprime_y_zero_transform_bypass_flag
+        if reader.u(1):  # seq_scaling_matrix_present_flag
+            for i in range(8 if chroma_format_idc != 3 else 12):
+                if reader.u(1):
+                    size = 16 if i < 6 else 64
+                    last_scale = next_scale = 8
+                    for _ in range(size):
+                        if next_scale:
+                            next_scale = (last_scale + reader.se()) % 256
+                        last_scale = next_scale or last_scale
+    reader.ue()  # log2_max_frame_num_minus4
+    pic_order_cnt_type = reader.ue()
+    if pic_order_cnt_type == 0:
+        reader.ue()  # log2_max_pic_order_cnt_lsb_minus4
+    elif pic_order_cnt_type == 1:
+        reader.skip(1)  # delta_pic_order_always_zero_flag
+        reader.se()  # offset_for_non_ref_pic
+        reader.se()  # offset_for_top_to_bottom_field
+        for _ in range(reader.ue()):
+            reader.se()
+    reader.ue()  # max_num_ref_frames
+    reader.skip(1)  # gaps_in_frame_num_value_allowed_flag
+    width_in_mbs = reader.ue() + 1
+    height_in_map_units = reader.ue() + 1
+    frame_mbs_only = reader.u(1)
+    if not frame_mbs_only:
+        reader.skip(1)  # mb_adaptive_frame_field_flag
+    reader.skip(1)  # direct_8x8_inference_flag
+
+    width = width_in_mbs * 16
+    height = (2 - frame_mbs_only) * height_in_map_units * 16
+    if reader.u(1):  # frame_cropping_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        if chroma_format_idc == 0 or separate_colour_plane:
+            crop_x, crop_y = 1, 2 - frame_mbs_only
+        else:
+            crop_x = 1 if chroma_format_idc == 3 else 2
+            crop_y = (2 if chroma_format_idc == 1 else 1) * (2 - frame_mbs_only)
+        width -= crop_x * (left + right)
+        height -= crop_y * (top + bottom)
+    return width, height
+
+
+def parse_hevc_sps(nal):
+    """解析 H.265 SPS（含两字节 NAL 头），返回 (宽, 高)"""
+    reader = BitReader(remove_emulation_prevention(nal[2:]))
+    reader.skip(4)  # sps_video_parameter_set_id
+    max_sub_layers_minus1 = reader.u(3)
+    reader.skip(1)  # sps_temporal_id_nesting_flag
+    # profile_tier_level: general_profile 88 位 + general_level_idc 8 位
+    reader.skip(96)
+    sub_layer_flags = [(reader.u(1), reader.u(1)) for _ in range(max_sub_layers_minus1)]
+    if max_sub_layers_minus1 > 0:
+        reader.skip(2 * (8 - max_sub_layers_minus1))
+    for profile_present, level_present in sub_layer_flags:
+        reader.skip(88 if profile_present else 0)
+        reader.skip(8 if level_present else 0)
+    reader.ue()  # sps_seq_parameter_set_id
+    chroma_format_idc = reader.ue()
+    separate_colour_plane = reader.u(1) if chroma_format_idc == 3 else 0
+    width = reader.ue()
+    height = reader.ue()
+    if reader.u(1):  # conformance_window_flag
+        left, right, top, bottom = reader.ue(), reader.ue(), reader.ue(), reader.ue()
+        if separate_colour_plane:
+            chroma_format_idc = 0
+        sub_width = 2 if chroma_format_idc in (1, 2) else 1
+        sub_height = 2 if chroma_format_idc == 1 else 1
+        width -= sub_width * (left + right)
+        height -= sub_height * (top + bottom)
+    return width, height
+
+
+def find_sps_resolution(codec, payload):
+    """在视频 PES 负载中查找 SPS，返回 (宽, 高)，没有找到时为 None"""
+    for nal in iter_nal_units(payload):
+        if not nal:
+            continue
+        try:
+            if codec == 'h264' and nal[0] & 0x1f == 7:
+                return parse_h264_sps(nal)
+            if codec == 'hevc' and len(nal) > 2 and (nal[0] >> 1) & 0x3f == 33:
+                return parse_hevc_sps(nal)
+        except (IndexError, ValueError):
+            # SPS 被截断或跨 PES，继续找下一个
+            continue
+    return None
+
+
+def parse_pes_header(payload):
+    """解析 PES 头，返回 (PTS 或 None, 负载起始位置)，不是 PES 时返回 (None, None)"""
+    if len(payload) < 9 or payload[:3] != b'\x00\x00\x01':
+        return None, None
+    header_end = 9 + payload[8]
+    pts = None
+    if payload[7] & 0x80 and len(payload) >= 14:
+        pts = (((payload[9] >> 1) & 0x07) << 30 | payload[10] << 22 | (payload[11] >> 1) << 15
+               | payload[12] << 7 | payload[13] >> 1)
+    return pts, header_end
+
+
+def find_sync(data):
+    """找到连续三个包都以同步字节开头的位置，结尾部分从任意位置开始读取时用"""
+    for offset in range(min(TS_PACKET_SIZE, len(data))):
+        if all(data[offset + i * TS_PACKET_SIZE] == SYNC_BYTE
+               for i in range(3) if offset + i * TS_PACKET_SIZE < len(data)):
+            return offset
+    return None
+
+
+def iter_packets(data):
+    """遍历 TS 包，返回 (PID, 是否为单元起始, 负载)"""
+    offset = find_sync(data)
+    if offset is None:
+        return
+    for position in range(offset, len(data) - TS_PACKET_SIZE + 1, TS_PACKET_SIZE):
+        packet = data[position:position + TS_PACKET_SIZE]
+        if packet[0] != SYNC_BYTE:
+            continue
+        pid = ((packet[1] & 0x1f) << 8) | packet[2]
+        adaptation_field_control = (packet[3] >> 4) & 0x03
+        if not adaptation_field_control & 0x01:
+            continue  # 只有自适应字段，没有负载
+        start = 4
+        if adaptation_field_control & 0x02:
+            start += 1 + packet[4]
+        if start < TS_PACKET_SIZE:
+            yield pid, bool(packet[1] & 0x40), packet[start:]
+
+
+def parse_section(payload):
+    """跳过 pointer_field，返回 PSI 段（到 CRC 之前）"""
+    section = payload[1 + payload[0]:]
+    if len(section) < 3:
+        return None
+    section_length = ((section[1] & 0x0f) << 8) | section[2]
+    return section[:3 + section_length - 4]
+
+
+class TsStreamValidator:
+    """
+    边下载边校验 ts 字节流，不需要下载完成后再读一遍文件
+
+    - 每个 188 字节的包都以同步字节 0x47 开头，结尾没有残缺的包
+    - 每个 PID 有负载的包连续计数器依次加 1（允许重复包，自适应字段标记了不连续时重新开始计数）
+    - 累计 CRC32 作为片段的校验和，记录到下载记录中，之后可以不重新下载就核对磁盘上的文件
+    """
+
+    def __init__(self, max_cc_errors=0):
+        self.max_cc_errors = max_cc_errors
+        self.packets = 0
+        self.cc_errors = 0
+        self.error = None
+        self._crc = 0
+        self._remainder = b''
+        self._counters = {}
+
+    @property
+    def checksum(self):
+        return f"{self._crc:08x}"
+
+    def feed(self, chunk):
+        """校验新收到的数据，返回 False 表示已发现损坏，不必继续下载"""
+        if self.error:
+            return False
+        self._crc = zlib.crc32(chunk, self._crc)
+        data = self._remainder + chunk if self._remainder else chunk
+        usable = len(data) - len(data) % TS_PACKET_SIZE
+        self._remainder = data[usable:]
+        if usable:
+            self.check_packets(data[:usable])
+        return self.error is None
+
+    def check_packets(self, data):
+        count = len(data) // TS_PACKET_SIZE
+        if data[::TS_PACKET_SIZE].count(SYNC_BYTE) != count:
+            bad = next(i for i in range(count) if data[i * TS_PACKET_SIZE] != SYNC_BYTE)
+            self.error = f"第 {self.packets + bad} 个包缺少同步字节"
+            return
+        counters = self._counters
+        for i, (b1, b2, b3) in enumerate(zip(data[1::TS_PACKET_SIZE], data[2::TS_PACKET_SIZE],
+                                             data[3::TS_PACKET_SIZE])):
+            pid = ((b1 & 0x1f) << 8) | b2
+            if pid == 0x1fff or not b3 & 0x10:
+                continue  # 空包和没有负载的包不计数
+            counter = b3 & 0x0f
+            previous = counters.get(pid)
+            counters[pid] = counter
+            if previous is None or counter == previous or counter == (previous + 1) & 0x0f:
+                continue
+            position = i * TS_PACKET_SIZE
+            if b3 & 0x20 and data[position + 4] and data[position + 5] & 0x80:
+                continue  # discontinuity_indicator
+            self.cc_errors += 1
+            if self.cc_errors > self.max_cc_errors:
+                self.error = f"PID {pid} 连续计数器不连续: {previous} -> {counter}（第 {self.packets + i} 个包）"
+                return
+        self.packets += count
+
+    def finish(self):
+        """数据接收完毕，返回错误描述，没有问题时返回 None"""
+        if self.error is None and self._remainder:
+            self.error = f"结尾有 {len(self._remainder)} 字节不足一个包"
+        if self.error is None and not self.packets:
+            self.error = "没有ts包"
+        return self.error
+
+
+def read_head_and_tail(path, probe_size):
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(probe_size)
+        tail = b''
+        if size > probe_size:
+            f.seek(max(probe_size, size - probe_size))
+            tail = f.read()
+    return size, head, tail
+
+
+def pts_offset(reference, pts):
+    """pts 相对 reference 的有符号差值，处理 33 位 PTS 回绕"""
+    return (pts - reference + PTS_WRAP // 2) % PTS_WRAP - PTS_WRAP // 2
+
+
+def probe_ts(path, probe_size=128 * 1024):
+    """
+    解析 ts 文件，返回与 ffprobe 结果相同格式的视频信息
+
+    Returns:
+        dict: {'resolution': (宽, 高), 'bandwidth': bps, 'codec': str, 'frame_rate': float,
+               'audio_codec': str, 'duration': 秒}，不是有效的 ts 文件或没有视频流时返回 None
+    """
+    size, head, tail = read_head_and_tail(path, probe_size)
+
+    pmt_pids = set()
+    video_pid = video_codec = audio_codec = None
+    resolution = None
+    video_pts = []
+    payload = b''
+    for pid, unit_start, data in iter_packets(head):
+        if pid == 0 and unit_start and not pmt_pids:
+            section = parse_section(data)
+            if section and section[0] == 0x00:
+                for i in range(8, len(section) - 3, 4):
+                    program_number = (section[i] << 8) | section[i + 1]
+                    if program_number:
+                        pmt_pids.add(((section[i + 2] & 0x1f) << 8) | section[i + 3])
+        elif pid in pmt_pids and unit_start and video_pid is None:
+            section = parse_section(data)
+            if not section or section[0] != 0x02:
+                continue
+            program_info_length = ((section[10] & 0x0f) << 8) | section[11]
+            i = 12 + program_info_length
+            while i + 5 <= len(section):
+                stream_type = section[i]
+                elementary_pid = ((section[i + 1] & 0x1f) << 8) | section[i + 2]
+                if stream_type in VIDEO_STREAM_TYPES and video_pid is None:
+                    video_pid, video_codec = elementary_pid, VIDEO_STREAM_TYPES[stream_type]
+                elif stream_type in AUDIO_STREAM_TYPES and audio_codec is None:
+                    audio_codec = AUDIO_STREAM_TYPES[stream_type]
+                i += 5 + (((section[i + 3] & 0x0f) << 8) | section[i + 4])
+        elif pid == video_pid:
+            if unit_start:
+                pts, payload_start = parse_pes_header(data)
+                if pts is not None:
+                    video_pts.append(pts)
+                if resolution is None and payload:
+                    resolution = find_sps_resolution(video_codec, payload)
+                payload = data[payload_start:] if payload_start is not None else b''
+            elif resolution is None:
+                payload += data
+
+    if video_pid is None:
+        return None
+    if resolution is None and payload:
+        resolution = find_sps_resolution(video_codec, payload)
+
+    # 帧率: 显示顺序（PTS 排序后）相邻帧间隔的中位数，B 帧导致解码顺序与显示顺序不同
+    frame_rate = None
+    frame_interval = 0
+    if len(video_pts) >= 2:
+        ordered = sorted({pts_offset(video_pts[0], pts) for pts in video_pts})
+        deltas = sorted(b - a for a, b in zip(ordered, ordered[1:]) if 0 < b - a < PTS_CLOCK)
+        if deltas:
+            frame_interval = deltas[len(deltas) // 2]
+            frame_rate = round(PTS_CLOCK / frame_interval, 3)
+
+    # 时长: 结尾部分最大的 PTS 减去开头最小的 PTS，再加一帧
+    duration = None
+    last_pts = [pts for pid, unit_start, data in iter_packets(tail) if pid == video_pid and unit_start
+                for pts in [parse_pes_header(data)[0]] if pts is not None] or video_pts
+    if video_pts and last_pts:
+        first = min(pts_offset(video_pts[0], pts) for pts in video_pts)
+        span = max(pts_offset(video_pts[0], pts) for pts in last_pts) - first + frame_interval
+        if span:
+            duration = span / PTS_CLOCK
+
+    return {
+        'resolution': resolution,
+        'bandwidth': int(size * 8 / duration) if duration else None,
+        'codec': video_codec,
+        'frame_rate': frame_rate,
+        'audio_codec': audio_codec,
+        'duration': duration,
+    }
+
+
+def probe_segments(paths, max_workers=4, probe_size=128 * 1024):
+    """
+    批量解析多个 ts 片段，返回合并后的视频信息
+
+    分辨率、编码、帧率取第一个解析成功的片段，码率用所有片段的总大小除以总时长，
+    比单个片段的码率更接近整个视频的平均码率。每个片段只读取两次 probe_size 字节，
+    线程池主要用于并发读取文件。
+
+    Returns:
+        dict: 同 probe_ts，没有片段解析成功时返回 None
+    """
+    def probe(path):
+        try:
+            return path, probe_ts(path, probe_size)
+        except (OSError, IndexError, ValueError):
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = [(path, info) for path, info in executor.map(probe, paths) if info]
+    if not results:
+        return None
+
+    merged = dict(next((info for _, info in results if info['resolution']), results[0][1]))
+    timed = [(path, info) for path, info in results if info['duration']]
+    if timed:
+        total_size = sum(os.path.getsize(path) for path, _ in timed)
+        total_duration = sum(info['duration'] for _, info in timed)
+        merged['bandwidth'] = int(total_size * 8 / total_duration)
+        merged['duration'] = total_duration
+    return merged